@@ -0,0 +1,84 @@
+import os
+import random
+import statistics
+import time
+import unittest
+
+import pytest
+
+from ..cleanup_old_assets_fixture import cleanup_old_assets
+from ..requests_oauth_fixture import requests_oauth
+from ..farmos_asset_helpers_fixture import farmos_asset_helpers
+
+BENCHMARK_ASSET_COUNTS = os.environ.get('FARMOS_WFS_BENCHMARK_ASSET_COUNTS', '')
+
+BENCHMARK_REPETITIONS = 5
+
+# A small window in the middle of the area the benchmark assets are scattered over - similar to a panned QGIS map
+BENCHMARK_BBOX = '-1,-1,1,1'
+
+
+@pytest.mark.skipif(not BENCHMARK_ASSET_COUNTS, reason="set FARMOS_WFS_BENCHMARK_ASSET_COUNTS (e.g. '100,1000,5000') to run")
+@pytest.mark.usefixtures("requests_oauth", "cleanup_old_assets", 'farmos_asset_helpers')
+class BboxQueryBenchmarkTest(unittest.TestCase):
+    """
+    Measures how the BBOX GetFeature query time scales with the number of assets.
+
+    Run with `-s` to see the results and compare them before/after the composite indexes by dropping them with
+    `drush php:eval "\\Drupal::moduleHandler()->loadInclude('farmos_wfs', 'install'); farmos_wfs_drop_composite_indexes();"`
+    and adding them back with `farmos_wfs_add_composite_indexes()`.
+    """
+
+    def create_benchmark_assets(self, count, rand):
+        for idx in range(count):
+            lon = rand.uniform(-20, 20)
+            lat = rand.uniform(-20, 20)
+
+            self.create_asset('structure', {
+                "name": "Benchmark structure {}".format(idx),
+                "notes": {
+                    "value": "Benchmark asset... [created by farmOS_wfs-qgis_tests]",
+                },
+                "intrinsic_geometry": {
+                    "value": "POINT({lon} {lat})".format(lon=lon, lat=lat),
+                },
+                "structure_type": "building",
+                "is_fixed": True,
+            })
+
+    def time_bbox_query(self, s, result_type):
+        durations = []
+
+        for _ in range(BENCHMARK_REPETITIONS):
+            start = time.perf_counter()
+
+            response = s.get('http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=GetFeature'
+                             '&TYPENAME=farmos:asset_structure_point&RESULTTYPE={}&BBOX={}'.format(result_type, BENCHMARK_BBOX))
+
+            durations.append(time.perf_counter() - start)
+
+            self.assertEqual(response.status_code, 200)
+
+        return statistics.median(durations)
+
+    def test_bbox_query_time_by_asset_count(self):
+        asset_counts = sorted(int(count) for count in BENCHMARK_ASSET_COUNTS.split(','))
+
+        rand = random.Random(42)
+
+        created_count = 0
+
+        results = []
+
+        with self.requests_session() as s:
+            for asset_count in asset_counts:
+                self.create_benchmark_assets(asset_count - created_count, rand)
+                created_count = asset_count
+
+                results.append((asset_count, self.time_bbox_query(s, 'hits'), self.time_bbox_query(s, 'results')))
+
+        print()
+        print("{:>12} {:>16} {:>16}".format("assets", "hits (ms)", "results (ms)"))
+
+        for asset_count, hits_duration, results_duration in results:
+            print("{:>12} {:>16.1f} {:>16.1f}".format(asset_count, hits_duration * 1000, results_duration * 1000))
@@ -1,5 +1,8 @@
 import pytest
+import re
+import time
 import unittest
+import uuid
 
 from lxml import etree
 
@@ -168,3 +171,1184 @@ class EdgeCasesTest(unittest.TestCase):
 
                 self.assertEqual(lower_corner.text, "-16 -13")
                 self.assertEqual(upper_corner.text, "38 21")
+
+    def test_get_feature_paging_and_hits(self):
+        for name, lon, lat in [('Paged A', 3, 4), ('Paged B', 5, 6), ('Paged C', 7, 8)]:
+            self.create_asset('structure', {
+                "name": name,
+                "notes": {
+                    "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+                },
+                "intrinsic_geometry": {
+                    "value": "POINT({lon} {lat})".format(lon=lon, lat=lat),
+                },
+                "structure_type": "building",
+                "is_fixed": True,
+            })
+
+        get_feature_url = 'http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=GetFeature&TYPENAME=farmos:asset_structure_point'
+
+        with self.requests_session() as s:
+            response = s.get(get_feature_url + '&RESULTTYPE=hits')
+
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            total_features = int(root.attrib['numberOfFeatures'])
+
+            self.assertGreaterEqual(total_features, 3)
+            self.assertEqual(root.findall("./{*}featureMember"), [])
+
+            response = s.get(get_feature_url + '&MAXFEATURES=2')
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            first_page_ids = [f.attrib['{http://www.opengis.net/gml}id']
+                              for f in root.findall("./{*}featureMember/{*}asset_structure_point")]
+
+            self.assertEqual(root.attrib['numberOfFeatures'], '2')
+            self.assertEqual(len(first_page_ids), 2)
+
+            response = s.get(get_feature_url + '&MAXFEATURES=2&STARTINDEX=1')
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            second_page_ids = [f.attrib['{http://www.opengis.net/gml}id']
+                               for f in root.findall("./{*}featureMember/{*}asset_structure_point")]
+
+            self.assertEqual(second_page_ids[0], first_page_ids[1])
+
+            response = s.get(get_feature_url + '&STARTINDEX={}'.format(total_features - 1))
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            self.assertEqual(root.attrib['numberOfFeatures'], '1')
+            self.assertEqual(len(root.findall("./{*}featureMember")), 1)
+
+    def test_get_feature_rejects_invalid_max_features(self):
+        with self.requests_session() as s:
+            response = s.get(
+                'http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=GetFeature&TYPENAME=farmos:asset_structure_point&MAXFEATURES=-1')
+
+            self.assertEqual(response.status_code, 400)
+
+    def test_get_feature_serializes_taxonomy_term_references_across_batches(self):
+        name_prefix = 'Orchard tree {}'.format(uuid.uuid4())
+
+        plant_type_names = ['Orchard type {} {}'.format(idx, uuid.uuid4()) for idx in range(5)]
+
+        plant_xml = '''
+      <asset_plant_point xmlns="https://farmos.org/wfs">
+         <name>{name}</name>
+         <is_fixed>1</is_fixed>
+         <plant_type>{plant_type_name}</plant_type>
+         <notes>Sample description... [created by farmOS_wfs-qgis_tests]</notes>
+         <geometry>
+            <gml:Point srsName="EPSG:4326">
+               <gml:pos srsDimension="2">{lat} {lon}</gml:pos>
+            </gml:Point>
+         </geometry>
+      </asset_plant_point>'''
+
+        # More plants than fit in one batch of the default get_feature_batch_size (200)
+        plant_count = 250
+
+        transaction_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<Transaction xmlns="http://www.opengis.net/wfs" xmlns:farmos="https://farmos.org/wfs" xmlns:gml="http://www.opengis.net/gml" service="WFS" version="1.1.0">
+   <Insert>{plants}
+   </Insert>
+</Transaction>
+'''.format(plants=''.join(plant_xml.format(name='{} {}'.format(name_prefix, idx),
+                                           plant_type_name=plant_type_names[idx % len(plant_type_names)],
+                                           lat=idx % 80, lon=idx % 80)
+                          for idx in range(plant_count)))
+
+        filter_xml = '''<ogc:Filter xmlns:ogc="http://www.opengis.net/ogc">
+   <ogc:PropertyIsLike wildCard="*" singleChar="." escapeChar="!">
+      <ogc:PropertyName>name</ogc:PropertyName>
+      <ogc:Literal>{name_prefix} *</ogc:Literal>
+   </ogc:PropertyIsLike>
+</ogc:Filter>'''.format(name_prefix=name_prefix)
+
+        def get_features(s, max_features):
+            # The second request is measured so both see the same warm caches
+            for _ in range(2):
+                response = s.get('http://www/wfs', params={
+                    'SERVICE': 'WFS',
+                    'VERSION': '1.1.0',
+                    'REQUEST': 'GetFeature',
+                    'TYPENAME': 'farmos:asset_plant_point',
+                    'FILTER': filter_xml,
+                    'MAXFEATURES': max_features,
+                })
+
+                self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            # The trailing Server-Timing comment also covers the queries made while streaming the features
+            query_count = int(re.search(r'db;desc="(\d+) queries"', root.getnext().text).group(1))
+
+            return root, query_count
+
+        with self.requests_session() as s:
+            response = s.post(
+                'http://www/wfs?SERVICE=WFS', data=transaction_xml, headers={'content-type': 'application/xml'})
+
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            self.assertEqual(root.find("./{*}TransactionSummary/{*}totalInserted").text, str(plant_count))
+
+            _, few_features_query_count = get_features(s, 10)
+            _, one_batch_query_count = get_features(s, 200)
+
+            # Term references are resolved per batch rather than per feature
+            self.assertEqual(one_batch_query_count, few_features_query_count)
+
+            root, two_batches_query_count = get_features(s, plant_count)
+
+            self.assertLess(two_batches_query_count, 2 * one_batch_query_count)
+
+            served_plant_types_by_name = {
+                feature.find('./{*}name').text: feature.find('./{*}plant_type').text
+                for feature in root.findall("./{*}featureMember/{*}asset_plant_point")
+            }
+
+            self.assertDictEqual(served_plant_types_by_name, {
+                '{} {}'.format(name_prefix, idx): plant_type_names[idx % len(plant_type_names)]
+                for idx in range(plant_count)
+            })
+
+    def test_get_capabilities_supports_conditional_requests(self):
+        with self.requests_session() as s:
+            response = s.get(
+                'http://www/wfs?SERVICE=WFS&REQUEST=GetCapabilities')
+
+            self.assertEqual(response.status_code, 200)
+
+            etag = response.headers['ETag']
+
+            response = s.get(
+                'http://www/wfs?SERVICE=WFS&REQUEST=GetCapabilities', headers={'If-None-Match': etag})
+
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.text, '')
+
+        self.create_asset('structure', {
+            "name": "Capabilities invalidation",
+            "notes": {
+                "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+            },
+            "intrinsic_geometry": {
+                "value": "POINT(-170 -80)",
+            },
+            "structure_type": "building",
+            "is_fixed": True,
+        })
+
+        with self.requests_session() as s:
+            response = s.get(
+                'http://www/wfs?SERVICE=WFS&REQUEST=GetCapabilities', headers={'If-None-Match': etag})
+
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_describe_feature_type_supports_conditional_requests(self):
+        describe_feature_type_url = ('http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=DescribeFeatureType'
+                                     '&TYPENAME=farmos:asset_structure_point,farmos:asset_land_polygon')
+
+        with self.requests_session() as s:
+            response = s.get(describe_feature_type_url)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('max-age=', response.headers['Cache-Control'])
+
+            etag = response.headers['ETag']
+
+            response = s.get(describe_feature_type_url, headers={'If-None-Match': etag})
+
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.text, '')
+
+            # The same set of types in a different order shares the cached schema
+            response = s.get('http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=DescribeFeatureType'
+                             '&TYPENAME=farmos:asset_land_polygon,farmos:asset_structure_point')
+
+            self.assertEqual(response.headers['ETag'], etag)
+
+    def test_get_feature_supports_conditional_and_compressed_requests(self):
+        get_feature_url = ('http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=GetFeature'
+                           '&TYPENAME=farmos:asset_structure_point')
+
+        with self.requests_session() as s:
+            response = s.get(get_feature_url, headers={'Accept-Encoding': 'gzip'})
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+            # The body is transparently decompressed by requests
+            etree.fromstring(response.text.encode('utf8'))
+
+            etag = response.headers['ETag']
+
+            response = s.get(get_feature_url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.text, '')
+
+            self.create_asset('structure', {
+                "name": "Conditionally fetched structure",
+                "notes": {
+                    "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+                },
+                "intrinsic_geometry": {
+                    "value": "POINT(17 34)",
+                },
+                "structure_type": "building",
+                "is_fixed": True,
+            })
+
+            response = s.get(get_feature_url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_transaction_release_action_controls_partial_commits(self):
+        def transaction_xml(release_action, valid_name):
+            return '''<?xml version="1.0" encoding="UTF-8"?>
+<Transaction xmlns="http://www.opengis.net/wfs" xmlns:farmos="https://farmos.org/wfs" xmlns:gml="http://www.opengis.net/gml" service="WFS" version="1.1.0" releaseAction="{release_action}">
+   <Insert>
+      <asset_land_point xmlns="https://farmos.org/wfs">
+         <name>{valid_name}</name>
+         <is_fixed>1</is_fixed>
+         <land_type>other</land_type>
+         <notes>Sample description... [created by farmOS_wfs-qgis_tests]</notes>
+         <geometry>
+            <gml:Point srsName="EPSG:4326">
+               <gml:pos srsDimension="2">-1.5 2.5</gml:pos>
+            </gml:Point>
+         </geometry>
+      </asset_land_point>
+      <asset_land_point xmlns="https://farmos.org/wfs">
+         <name>Invalid release action point</name>
+         <is_fixed>1</is_fixed>
+         <land_type>other</land_type>
+         <notes>Sample description... [created by farmOS_wfs-qgis_tests]</notes>
+         <geometry>
+            <gml:LineString srsName="EPSG:4326">
+               <gml:posList srsDimension="2">-1.1 -0.2 -0.9 0.06</gml:posList>
+            </gml:LineString>
+         </geometry>
+      </asset_land_point>
+   </Insert>
+</Transaction>
+'''.format(release_action=release_action, valid_name=valid_name)
+
+        def count_land_assets_named(s, name):
+            response = s.get('http://www/api/asset/land', params={'filter[name]': name})
+
+            self.assertTrue(response.ok)
+
+            return len(response.json()['data'])
+
+        with self.requests_session() as s:
+            response = s.post(
+                'http://www/wfs?SERVICE=WFS', data=transaction_xml('ALL', 'Release all point'), headers={'content-type': 'application/xml'})
+
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            self.assertEqual(root.find("./{*}TransactionSummary/{*}totalInserted").text, '0')
+            self.assertEqual(len(root.findall("./{*}TransactionResults/{*}Action")), 1)
+            self.assertEqual(count_land_assets_named(s, 'Release all point'), 0)
+
+            response = s.post(
+                'http://www/wfs?SERVICE=WFS', data=transaction_xml('SOME', 'Release some point'), headers={'content-type': 'application/xml'})
+
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            self.assertEqual(root.find("./{*}TransactionSummary/{*}totalInserted").text, '1')
+            self.assertEqual(len(root.findall("./{*}TransactionResults/{*}Action")), 1)
+            self.assertEqual(count_land_assets_named(s, 'Release some point'), 1)
+
+    def test_transaction_rejects_unknown_release_action(self):
+        transaction_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<Transaction xmlns="http://www.opengis.net/wfs" service="WFS" version="1.1.0" releaseAction="MOST">
+</Transaction>
+'''
+
+        with self.requests_session() as s:
+            response = s.post(
+                'http://www/wfs?SERVICE=WFS', data=transaction_xml, headers={'content-type': 'application/xml'})
+
+            self.assertEqual(response.status_code, 400)
+
+    def test_transaction_deletes_all_features_matched_by_filter(self):
+        structure_ids = [self.create_asset('structure', {
+            "name": "Bulk delete {}".format(idx),
+            "notes": {
+                "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+            },
+            "intrinsic_geometry": {
+                "value": "POINT({lon} 12)".format(lon=idx),
+            },
+            "structure_type": "building",
+            "is_fixed": True,
+        }) for idx in range(3)]
+
+        feature_ids = ''.join('<ogc:FeatureId fid="asset_structure_point.{}"/>'.format(structure_id)
+                              for structure_id in structure_ids)
+
+        transaction_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<Transaction xmlns="http://www.opengis.net/wfs" xmlns:ogc="http://www.opengis.net/ogc" service="WFS" version="1.1.0">
+   <Delete typeName="farmos:asset_structure_point">
+      <ogc:Filter>{feature_ids}</ogc:Filter>
+   </Delete>
+</Transaction>
+'''.format(feature_ids=feature_ids)
+
+        with self.requests_session() as s:
+            response = s.post(
+                'http://www/wfs?SERVICE=WFS', data=transaction_xml, headers={'content-type': 'application/xml'})
+
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            self.assertEqual(root.find("./{*}TransactionSummary/{*}totalDeleted").text, '3')
+
+        for structure_id in structure_ids:
+            self.assert_asset_does_not_exist('structure', structure_id)
+
+    def test_transaction_reuses_taxonomy_terms_auto_created_earlier_in_the_transaction(self):
+        plant_type_name = 'Transaction shared type {}'.format(uuid.uuid4())
+
+        plant_xml = '''
+      <asset_plant_point xmlns="https://farmos.org/wfs">
+         <name>{name}</name>
+         <is_fixed>1</is_fixed>
+         <plant_type>{plant_type_name}</plant_type>
+         <notes>Sample description... [created by farmOS_wfs-qgis_tests]</notes>
+         <geometry>
+            <gml:Point srsName="EPSG:4326">
+               <gml:pos srsDimension="2">{lon} 14</gml:pos>
+            </gml:Point>
+         </geometry>
+      </asset_plant_point>'''
+
+        transaction_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<Transaction xmlns="http://www.opengis.net/wfs" xmlns:farmos="https://farmos.org/wfs" xmlns:gml="http://www.opengis.net/gml" service="WFS" version="1.1.0">
+   <Insert>{plants}
+   </Insert>
+</Transaction>
+'''.format(plants=''.join(plant_xml.format(name='Shared type plant {}'.format(idx), plant_type_name=plant_type_name, lon=idx)
+                          for idx in range(2)))
+
+        with self.requests_session() as s:
+            response = s.post(
+                'http://www/wfs?SERVICE=WFS', data=transaction_xml, headers={'content-type': 'application/xml'})
+
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            created_plant_ids = [feature_id.attrib['fid'].split('.')[1]
+                                 for feature_id in root.findall("./{*}InsertResults/{*}Feature/{*}FeatureId")]
+
+        self.assertEqual(len(created_plant_ids), 2)
+
+        plant_type_ids = set()
+
+        for plant_id in created_plant_ids:
+            plant_types = self.get_asset_ref_field_by_type_id_and_field('plant', plant_id, 'plant_type')
+
+            self.assertEqual(len(plant_types), 1)
+            self.assertEqual(plant_types[0]['attributes']['name'], plant_type_name)
+
+            plant_type_ids.add(plant_types[0]['id'])
+
+        self.assertEqual(len(plant_type_ids), 1)
+
+    def test_get_feature_filters_by_property_comparisons(self):
+        name_prefix = 'Filtered {}'.format(uuid.uuid4())
+
+        structure_ids_by_name = {
+            name: self.create_asset('structure', {
+                "name": name,
+                "notes": {
+                    "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+                },
+                "intrinsic_geometry": {
+                    "value": "POINT({lon} 16)".format(lon=lon),
+                },
+                "structure_type": "building",
+                "is_fixed": True,
+            }) for name, lon in [(name_prefix + ' barn', 1), (name_prefix + ' shed', 2), (name_prefix + ' silo', 30)]
+        }
+
+        filter_xml = '''<ogc:Filter xmlns:ogc="http://www.opengis.net/ogc" xmlns:gml="http://www.opengis.net/gml">
+   <ogc:And>
+      <ogc:PropertyIsLike wildCard="*" singleChar="." escapeChar="!">
+         <ogc:PropertyName>name</ogc:PropertyName>
+         <ogc:Literal>{name_prefix}*</ogc:Literal>
+      </ogc:PropertyIsLike>
+      <ogc:Not>
+         <ogc:PropertyIsEqualTo>
+            <ogc:PropertyName>farmos:name</ogc:PropertyName>
+            <ogc:Literal>{name_prefix} shed</ogc:Literal>
+         </ogc:PropertyIsEqualTo>
+      </ogc:Not>
+      <ogc:BBOX>
+         <ogc:PropertyName>geometry</ogc:PropertyName>
+         <gml:Envelope srsName="EPSG:4326">
+            <gml:lowerCorner>15 0</gml:lowerCorner>
+            <gml:upperCorner>17 10</gml:upperCorner>
+         </gml:Envelope>
+      </ogc:BBOX>
+   </ogc:And>
+</ogc:Filter>'''.format(name_prefix=name_prefix)
+
+        with self.requests_session() as s:
+            response = s.get('http://www/wfs', params={
+                'SERVICE': 'WFS',
+                'VERSION': '1.1.0',
+                'REQUEST': 'GetFeature',
+                'TYPENAME': 'farmos:asset_structure_point',
+                'FILTER': filter_xml,
+            })
+
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            served_ids = [feature.find('./{*}__uuid').text
+                          for feature in root.findall("./{*}featureMember/{*}asset_structure_point")]
+
+            self.assertEqual(served_ids, [structure_ids_by_name[name_prefix + ' barn']])
+
+    def test_get_feature_rejects_filters_on_unknown_properties(self):
+        filter_xml = '''<ogc:Filter xmlns:ogc="http://www.opengis.net/ogc">
+   <ogc:PropertyIsEqualTo>
+      <ogc:PropertyName>no_such_property</ogc:PropertyName>
+      <ogc:Literal>1</ogc:Literal>
+   </ogc:PropertyIsEqualTo>
+</ogc:Filter>'''
+
+        with self.requests_session() as s:
+            response = s.get('http://www/wfs', params={
+                'SERVICE': 'WFS',
+                'VERSION': '1.1.0',
+                'REQUEST': 'GetFeature',
+                'TYPENAME': 'farmos:asset_structure_point',
+                'FILTER': filter_xml,
+            })
+
+            self.assertEqual(response.status_code, 400)
+
+    def test_get_feature_refines_spatial_filters_with_exact_geometries(self):
+        name_prefix = 'Spatially filtered {}'.format(uuid.uuid4())
+
+        land_ids_by_name = {
+            name: self.create_asset('land', {
+                "name": name,
+                "notes": {
+                    "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+                },
+                "intrinsic_geometry": {
+                    "value": wkt,
+                },
+                "land_type": "landmark",
+                "is_location": True,
+                "is_fixed": True,
+            }) for name, wkt in [
+                # Crosses the query envelope
+                (name_prefix + ' crossing', "LINESTRING(40 40.5, 42 40.5)"),
+                # Only the bounding box overlaps the query envelope
+                (name_prefix + ' diagonal', "LINESTRING(30 60, 50 40)"),
+            ]
+        }
+
+        def get_feature_ids(s, spatial_operation_xml):
+            filter_xml = '''<ogc:Filter xmlns:ogc="http://www.opengis.net/ogc" xmlns:gml="http://www.opengis.net/gml">
+   <ogc:And>
+      <ogc:PropertyIsLike wildCard="*" singleChar="." escapeChar="!">
+         <ogc:PropertyName>name</ogc:PropertyName>
+         <ogc:Literal>{name_prefix}*</ogc:Literal>
+      </ogc:PropertyIsLike>
+      {spatial_operation_xml}
+   </ogc:And>
+</ogc:Filter>'''.format(name_prefix=name_prefix, spatial_operation_xml=spatial_operation_xml)
+
+            response = s.get('http://www/wfs', params={
+                'SERVICE': 'WFS',
+                'VERSION': '1.1.0',
+                'REQUEST': 'GetFeature',
+                'TYPENAME': 'farmos:asset_land_linestring',
+                'FILTER': filter_xml,
+            })
+
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            return sorted(feature.find('./{*}__uuid').text
+                          for feature in root.findall("./{*}featureMember/{*}asset_land_linestring"))
+
+        envelope_xml = '''<gml:Envelope srsName="EPSG:4326">
+            <gml:lowerCorner>40 40</gml:lowerCorner>
+            <gml:upperCorner>41 41</gml:upperCorner>
+         </gml:Envelope>'''
+
+        with self.requests_session() as s:
+            self.assertEqual(get_feature_ids(s, '<ogc:BBOX><ogc:PropertyName>geometry</ogc:PropertyName>{}</ogc:BBOX>'.format(envelope_xml)),
+                             sorted(land_ids_by_name.values()))
+
+            self.assertEqual(get_feature_ids(s, '<ogc:Intersects><ogc:PropertyName>geometry</ogc:PropertyName>{}</ogc:Intersects>'.format(envelope_xml)),
+                             [land_ids_by_name[name_prefix + ' crossing']])
+
+            self.assertEqual(get_feature_ids(s, '<ogc:Within><ogc:PropertyName>geometry</ogc:PropertyName>{}</ogc:Within>'.format(envelope_xml)),
+                             [])
+
+            self.assertEqual(get_feature_ids(s, '''<ogc:DWithin>
+         <ogc:PropertyName>geometry</ogc:PropertyName>
+         <gml:Point srsName="EPSG:4326"><gml:pos srsDimension="2">41 39</gml:pos></gml:Point>
+         <ogc:Distance units="m">200000</ogc:Distance>
+      </ogc:DWithin>'''),
+                             [land_ids_by_name[name_prefix + ' crossing']])
+
+    def test_get_feature_only_serializes_requested_properties(self):
+        structure_id = self.create_asset('structure', {
+            "name": "Projected structure",
+            "notes": {
+                "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+            },
+            "intrinsic_geometry": {
+                "value": "POINT(9 18)",
+            },
+            "structure_type": "building",
+            "is_fixed": True,
+        })
+
+        get_feature_url = 'http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=GetFeature&TYPENAME=farmos:asset_structure_point'
+
+        with self.requests_session() as s:
+            response = s.get(get_feature_url + '&PROPERTYNAME=farmos:name,farmos:geometry')
+
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            features = [feature for feature in root.findall("./{*}featureMember/{*}asset_structure_point")
+                        if feature.attrib['{http://www.opengis.net/gml}id'] == 'asset_structure_point.{}'.format(structure_id)]
+
+            self.assertEqual(len(features), 1)
+            self.assertEqual(features[0].find('./{*}name').text, "Projected structure")
+            self.assertIsNotNone(features[0].find('./{*}geometry'))
+            self.assertIsNone(features[0].find('./{*}notes'))
+            self.assertIsNone(features[0].find('./{*}structure_type'))
+
+            response = s.get(get_feature_url + '&PROPERTYNAME=no_such_property')
+
+            self.assertEqual(response.status_code, 400)
+
+    def test_get_feature_sorts_results(self):
+        name_prefix = 'Sorted {}'.format(uuid.uuid4())
+
+        structure_ids_by_name = {
+            name: self.create_asset('structure', {
+                "name": name,
+                "notes": {
+                    "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+                },
+                "intrinsic_geometry": {
+                    "value": "POINT(11 22)",
+                },
+                "structure_type": "building",
+                "is_fixed": True,
+            }) for name in [name_prefix + ' b', name_prefix + ' c', name_prefix + ' a']
+        }
+
+        filter_xml = '''<ogc:Filter xmlns:ogc="http://www.opengis.net/ogc">
+   <ogc:PropertyIsLike wildCard="*" singleChar="." escapeChar="!">
+      <ogc:PropertyName>name</ogc:PropertyName>
+      <ogc:Literal>{name_prefix}*</ogc:Literal>
+   </ogc:PropertyIsLike>
+</ogc:Filter>'''.format(name_prefix=name_prefix)
+
+        def get_feature_names(s, sort_by, **params):
+            response = s.get('http://www/wfs', params=dict({
+                'SERVICE': 'WFS',
+                'VERSION': '1.1.0',
+                'REQUEST': 'GetFeature',
+                'TYPENAME': 'farmos:asset_structure_point',
+                'FILTER': filter_xml,
+                'SORTBY': sort_by,
+            }, **params))
+
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            return [feature.find('./{*}name').text
+                    for feature in root.findall("./{*}featureMember/{*}asset_structure_point")]
+
+        with self.requests_session() as s:
+            self.assertEqual(get_feature_names(s, 'farmos:name D'), sorted(structure_ids_by_name.keys(), reverse=True))
+
+            self.assertEqual(get_feature_names(s, 'name ASC', MAXFEATURES='2', STARTINDEX='1'),
+                             sorted(structure_ids_by_name.keys())[1:])
+
+            # Identical sort keys are broken by the asset id
+            self.assertEqual(get_feature_names(s, '__changed DESC,status'),
+                             get_feature_names(s, '__changed DESC,status'))
+
+            response = s.get('http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=GetFeature'
+                             '&TYPENAME=farmos:asset_structure_point&SORTBY=notes')
+
+            self.assertEqual(response.status_code, 400)
+
+    def test_get_feature_answers_multiple_queries_in_one_response(self):
+        name_prefix = 'Multi query {}'.format(uuid.uuid4())
+
+        point_structure_id = self.create_asset('structure', {
+            "name": name_prefix + " point",
+            "notes": {
+                "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+            },
+            "intrinsic_geometry": {
+                "value": "POINT(13 26)",
+            },
+            "structure_type": "building",
+            "is_fixed": True,
+        })
+
+        polygon_structure_id = self.create_asset('structure', {
+            "name": name_prefix + " polygon",
+            "notes": {
+                "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+            },
+            "intrinsic_geometry": {
+                "value": "POLYGON((13 26, 14 26, 14 27, 13 27, 13 26))",
+            },
+            "structure_type": "building",
+            "is_fixed": True,
+        })
+
+        filter_xml = '''<ogc:Filter xmlns:ogc="http://www.opengis.net/ogc">
+   <ogc:PropertyIsLike wildCard="*" singleChar="." escapeChar="!">
+      <ogc:PropertyName>name</ogc:PropertyName>
+      <ogc:Literal>{name_prefix}*</ogc:Literal>
+   </ogc:PropertyIsLike>
+</ogc:Filter>'''.format(name_prefix=name_prefix)
+
+        expected_feature_ids = [
+            'asset_structure_point.{}'.format(point_structure_id),
+            'asset_structure_polygon.{}'.format(polygon_structure_id),
+        ]
+
+        def feature_ids(response):
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            return [feature.attrib['{http://www.opengis.net/gml}id'] for feature in root.findall("./{*}featureMember/*")]
+
+        with self.requests_session() as s:
+            response = s.get('http://www/wfs', params={
+                'SERVICE': 'WFS',
+                'VERSION': '1.1.0',
+                'REQUEST': 'GetFeature',
+                'TYPENAME': 'farmos:asset_structure_point,farmos:asset_structure_polygon',
+                'FILTER': filter_xml,
+            })
+
+            self.assertEqual(feature_ids(response), expected_feature_ids)
+
+            response = s.get('http://www/wfs', params={
+                'SERVICE': 'WFS',
+                'VERSION': '1.1.0',
+                'REQUEST': 'GetFeature',
+                'TYPENAME': 'farmos:asset_structure_point,farmos:asset_structure_polygon',
+                'FILTER': filter_xml,
+                'MAXFEATURES': '1',
+                'STARTINDEX': '1',
+            })
+
+            self.assertEqual(feature_ids(response), expected_feature_ids[1:])
+
+            get_feature_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<wfs:GetFeature service="WFS" version="1.1.0" xmlns:wfs="http://www.opengis.net/wfs" xmlns:ogc="http://www.opengis.net/ogc" xmlns:farmos="https://farmos.org/wfs">
+  <wfs:Query typeName="farmos:asset_structure_point">
+    <wfs:PropertyName>farmos:name</wfs:PropertyName>
+    {filter_xml}
+  </wfs:Query>
+  <wfs:Query typeName="farmos:asset_structure_polygon">
+    {filter_xml}
+    <ogc:SortBy>
+      <ogc:SortProperty>
+        <ogc:PropertyName>name</ogc:PropertyName>
+        <ogc:SortOrder>DESC</ogc:SortOrder>
+      </ogc:SortProperty>
+    </ogc:SortBy>
+  </wfs:Query>
+</wfs:GetFeature>'''.format(filter_xml=filter_xml)
+
+            response = s.post('http://www/wfs?SERVICE=WFS', data=get_feature_xml, headers={'content-type': 'application/xml'})
+
+            self.assertEqual(feature_ids(response), expected_feature_ids)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            point_feature = root.find("./{*}featureMember/{*}asset_structure_point")
+
+            self.assertEqual(point_feature.find('./{*}name').text, name_prefix + " point")
+            self.assertIsNone(point_feature.find('./{*}notes'))
+
+            response = s.post('http://www/wfs?SERVICE=WFS',
+                              data=get_feature_xml.replace('farmos:asset_structure_polygon', 'farmos:no_such_type'),
+                              headers={'content-type': 'application/xml'})
+
+            self.assertEqual(response.status_code, 400)
+
+    def test_get_feature_supports_geojson_output(self):
+        structure_id = self.create_asset('structure', {
+            "name": "GeoJSON structure",
+            "notes": {
+                "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+            },
+            "intrinsic_geometry": {
+                "value": "POLYGON((15 30, 16 30, 16 31, 15 31, 15 30))",
+            },
+            "structure_type": "building",
+            "is_fixed": True,
+        })
+
+        get_feature_url = 'http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=GetFeature&TYPENAME=farmos:asset_structure_polygon'
+
+        with self.requests_session() as s:
+            response = s.get(get_feature_url + '&OUTPUTFORMAT=application/json')
+
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.headers['content-type'].startswith('application/json'))
+
+            feature_collection = response.json()
+
+            self.assertEqual(feature_collection['type'], 'FeatureCollection')
+            self.assertEqual(feature_collection['numberOfFeatures'], len(feature_collection['features']))
+
+            features = [feature for feature in feature_collection['features']
+                        if feature['id'] == 'asset_structure_polygon.{}'.format(structure_id)]
+
+            self.assertEqual(len(features), 1)
+            self.assertEqual(features[0]['geometry'], {
+                'type': 'Polygon',
+                'coordinates': [[[15.0, 30.0], [16.0, 30.0], [16.0, 31.0], [15.0, 31.0], [15.0, 30.0]]],
+            })
+            self.assertEqual(features[0]['bbox'], [15.0, 30.0, 16.0, 31.0])
+            self.assertEqual(features[0]['properties']['name'], "GeoJSON structure")
+            self.assertEqual(features[0]['properties']['structure_type'], "building")
+            self.assertIs(features[0]['properties']['is_fixed'], True)
+
+            response = s.get(get_feature_url + '&OUTPUTFORMAT=application/json&RESULTTYPE=hits')
+
+            self.assertEqual(response.status_code, 200)
+            self.assertGreaterEqual(response.json()['numberOfFeatures'], 1)
+
+            response = s.get(get_feature_url + '&OUTPUTFORMAT=text/csv')
+
+            self.assertEqual(response.status_code, 400)
+
+    def test_get_feature_returns_changes_and_deletions_since_a_cursor(self):
+        def create_structure(name):
+            return self.create_asset('structure', {
+                "name": name,
+                "notes": {
+                    "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+                },
+                "intrinsic_geometry": {
+                    "value": "POINT(19 38)",
+                },
+                "structure_type": "building",
+                "is_fixed": True,
+            })
+
+        unchanged_structure_id = create_structure("Unchanged structure")
+        deleted_structure_id = create_structure("Deleted structure")
+
+        get_feature_url = 'http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=GetFeature&TYPENAME=farmos:asset_structure_point'
+
+        with self.requests_session() as s:
+            # Changes within the same second as the cursor are included so make sure the existing assets are older
+            time.sleep(1.5)
+
+            response = s.get(get_feature_url + '&RESULTTYPE=hits')
+
+            # The feature collection carries the cursor for the next incremental request
+            cursor = etree.fromstring(response.text.encode('utf8')).attrib['timeStamp']
+
+            self.assertRegex(cursor, r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z$')
+
+            created_structure_id = create_structure("Created structure")
+
+            delete_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<Transaction xmlns="http://www.opengis.net/wfs" xmlns:ogc="http://www.opengis.net/ogc" service="WFS" version="1.1.0">
+   <Delete typeName="farmos:asset_structure_point">
+      <ogc:Filter><ogc:FeatureId fid="asset_structure_point.{}"/></ogc:Filter>
+   </Delete>
+</Transaction>
+'''.format(deleted_structure_id)
+
+            response = s.post('http://www/wfs?SERVICE=WFS', data=delete_xml, headers={'content-type': 'application/xml'})
+
+            self.assertEqual(response.status_code, 200)
+
+            response = s.get(get_feature_url + '&CHANGEDSINCE={}'.format(cursor))
+
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            feature_ids = [feature.attrib['{http://www.opengis.net/gml}id']
+                           for feature in root.findall("./{*}featureMember/{*}asset_structure_point")]
+
+            self.assertIn('asset_structure_point.{}'.format(created_structure_id), feature_ids)
+            self.assertNotIn('asset_structure_point.{}'.format(unchanged_structure_id), feature_ids)
+
+            deleted_feature_ids = [feature_id.attrib['fid']
+                                   for feature_id in root.findall("./{*}deletedFeatures/{*}FeatureId")]
+
+            self.assertIn('asset_structure_point.{}'.format(deleted_structure_id), deleted_feature_ids)
+
+            response = s.get(get_feature_url + '&OUTPUTFORMAT=application/json&CHANGEDSINCE={}'.format(cursor))
+
+            self.assertIn('asset_structure_point.{}'.format(deleted_structure_id), response.json()['deletedFeatureIds'])
+            self.assertIn('timeStamp', response.json())
+
+            response = s.get(get_feature_url + '&CHANGEDSINCE=not-a-time')
+
+            self.assertEqual(response.status_code, 400)
+
+    def test_get_feature_simplifies_geometries(self):
+        # A slightly jagged trace with many more vertices than needed at a coarse scale
+        trace = ', '.join('{} {}'.format(21 + idx * 0.001, 42 + (idx % 2) * 0.00001) for idx in range(200))
+
+        structure_id = self.create_asset('structure', {
+            "name": "Traced structure",
+            "notes": {
+                "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+            },
+            "intrinsic_geometry": {
+                "value": "LINESTRING({})".format(trace),
+            },
+            "structure_type": "building",
+            "is_fixed": True,
+        })
+
+        get_feature_url = ('http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=GetFeature'
+                           '&TYPENAME=farmos:asset_structure_linestring')
+
+        def get_pos_list_length(s, params):
+            response = s.get(get_feature_url + params)
+
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            features = [feature for feature in root.findall("./{*}featureMember/{*}asset_structure_linestring")
+                        if feature.attrib['{http://www.opengis.net/gml}id'] == 'asset_structure_linestring.{}'.format(structure_id)]
+
+            self.assertEqual(len(features), 1)
+
+            return len(features[0].find('./{*}geometry/{*}LineString/{*}posList').text.split()) // 2
+
+        with self.requests_session() as s:
+            self.assertEqual(get_pos_list_length(s, ''), 200)
+
+            # Cached simplified geometries are served the same way
+            for _ in range(2):
+                self.assertEqual(get_pos_list_length(s, '&SIMPLIFY=0.001'), 2)
+
+            self.assertEqual(get_pos_list_length(s, '&SIMPLIFY=auto&BBOX=41,20,43,22'), 2)
+
+            response = s.get(get_feature_url + '&SIMPLIFY=auto')
+
+            self.assertEqual(response.status_code, 400)
+
+            # XML-POST requests derive 'auto' tolerances from the BBOX of each query's filter
+            def post_get_feature(*filter_xmls):
+                query_xmls = ['''<wfs:Query typeName="farmos:asset_structure_linestring">
+    {filter_xml}
+  </wfs:Query>'''.format(filter_xml=filter_xml) for filter_xml in filter_xmls]
+
+                return s.post('http://www/wfs?SERVICE=WFS', data='''<?xml version="1.0" encoding="UTF-8"?>
+<wfs:GetFeature service="WFS" version="1.1.0" simplify="auto" xmlns:wfs="http://www.opengis.net/wfs" xmlns:ogc="http://www.opengis.net/ogc" xmlns:gml="http://www.opengis.net/gml">
+  {query_xmls}
+</wfs:GetFeature>'''.format(query_xmls='\n  '.join(query_xmls)), headers={'content-type': 'application/xml'})
+
+            def bbox_filter_xml(lower_corner, upper_corner):
+                return '''<ogc:Filter>
+      <ogc:And>
+        <ogc:BBOX>
+          <ogc:PropertyName>geometry</ogc:PropertyName>
+          <gml:Envelope>
+            <gml:lowerCorner>{lower_corner}</gml:lowerCorner>
+            <gml:upperCorner>{upper_corner}</gml:upperCorner>
+          </gml:Envelope>
+        </ogc:BBOX>
+        <ogc:PropertyIsEqualTo>
+          <ogc:PropertyName>name</ogc:PropertyName>
+          <ogc:Literal>Traced structure</ogc:Literal>
+        </ogc:PropertyIsEqualTo>
+      </ogc:And>
+    </ogc:Filter>'''.format(lower_corner=lower_corner, upper_corner=upper_corner)
+
+            def pos_list_lengths(response):
+                self.assertEqual(response.status_code, 200)
+
+                return [len(pos_list.text.split()) // 2 for pos_list in etree.fromstring(response.text.encode('utf8')).findall(
+                    "./{*}featureMember/{*}asset_structure_linestring/{*}geometry/{*}LineString/{*}posList")]
+
+            self.assertEqual(pos_list_lengths(post_get_feature(bbox_filter_xml('41 20', '43 22'))), [2])
+
+            # The same asset is served at the tolerance of each query which matches it - a tiny bbox around one of its
+            # vertices keeps all of them
+            self.assertEqual(pos_list_lengths(post_get_feature(bbox_filter_xml('41 20', '43 22'),
+                                                               bbox_filter_xml('41.99999 20.99999', '42.00002 21.00002'))),
+                             [2, 200])
+
+            # GET requests without a BBOX parameter fall back to their filter the same way
+            response = s.get('http://www/wfs', params={
+                'SERVICE': 'WFS',
+                'VERSION': '1.1.0',
+                'REQUEST': 'GetFeature',
+                'TYPENAME': 'farmos:asset_structure_linestring',
+                'SIMPLIFY': 'auto',
+                'FILTER': bbox_filter_xml('41 20', '43 22').replace(
+                    '<ogc:Filter>',
+                    '<ogc:Filter xmlns:ogc="http://www.opengis.net/ogc" xmlns:gml="http://www.opengis.net/gml">'),
+            })
+
+            self.assertEqual(pos_list_lengths(response), [2])
+
+            response = post_get_feature('''<ogc:Filter>
+      <ogc:PropertyIsEqualTo>
+        <ogc:PropertyName>name</ogc:PropertyName>
+        <ogc:Literal>Traced structure</ogc:Literal>
+      </ogc:PropertyIsEqualTo>
+    </ogc:Filter>''')
+
+            self.assertEqual(response.status_code, 400)
+
+    def test_responses_carry_server_timing_metrics(self):
+        self.create_asset('structure', {
+            "name": "Timed structure",
+            "notes": {
+                "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+            },
+            "intrinsic_geometry": {
+                "value": "POINT(21 42)",
+            },
+            "structure_type": "building",
+            "is_fixed": True,
+        })
+
+        with self.requests_session() as s:
+            response = s.get('http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=GetFeature'
+                             '&TYPENAME=farmos:asset_structure_point')
+
+            self.assertEqual(response.status_code, 200)
+
+            metric_names = [metric.split(';')[0].strip() for metric in response.headers['Server-Timing'].split(',')]
+
+            for metric_name in ['total', 'db', 'resolve', 'etag', 'fetch']:
+                self.assertIn(metric_name, metric_names)
+
+            # The metrics of the whole request follow the streamed features
+            trailing_comment = etree.fromstring(response.text.encode('utf8')).getnext()
+
+            self.assertIsNotNone(trailing_comment)
+            self.assertIn('Server-Timing: total;dur=', trailing_comment.text)
+            self.assertIn('load;dur=', trailing_comment.text)
+
+            # Exception reports are serialized before being sent
+            response = s.get('http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=Unknown')
+
+            self.assertEqual(response.status_code, 400)
+
+            self.assertIn('serialize', response.headers['Server-Timing'])
+
+    def test_get_feature_follows_movement_logs_of_mobile_assets(self):
+        structure_id = self.create_asset('structure', {
+            "name": "Moved structure",
+            "notes": {
+                "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+            },
+            "structure_type": "building",
+            "is_fixed": False,
+        })
+
+        def move_structure(lon, lat, timestamp):
+            return self.create_entity('log', 'activity', {
+                "name": "Move structure",
+                "status": "done",
+                "timestamp": timestamp,
+                "is_movement": True,
+                "geometry": {
+                    "value": "POINT({} {})".format(lon, lat),
+                },
+            }, relationships={
+                "asset": {
+                    "data": [{
+                        "type": "asset--structure",
+                        "id": structure_id,
+                    }],
+                },
+            })
+
+        def get_structure_geometries(s):
+            response = s.get('http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=GetFeature'
+                             '&TYPENAME=farmos:asset_structure_point&OUTPUTFORMAT=application/json')
+
+            self.assertEqual(response.status_code, 200)
+
+            return [feature['geometry'] for feature in response.json()['features']
+                    if feature['id'] == 'asset_structure_point.{}'.format(structure_id)]
+
+        now = int(time.time())
+
+        with self.requests_session() as s:
+            # Mobile assets without movements have no location
+            self.assertEqual(get_structure_geometries(s), [])
+
+            move_structure(17, 33, now - 60)
+
+            self.assertEqual(get_structure_geometries(s), [{'type': 'Point', 'coordinates': [17.0, 33.0]}])
+
+            move_structure(18, 34, now - 30)
+
+            self.assertEqual(get_structure_geometries(s), [{'type': 'Point', 'coordinates': [18.0, 34.0]}])
+
+            # Movements in the future don't change the current location yet
+            move_structure(19, 35, now + 3600)
+
+            self.assertEqual(get_structure_geometries(s), [{'type': 'Point', 'coordinates': [18.0, 34.0]}])
+
+    def test_get_feature_returns_assets_whose_location_reverted_since_a_cursor(self):
+        structure_id = self.create_asset('structure', {
+            "name": "Reverted structure",
+            "notes": {
+                "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+            },
+            "structure_type": "building",
+            "is_fixed": False,
+        })
+
+        def move_structure(lon, lat, timestamp):
+            return self.create_entity('log', 'activity', {
+                "name": "Move structure",
+                "status": "done",
+                "timestamp": timestamp,
+                "is_movement": True,
+                "geometry": {
+                    "value": "POINT({} {})".format(lon, lat),
+                },
+            }, relationships={
+                "asset": {
+                    "data": [{
+                        "type": "asset--structure",
+                        "id": structure_id,
+                    }],
+                },
+            })
+
+        now = int(time.time())
+
+        move_structure(17, 33, now - 60)
+        latest_movement_log_id = move_structure(18, 34, now - 30)
+
+        get_feature_url = ('http://www/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=GetFeature'
+                           '&TYPENAME=farmos:asset_structure_point&OUTPUTFORMAT=application/json')
+
+        with self.requests_session() as s:
+            # Changes within the same second as the cursor are included so make sure the existing entities are older
+            time.sleep(1.5)
+
+            cursor = s.get(get_feature_url + '&RESULTTYPE=hits').json()['timeStamp']
+
+            # Neither the asset nor the movement log its location reverts to change
+            response = s.delete('http://www/api/log/activity/{}'.format(latest_movement_log_id))
+
+            response.raise_for_status()
+
+            response = s.get(get_feature_url + '&CHANGEDSINCE={}'.format(cursor))
+
+            self.assertEqual(response.status_code, 200)
+
+            self.assertEqual([feature['geometry'] for feature in response.json()['features']
+                              if feature['id'] == 'asset_structure_point.{}'.format(structure_id)],
+                             [{'type': 'Point', 'coordinates': [17.0, 33.0]}])
+
+    def test_transaction_rejects_updates_of_assets_deleted_earlier_in_the_transaction(self):
+        structure_id = self.create_asset('structure', {
+            "name": "Deleted then updated structure",
+            "notes": {
+                "value": "Sample description... [created by farmOS_wfs-qgis_tests]",
+            },
+            "intrinsic_geometry": {
+                "value": "POINT(22 43)",
+            },
+            "structure_type": "building",
+            "is_fixed": True,
+        })
+
+        transaction_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<Transaction xmlns="http://www.opengis.net/wfs" xmlns:ogc="http://www.opengis.net/ogc" service="WFS" version="1.1.0" releaseAction="{release_action}">
+   <Delete typeName="farmos:asset_structure_point">
+      <ogc:Filter><ogc:FeatureId fid="asset_structure_point.{structure_id}"/></ogc:Filter>
+   </Delete>
+   <Update typeName="farmos:asset_structure_point">
+      <Property>
+         <Name>name</Name>
+         <Value>Resurrected structure</Value>
+      </Property>
+      <ogc:Filter><ogc:FeatureId fid="asset_structure_point.{structure_id}"/></ogc:Filter>
+   </Update>
+</Transaction>
+'''
+
+        with self.requests_session() as s:
+            response = s.post('http://www/wfs?SERVICE=WFS',
+                              data=transaction_xml.format(release_action='ALL', structure_id=structure_id),
+                              headers={'content-type': 'application/xml'})
+
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            self.assertEqual(root.find("./{*}TransactionSummary/{*}totalDeleted").text, '0')
+            self.assertEqual(root.find("./{*}TransactionSummary/{*}totalUpdated").text, '0')
+            self.assertIn('deleted earlier in the transaction',
+                          root.find("./{*}TransactionResults/{*}Action/{*}Message").text)
+
+        self.assertEqual(self.get_asset_by_type_and_id('structure', structure_id)['attributes']['name'],
+                         "Deleted then updated structure")
+
+        with self.requests_session() as s:
+            response = s.post('http://www/wfs?SERVICE=WFS',
+                              data=transaction_xml.format(release_action='SOME', structure_id=structure_id),
+                              headers={'content-type': 'application/xml'})
+
+            self.assertEqual(response.status_code, 200)
+
+            root = etree.fromstring(response.text.encode('utf8'))
+
+            self.assertEqual(root.find("./{*}TransactionSummary/{*}totalDeleted").text, '1')
+            self.assertEqual(root.find("./{*}TransactionSummary/{*}totalUpdated").text, '0')
+
+        self.assert_asset_does_not_exist('structure', structure_id)
@@ -0,0 +1,56 @@
+<?php
+
+namespace Drupal\farmos_wfs\Commands;
+
+use Drupal\Core\Config\ConfigFactoryInterface;
+use Drupal\farmos_wfs\FarmWfsAssetLocationIndex;
+use Drush\Commands\DrushCommands;
+
+/**
+ * Drush commands for the farmOS WFS module.
+ */
+class FarmWfsCommands extends DrushCommands {
+
+  protected $assetLocationIndex;
+
+  protected $configFactory;
+
+  public function __construct(FarmWfsAssetLocationIndex $asset_location_index, ConfigFactoryInterface $config_factory) {
+    parent::__construct();
+    $this->assetLocationIndex = $asset_location_index;
+    $this->configFactory = $config_factory;
+  }
+
+  /**
+   * Rebuilds the asset location index and enables its use for WFS queries.
+   *
+   * @param array $options
+   *          The command options.
+   *
+   * @command farmos_wfs:rebuild-asset-location-index
+   * @option batch-size The number of assets to index at a time.
+   * @usage farmos_wfs:rebuild-asset-location-index
+   *   Rebuild the asset location index.
+   */
+  public function rebuildAssetLocationIndex(array $options = [
+    'batch-size' => 500
+  ]) {
+    $batch_size = (int) $options['batch-size'];
+
+    if ($batch_size < 1) {
+      throw new \InvalidArgumentException('The batch-size option must be a positive integer.');
+    }
+
+    // Enabling the setting first keeps the index maintained for assets and logs which change during the rebuild - the
+    // index is only read once the rebuild has cleared its needs rebuild flag
+    $this->configFactory->getEditable('farmos_wfs.settings')
+      ->set('use_asset_location_index', TRUE)
+      ->save();
+
+    $indexed_count = $this->assetLocationIndex->rebuild($batch_size);
+
+    $this->logger()->success(dt('Indexed the locations of @count assets.', [
+      '@count' => $indexed_count
+    ]));
+  }
+}
@@ -5,6 +5,7 @@ namespace Drupal\farmos_wfs\Controller;
 use Drupal\Core\Config\ConfigFactoryInterface;
 use Drupal\Core\Controller\ControllerBase;
 use Drupal\Core\Session\AccountProxyInterface;
+use Drupal\farmos_wfs\FarmWfsProfiler;
 use Drupal\farmos_wfs\Exception\FarmWfsException;
 use Drupal\farmos_wfs\Handler\FarmWfsDescribeFeatureTypeHandler;
 use Drupal\farmos_wfs\Handler\FarmWfsGetCapabilitiesHandler;
@@ -12,6 +13,7 @@ use Drupal\farmos_wfs\Handler\FarmWfsGetFeatureHandler;
 use Drupal\farmos_wfs\Handler\FarmWfsTransactionHandler;
 use Symfony\Component\HttpFoundation\RequestStack;
 use Symfony\Component\HttpFoundation\Response;
+use Symfony\Component\HttpFoundation\StreamedResponse;
 
 /**
  * Defines FarmWfsController class.
@@ -67,6 +69,13 @@ class FarmWfsController extends ControllerBase {
    */
   protected $transactionHandler;
 
+  /**
+   * The request profiler
+   *
+   * @var \Drupal\farmos_wfs\FarmWfsProfiler
+   */
+  protected $profiler;
+
   /**
    * Constructs a new FarmWfsController object.
    *
@@ -79,7 +88,7 @@ class FarmWfsController extends ControllerBase {
   public function __construct(RequestStack $request_stack, ConfigFactoryInterface $config_factory,
     AccountProxyInterface $currentUser, FarmWfsGetCapabilitiesHandler $getCapabilitiesHandler,
     FarmWfsDescribeFeatureTypeHandler $describeFeatureTypeHandler, FarmWfsGetFeatureHandler $getFeatureHandler,
-    FarmWfsTransactionHandler $transactionHandler) {
+    FarmWfsTransactionHandler $transactionHandler, FarmWfsProfiler $profiler) {
     $this->requestStack = $request_stack;
     $this->configFactory = $config_factory;
     $this->currentUser = $currentUser;
@@ -88,6 +97,7 @@ class FarmWfsController extends ControllerBase {
     $this->describeFeatureTypeHandler = $describeFeatureTypeHandler;
     $this->getFeatureHandler = $getFeatureHandler;
     $this->transactionHandler = $transactionHandler;
+    $this->profiler = $profiler;
   }
 
   /**
@@ -98,6 +108,8 @@ class FarmWfsController extends ControllerBase {
   public function content() {
     $status_code = 200;
 
+    $this->profiler->start_request();
+
     try {
       $response = $this->handle_request();
     } catch (FarmWfsException $e) {
@@ -106,7 +118,9 @@ class FarmWfsController extends ControllerBase {
     }
 
     if ($response instanceof \DOMDocument) {
-      $xml_response = $response->saveXML();
+      $xml_response = $this->profiler->measure('serialize', function () use ($response) {
+        return $response->saveXML();
+      });
 
       $response = new Response();
       $response->setStatusCode($status_code);
@@ -114,6 +128,16 @@ class FarmWfsController extends ControllerBase {
       $response->setContent($xml_response);
     }
 
+    if ($this->profiler->is_sending_server_timing()) {
+      $response->headers->set('Server-Timing', $this->profiler->get_server_timing_header());
+    }
+
+    // Streamed responses finish the request once their body has been written
+    if (! $response instanceof StreamedResponse) {
+      $this->profiler->count('bytes_out', strlen($response->getContent()));
+      $this->profiler->finish_request();
+    }
+
     return $response;
   }
 
@@ -146,11 +170,16 @@ class FarmWfsController extends ControllerBase {
 
     $requested_operation = $query_params['REQUEST'] ?? null;
 
+    $this->profiler->set_operation($requested_operation ?? 'unknown');
+
     $requested_operation_handler = $request_handlers[$requested_operation] ?? null;
 
     $request_method = $current_request->getMethod();
 
-    if ($requested_operation_handler) {
+    // GetFeature requests may also be encoded as XML in the body of a POST request
+    $is_post_get_feature = $requested_operation == "GetFeature" && $request_method == "POST";
+
+    if ($requested_operation_handler && ! $is_post_get_feature) {
       if ($request_method != "GET") {
 
         throw new FarmWfsException(
@@ -168,18 +197,6 @@ class FarmWfsController extends ControllerBase {
     }
 
     if ($requested_operation == "Transaction" || $request_method == "POST") {
-      if (! $this->currentUser->hasPermission('Administer assets')) {
-
-        throw new FarmWfsException(
-          farmos_wfs_makeExceptionReport(
-            function ($eReport, $elem) {
-              $eReport->appendChild(
-                $elem('Exception', array(
-                  "exceptionCode" => "AccessDenied"
-                ), $elem('ExceptionText', [], "Access denied")));
-            }), 401);
-      }
-
       $request_body = file_get_contents('php://input');
 
       if (empty($request_body)) {
@@ -190,12 +207,14 @@ class FarmWfsController extends ControllerBase {
                 $elem('Exception', array(
                   "exceptionCode" => "MissingParameterValue",
                   "locator" => "body"
-                ), $elem('ExceptionText', [], "Missing transaction request body")));
+                ), $elem('ExceptionText', [], "Missing request body")));
             }), 400);
       }
 
       try {
-        $doc = farmos_wfs_loadXml($request_body);
+        $doc = $this->profiler->measure('parse', function () use ($request_body) {
+          return farmos_wfs_loadXml($request_body);
+        });
       } catch (\Exception $e) {
         throw new FarmWfsException(
           farmos_wfs_makeExceptionReport(
@@ -204,10 +223,29 @@ class FarmWfsController extends ControllerBase {
                 $elem('Exception', array(
                   "exceptionCode" => "InvalidParameterValue",
                   "locator" => "body"
-                ), $elem('ExceptionText', [], "Invalid transaction request body: {$e->getMessage()}")));
+                ), $elem('ExceptionText', [], "Invalid request body: {$e->getMessage()}")));
             }), 400);
       }
 
+      // Reading features doesn't need any more permissions than the GET encoded GetFeature requests do
+      if ($doc->documentElement && $doc->documentElement->localName == "GetFeature") {
+        $this->profiler->set_operation('GetFeature');
+
+        return $this->getFeatureHandler->handle_post($query_params, $doc->documentElement);
+      }
+
+      if (! $this->currentUser->hasPermission('Administer assets')) {
+
+        throw new FarmWfsException(
+          farmos_wfs_makeExceptionReport(
+            function ($eReport, $elem) {
+              $eReport->appendChild(
+                $elem('Exception', array(
+                  "exceptionCode" => "AccessDenied"
+                ), $elem('ExceptionText', [], "Access denied")));
+            }), 401);
+      }
+
       if (! $doc->firstChild || $doc->firstChild->nodeName != "Transaction") {
 
         throw new FarmWfsException(
@@ -215,10 +253,13 @@ class FarmWfsController extends ControllerBase {
             function ($eReport, $elem) {
               $eReport->appendChild(
                 $elem('Exception', [],
-                  $elem('ExceptionText', [], "Could not understand request body: root element must be a Transaction")));
+                  $elem('ExceptionText', [],
+                    "Could not understand request body: root element must be a Transaction or GetFeature")));
             }), 400);
       }
 
+      $this->profiler->set_operation('Transaction');
+
       return $this->transactionHandler->handle($query_params, $doc->firstChild);
     }
 
@@ -0,0 +1,212 @@
+<?php
+
+namespace Drupal\farmos_wfs;
+
+use Drupal\Component\Datetime\TimeInterface;
+use Drupal\Core\Database\Connection;
+use Drupal\Core\Entity\EntityTypeManagerInterface;
+use Drupal\Core\State\StateInterface;
+
+/**
+ * Maintains the materialized current location (geometry type and bounding box) of each asset.
+ *
+ * Computing the current location of mobile assets requires finding their latest movement log - a window query over all
+ * movement logs which dominates the cost of WFS queries for large farms. When enabled via the use_asset_location_index
+ * setting, FarmWfsQueryFactory reads the locations from this index instead. The index is kept up to date by the asset
+ * and log entity hooks, by cron for movement logs which become effective after being saved, and can be fully rebuilt
+ * with the farmos_wfs:rebuild-asset-location-index Drush command.
+ *
+ * Assets or logs which change while the setting is off leave the index stale, so it is flagged as needing a rebuild
+ * and isn't read again until it has been rebuilt.
+ */
+class FarmWfsAssetLocationIndex {
+
+  protected $connection;
+
+  protected $entityTypeManager;
+
+  protected $queryFactory;
+
+  protected $state;
+
+  protected $time;
+
+  public function __construct(Connection $connection, EntityTypeManagerInterface $entity_type_manager,
+    FarmWfsQueryFactory $query_factory, StateInterface $state, TimeInterface $time) {
+    $this->connection = $connection;
+    $this->entityTypeManager = $entity_type_manager;
+    $this->queryFactory = $query_factory;
+    $this->state = $state;
+    $this->time = $time;
+  }
+
+  /**
+   * Whether the index is kept up to date as assets and logs change - i.e. the use_asset_location_index setting is on.
+   */
+  function is_enabled() {
+    return $this->queryFactory->is_asset_location_index_maintained();
+  }
+
+  function needs_rebuild() {
+    return (bool) $this->state->get('farmos_wfs.asset_location_index_needs_rebuild', TRUE);
+  }
+
+  /**
+   * Flags the index as stale until the next rebuild.
+   */
+  function mark_needs_rebuild() {
+    if (! $this->needs_rebuild()) {
+      $this->state->set('farmos_wfs.asset_location_index_needs_rebuild', TRUE);
+    }
+  }
+
+  /**
+   * Recomputes the index entries of the given assets.
+   */
+  function update_assets(array $asset_ids) {
+    $asset_ids = array_values(array_unique(array_filter($asset_ids)));
+
+    if (empty($asset_ids)) {
+      return;
+    }
+
+    $transaction = $this->connection->startTransaction();
+
+    try {
+      $this->delete_assets($asset_ids);
+      $this->insert_assets($asset_ids);
+    } catch (\Exception $e) {
+      $transaction->rollBack();
+      throw $e;
+    }
+  }
+
+  /**
+   * Removes the index entries of the given assets.
+   */
+  function delete_assets(array $asset_ids) {
+    if (empty($asset_ids)) {
+      return;
+    }
+
+    $this->connection->delete(FARMOS_WFS_ASSET_LOCATION_INDEX_TABLE)
+      ->condition('asset_id', $asset_ids, 'IN')
+      ->execute();
+  }
+
+  /**
+   * Recomputes the index entries of the assets whose latest movement became effective since the last call.
+   *
+   * Movement logs with a future timestamp do not change the location of their assets when they are saved, so the
+   * affected index entries are refreshed once their timestamp has passed.
+   */
+  function update_assets_with_newly_effective_movements() {
+    $last_refreshed = $this->state->get('farmos_wfs.asset_location_index_last_refreshed', 0);
+    $now = $this->time->getRequestTime();
+
+    $log_storage = $this->entityTypeManager->getStorage('log');
+
+    $query = $this->connection->select($log_storage->getDataTable(), 'log_field_data');
+    $query->join($log_storage->getTableMapping()->getFieldTableName('asset'), 'log_asset',
+      'log_field_data.id = log_asset.entity_id');
+    $query->addField('log_asset', 'asset_target_id');
+    $query->condition('log_field_data.is_movement', 1)
+      ->condition('log_field_data.status', 'done')
+      ->condition('log_field_data.timestamp', $last_refreshed, '>')
+      ->condition('log_field_data.timestamp', $now, '<=')
+      ->condition('log_asset.deleted', 0)
+      ->distinct();
+
+    foreach (array_chunk($query->execute()->fetchCol(0), 500) as $asset_ids) {
+      $this->update_assets($asset_ids);
+    }
+
+    $this->state->set('farmos_wfs.asset_location_index_last_refreshed', $now);
+  }
+
+  /**
+   * Rebuilds the whole index.
+   *
+   * @return int The number of assets which were indexed.
+   */
+  function rebuild(int $batch_size = 500) {
+    $transaction = $this->connection->startTransaction();
+
+    try {
+      $this->connection->delete(FARMOS_WFS_ASSET_LOCATION_INDEX_TABLE)->execute();
+
+      // Assets are listed after clearing the index so that assets created concurrently are either listed here or keep
+      // the entries which the entity hooks wrote for them
+      $asset_ids = $this->connection->select($this->entityTypeManager->getStorage('asset')->getBaseTable(), 'asset')
+        ->fields('asset', [
+        'id'
+      ])
+        ->orderBy('id')
+        ->execute()
+        ->fetchCol(0);
+
+      foreach (array_chunk($asset_ids, $batch_size) as $asset_ids_batch) {
+        $this->insert_assets($asset_ids_batch);
+      }
+    } catch (\Exception $e) {
+      $transaction->rollBack();
+      throw $e;
+    }
+
+    // Commits the rebuilt index before it may be read
+    unset($transaction);
+
+    $this->state->set('farmos_wfs.asset_location_index_last_refreshed', $this->time->getRequestTime());
+    $this->state->set('farmos_wfs.asset_location_index_needs_rebuild', FALSE);
+
+    return $this->connection->select(FARMOS_WFS_ASSET_LOCATION_INDEX_TABLE, 'asset_location')
+      ->countQuery()
+      ->execute()
+      ->fetchField();
+  }
+
+  private function insert_assets(array $asset_ids) {
+    $location_query = $this->queryFactory->create_computed_query(null, FARMOS_WFS_RECOGNIZED_GEOMETRY_TYPES,
+      $asset_ids);
+
+    $location_query->addField('asset', 'type', 'asset_type');
+
+    $this->queryFactory->add_geometry_fields($location_query);
+
+    $rows = $location_query->execute()->fetchAll();
+
+    if (empty($rows)) {
+      return;
+    }
+
+    $insert = $this->connection->insert(FARMOS_WFS_ASSET_LOCATION_INDEX_TABLE)->fields(
+      [
+        'asset_id',
+        'asset_type',
+        'is_fixed',
+        'movement_log_id',
+        'geometry_geo_type',
+        'geometry_top',
+        'geometry_right',
+        'geometry_bottom',
+        'geometry_left'
+      ]);
+
+    foreach ($rows as $row) {
+      $insert->values(
+        [
+          'asset_id' => $row->asset_id,
+          'asset_type' => $row->asset_type,
+          'is_fixed' => (int) $row->is_fixed,
+          'movement_log_id' => $row->movement_log_id,
+          'geometry_geo_type' => $row->geometry_geo_type,
+          'geometry_top' => $row->geometry_top,
+          'geometry_right' => $row->geometry_right,
+          'geometry_bottom' => $row->geometry_bottom,
+          'geometry_left' => $row->geometry_left
+        ]);
+    }
+
+    $insert->execute();
+  }
+}
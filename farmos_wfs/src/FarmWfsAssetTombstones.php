@@ -0,0 +1,117 @@
+<?php
+
+namespace Drupal\farmos_wfs;
+
+use Drupal\Component\Datetime\TimeInterface;
+use Drupal\Core\Config\ConfigFactoryInterface;
+use Drupal\Core\Database\Connection;
+use Drupal\Core\State\StateInterface;
+
+/**
+ * Records the deletion of assets so incremental GetFeature requests can report which features were deleted.
+ *
+ * A tombstone is recorded by the asset delete hook and kept for the number of seconds configured by the
+ * asset_tombstone_max_age setting before cron prunes it. Incremental requests can only be answered for cursors which
+ * are no older than the retained tombstones - see get_earliest_cursor.
+ *
+ * Likewise the log hooks record when the location of an asset changed because one of its movement logs was saved or
+ * deleted, which a reverted location otherwise leaves no trace of.
+ */
+class FarmWfsAssetTombstones {
+
+  protected $connection;
+
+  protected $configFactory;
+
+  protected $state;
+
+  protected $time;
+
+  public function __construct(Connection $connection, ConfigFactoryInterface $config_factory, StateInterface $state,
+    TimeInterface $time) {
+    $this->connection = $connection;
+    $this->configFactory = $config_factory;
+    $this->state = $state;
+    $this->time = $time;
+  }
+
+  /**
+   * Records tombstones for the given assets.
+   */
+  function record_deleted_assets(array $assets) {
+    $now = $this->time->getRequestTime();
+
+    foreach ($assets as $asset) {
+      $this->connection->merge(FARMOS_WFS_ASSET_TOMBSTONE_TABLE)
+        ->key('asset_id', $asset->id())
+        ->fields([
+        'asset_uuid' => $asset->uuid(),
+        'asset_type' => $asset->bundle(),
+        'deleted' => $now
+      ])
+        ->execute();
+    }
+  }
+
+  /**
+   * Records that the location of the given assets changed.
+   */
+  function record_location_changes(array $asset_ids) {
+    $now = $this->time->getRequestTime();
+
+    foreach (array_unique($asset_ids) as $asset_id) {
+      $this->connection->merge(FARMOS_WFS_ASSET_LOCATION_CHANGE_TABLE)
+        ->key('asset_id', $asset_id)
+        ->fields([
+        'changed' => $now
+      ])
+        ->execute();
+    }
+  }
+
+  /**
+   * Loads the uuids of the assets of a given type which were deleted at or after a given time.
+   */
+  function load_deleted_asset_uuids(string $asset_type, int $since) {
+    return $this->connection->select(FARMOS_WFS_ASSET_TOMBSTONE_TABLE, 'asset_tombstone')
+      ->fields('asset_tombstone', [
+      'asset_uuid'
+    ])
+      ->condition('asset_tombstone.asset_type', $asset_type)
+      ->condition('asset_tombstone.deleted', $since, '>=')
+      ->orderBy('asset_tombstone.deleted')
+      ->orderBy('asset_tombstone.asset_id')
+      ->execute()
+      ->fetchCol(0);
+  }
+
+  /**
+   * Gets the earliest cursor for which all deletions since are still known.
+   *
+   * That is the later of when tombstones started being recorded and the age of the oldest retained tombstone.
+   */
+  function get_earliest_cursor() {
+    $recorded_since = $this->state->get('farmos_wfs.asset_tombstones_recorded_since', $this->time->getRequestTime());
+
+    return max($recorded_since, $this->time->getRequestTime() - $this->get_max_age());
+  }
+
+  /**
+   * Removes the tombstones and location changes which are older than the asset_tombstone_max_age setting.
+   */
+  function prune() {
+    $oldest_retained = $this->time->getRequestTime() - $this->get_max_age();
+
+    $this->connection->delete(FARMOS_WFS_ASSET_TOMBSTONE_TABLE)
+      ->condition('deleted', $oldest_retained, '<')
+      ->execute();
+
+    $this->connection->delete(FARMOS_WFS_ASSET_LOCATION_CHANGE_TABLE)
+      ->condition('changed', $oldest_retained, '<')
+      ->execute();
+  }
+
+  private function get_max_age() {
+    return max(0, (int) $this->configFactory->get('farmos_wfs.settings')->get('asset_tombstone_max_age'));
+  }
+}
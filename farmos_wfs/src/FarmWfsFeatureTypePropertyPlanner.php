@@ -0,0 +1,120 @@
+<?php
+
+namespace Drupal\farmos_wfs;
+
+use Drupal\Core\Cache\CacheBackendInterface;
+use Drupal\Core\Entity\EntityFieldManagerInterface;
+
+const FARMOS_WFS_SUPPORTED_FIELD_TYPES_TO_SCHEMA_TYPES = [
+  'string' => 'string',
+  'text_long' => 'string',
+  'timestamp' => 'dateTime',
+  'boolean' => 'boolean',
+  'uuid' => 'string',
+  'list_string' => 'string',
+  'string_long' => 'string',
+  'integer' => 'integer',
+  'state' => 'string'
+];
+
+/**
+ * Compiles the ordered list of feature properties served for each asset type.
+ *
+ * Both DescribeFeatureType and GetFeature use the same plan so the schema and the data cannot drift apart. Plans are
+ * built once per request and cached across requests until the entity field definitions change.
+ */
+class FarmWfsFeatureTypePropertyPlanner {
+
+  protected $entityFieldManager;
+
+  protected $cache;
+
+  protected $propertyPlansByAssetType = [];
+
+  public function __construct(EntityFieldManagerInterface $entity_field_manager, CacheBackendInterface $cache) {
+    $this->entityFieldManager = $entity_field_manager;
+    $this->cache = $cache;
+  }
+
+  /**
+   * Gets the property plan for a given asset type.
+   *
+   * @return array An ordered list of properties with the keys; field_id, property_name, element_name, field_type,
+   *         schema_type, is_taxonomy_term_ref, is_required, cardinality, and formatter - a callable which converts a raw
+   *         field item value to its serialized string form.
+   */
+  function get_property_plan(string $asset_type) {
+    if (isset($this->propertyPlansByAssetType[$asset_type])) {
+      return $this->propertyPlansByAssetType[$asset_type];
+    }
+
+    $cid = "farmos_wfs:property_plan:$asset_type";
+
+    $cached = $this->cache->get($cid);
+
+    if ($cached) {
+      $property_plan = $cached->data;
+    } else {
+      $property_plan = $this->build_property_plan($asset_type);
+
+      $this->cache->set($cid, $property_plan, CacheBackendInterface::CACHE_PERMANENT, [
+        'entity_field_info',
+        'entity_bundles'
+      ]);
+    }
+
+    $this->propertyPlansByAssetType[$asset_type] = $property_plan;
+
+    return $property_plan;
+  }
+
+  private function build_property_plan(string $asset_type) {
+    $field_definitions = $this->entityFieldManager->getFieldDefinitions('asset', $asset_type);
+
+    $property_plan = [];
+
+    foreach ($field_definitions as $field_id => $field_definition) {
+
+      $field_type = $field_definition->getType();
+
+      $is_taxonomy_term_ref = $field_type == "entity_reference" && $field_definition->getSetting('target_type') == "taxonomy_term";
+
+      if (! $is_taxonomy_term_ref && ! isset(FARMOS_WFS_SUPPORTED_FIELD_TYPES_TO_SCHEMA_TYPES[$field_type])) {
+        continue;
+      }
+
+      $property_name = $field_definition->isReadOnly() ? '__' . $field_id : $field_id;
+
+      $property_plan[] = [
+        'field_id' => $field_id,
+        'property_name' => $property_name,
+        'element_name' => 'farmos:' . $property_name,
+        'field_type' => $field_type,
+        'schema_type' => $is_taxonomy_term_ref ? 'string' : FARMOS_WFS_SUPPORTED_FIELD_TYPES_TO_SCHEMA_TYPES[$field_type],
+        'is_taxonomy_term_ref' => $is_taxonomy_term_ref,
+        'is_required' => $field_definition->isRequired(),
+        'cardinality' => $field_definition->getCardinality(),
+        // Static method callables so that the plan stays serializable for caching
+        'formatter' => $field_type == 'timestamp' ? [
+          static::class,
+          'format_timestamp'
+        ] : [
+          static::class,
+          'format_plain'
+        ]
+      ];
+    }
+
+    return $property_plan;
+  }
+
+  public static function format_plain($value) {
+    return (string) $value;
+  }
+
+  public static function format_timestamp($value) {
+    $datetime = new \DateTime("@{$value}");
+
+    return $datetime->format(\DateTime::ISO8601);
+  }
+}
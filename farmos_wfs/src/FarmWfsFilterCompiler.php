@@ -0,0 +1,590 @@
+<?php
+
+namespace Drupal\farmos_wfs;
+
+use Drupal\Core\Database\Connection;
+use Drupal\Core\Database\Query\SelectInterface;
+use Drupal\Core\Entity\EntityFieldManagerInterface;
+use Drupal\Core\Entity\EntityTypeManagerInterface;
+use Drupal\farmos_wfs\Exception\FarmWfsException;
+
+const FARMOS_WFS_FILTER_COMPARISON_OPERATORS = [
+  'PropertyIsEqualTo' => '=',
+  'PropertyIsNotEqualTo' => '<>',
+  'PropertyIsLessThan' => '<',
+  'PropertyIsGreaterThan' => '>',
+  'PropertyIsLessThanOrEqualTo' => '<=',
+  'PropertyIsGreaterThanOrEqualTo' => '>='
+];
+
+const FARMOS_WFS_FILTER_NEGATED_OPERATORS = [
+  '=' => '<>',
+  '<>' => '=',
+  '<' => '>=',
+  '>' => '<=',
+  '<=' => '>',
+  '>=' => '<',
+  'LIKE' => 'NOT LIKE',
+  'BETWEEN' => 'NOT BETWEEN'
+];
+
+/**
+ * Compiles OGC Filter 1.1 expressions into conditions on queries created by FarmWfsQueryFactory::create_query.
+ *
+ * Supports FeatureId/GmlObjectId, BBOX, Intersects, Within, DWithin, the comparison operators, PropertyIsLike,
+ * PropertyIsBetween, PropertyIsNull, and the And/Or/Not logical operators. Property predicates are evaluated against
+ * the asset field tables - multi-valued and bundle fields through EXISTS subqueries and taxonomy term references by
+ * term name. Negations are pushed down to the individual predicates so no NOT groups are needed.
+ *
+ * The exact spatial predicates (Intersects, Within, and DWithin) are compiled to bounding box conditions and attached
+ * to the query as 'farmos_wfs_spatial_predicates' metadata for the exact geometry tests.
+ */
+class FarmWfsFilterCompiler {
+
+  protected $connection;
+
+  protected $entityTypeManager;
+
+  protected $entityFieldManager;
+
+  protected $propertyPlanner;
+
+  protected $queryFactory;
+
+  public function __construct(Connection $connection, EntityTypeManagerInterface $entity_type_manager,
+    EntityFieldManagerInterface $entity_field_manager, FarmWfsFeatureTypePropertyPlanner $property_planner,
+    FarmWfsQueryFactory $query_factory) {
+    $this->connection = $connection;
+    $this->entityTypeManager = $entity_type_manager;
+    $this->entityFieldManager = $entity_field_manager;
+    $this->propertyPlanner = $property_planner;
+    $this->queryFactory = $query_factory;
+  }
+
+  /**
+   * Compiles an ogc:Filter element into a condition for a given query.
+   *
+   * @throws FarmWfsException If the filter is illegal or uses unsupported operations/properties.
+   */
+  function compile(SelectInterface $asset_query, string $asset_type, \DOMElement $filter_elem) {
+    $children = farmos_wfs_get_xnode_children_with_tag($filter_elem);
+
+    if (empty($children)) {
+      throw $this->filter_exception("Illegal filter expression. Cannot be empty.");
+    }
+
+    $distinct_child_names = array_values(array_unique(array_map(function ($e) {
+      return $e->localName;
+    }, $children)));
+
+    if (empty(array_diff($distinct_child_names, [
+      'FeatureId',
+      'GmlObjectId'
+    ]))) {
+      return $this->compile_feature_ids($asset_query, $children, FALSE);
+    }
+
+    if (count($children) > 1) {
+      $distinct_child_names_str = implode(', ', $distinct_child_names);
+      throw $this->filter_exception(
+        "Illegal filter expression. A filter must have a single root operation, but found: $distinct_child_names_str");
+    }
+
+    return $this->compile_operation($asset_query, $asset_type, $children[0], FALSE, TRUE);
+  }
+
+  /**
+   * Gets the bounding box the matches of an ogc:Filter element are restricted to by a BBOX, Intersects, Within, or
+   * DWithin operation at its root or only nested in And operations.
+   *
+   * @return array|null The bounding box as [min latitude, min longitude, max latitude, max longitude] or null if the
+   *         filter has no such operation.
+   *
+   * @throws FarmWfsException If the bounding operation is illegal.
+   */
+  function get_bbox(\DOMElement $filter_elem) {
+    $children = farmos_wfs_get_xnode_children_with_tag($filter_elem);
+
+    return count($children) == 1 ? $this->get_operation_bbox($children[0]) : null;
+  }
+
+  private function get_operation_bbox(\DOMElement $op_elem) {
+    switch ($op_elem->localName) {
+      case 'And':
+        foreach (farmos_wfs_get_xnode_children_with_tag($op_elem) as $operand_elem) {
+          $bbox = $this->get_operation_bbox($operand_elem);
+
+          if (isset($bbox)) {
+            return $bbox;
+          }
+        }
+
+        return null;
+
+      case 'BBOX':
+        return $this->parse_bbox_envelope($op_elem);
+
+      case 'Intersects':
+      case 'Within':
+      case 'DWithin':
+        return $this->parse_spatial_predicate($op_elem)->get_bbox();
+
+      default:
+        return null;
+    }
+  }
+
+  /**
+   * @param bool $negated
+   *          Whether the operation is (an odd number of times) negated.
+   * @param bool $conjunctive
+   *          Whether the operation must hold for the whole filter to match - i.e. it is only nested in And operations.
+   */
+  private function compile_operation(SelectInterface $asset_query, string $asset_type, \DOMElement $op_elem,
+    bool $negated, bool $conjunctive) {
+    $op_name = $op_elem->localName;
+
+    $operands = farmos_wfs_get_xnode_children_with_tag($op_elem);
+
+    switch ($op_name) {
+      case 'And':
+      case 'Or':
+        if (empty($operands)) {
+          throw $this->filter_exception("Illegal filter expression. $op_name must have at least one operand.");
+        }
+
+        // De Morgan's laws - NOT (a AND b) is (NOT a) OR (NOT b) and vice versa
+        $group = ($op_name == 'And') != $negated ? $asset_query->andConditionGroup() : $asset_query->orConditionGroup();
+
+        foreach ($operands as $operand_elem) {
+          $group->condition(
+            $this->compile_operation($asset_query, $asset_type, $operand_elem, $negated,
+              $conjunctive && $op_name == 'And' && ! $negated));
+        }
+
+        return $group;
+
+      case 'Not':
+        if (count($operands) != 1) {
+          throw $this->filter_exception("Illegal filter expression. Not must have exactly one operand.");
+        }
+
+        return $this->compile_operation($asset_query, $asset_type, $operands[0], ! $negated, FALSE);
+
+      case 'FeatureId':
+      case 'GmlObjectId':
+        return $this->compile_feature_ids($asset_query, [
+          $op_elem
+        ], $negated);
+
+      case 'BBOX':
+        return $this->queryFactory->create_bbox_condition($asset_query, $this->parse_bbox_envelope($op_elem), $negated);
+
+      case 'Intersects':
+      case 'Within':
+      case 'DWithin':
+        // The exact geometry test happens after the query (see FarmWfsFilterQueryResolver) so it can only narrow down
+        // the results of the whole filter
+        if (! $conjunctive) {
+          throw $this->filter_exception(
+            "Unsupported filter expression. $op_name can only be combined with other operations using And.");
+        }
+
+        $spatial_predicate = $this->parse_spatial_predicate($op_elem);
+
+        $asset_query->addMetaData('farmos_wfs_spatial_predicates',
+          array_merge($asset_query->getMetaData('farmos_wfs_spatial_predicates') ?? [], [
+            $spatial_predicate
+          ]));
+
+        return $this->queryFactory->create_bbox_condition($asset_query, $spatial_predicate->get_bbox());
+
+      case 'PropertyIsLike':
+        list ($property_name_elem, $literal) = $this->property_name_and_literal($op_elem);
+
+        $pattern = $this->like_pattern($literal, $op_elem->getAttribute('wildCard') ?: '*',
+          $op_elem->getAttribute('singleChar') ?: '.',
+          $op_elem->getAttribute('escapeChar') ?: $op_elem->getAttribute('escape') ?: '!');
+
+        return $this->compile_property_predicate($asset_query, $asset_type, $property_name_elem, $negated,
+          function ($condition, $field, $negated) use ($pattern) {
+            $condition->condition($field, $pattern, $negated ? 'NOT LIKE' : 'LIKE');
+          }, FALSE);
+
+      case 'PropertyIsBetween':
+        $property_name_elem = farmos_wfs_get_xnode_children_with_tag($op_elem, 'PropertyName')[0] ?? null;
+        $lower_literal_elem = farmos_wfs_get_xnode_children_with_tag(
+          farmos_wfs_get_xnode_children_with_tag($op_elem, 'LowerBoundary')[0] ?? null, 'Literal')[0] ?? null;
+        $upper_literal_elem = farmos_wfs_get_xnode_children_with_tag(
+          farmos_wfs_get_xnode_children_with_tag($op_elem, 'UpperBoundary')[0] ?? null, 'Literal')[0] ?? null;
+
+        if (! $property_name_elem || ! $lower_literal_elem || ! $upper_literal_elem) {
+          throw $this->filter_exception(
+            "Illegal filter expression. PropertyIsBetween requires a PropertyName and literal LowerBoundary and UpperBoundary.");
+        }
+
+        return $this->compile_property_predicate($asset_query, $asset_type, $property_name_elem, $negated,
+          function ($condition, $field, $negated, $plan_entry) use ($lower_literal_elem, $upper_literal_elem) {
+            $condition->condition($field,
+              [
+                $this->literal_value($plan_entry, $lower_literal_elem->nodeValue),
+                $this->literal_value($plan_entry, $upper_literal_elem->nodeValue)
+              ], $negated ? 'NOT BETWEEN' : 'BETWEEN');
+          }, FALSE);
+
+      case 'PropertyIsNull':
+        $property_name_elem = farmos_wfs_get_xnode_children_with_tag($op_elem, 'PropertyName')[0] ?? null;
+
+        if (! $property_name_elem) {
+          throw $this->filter_exception("Illegal filter expression. PropertyIsNull requires a PropertyName.");
+        }
+
+        return $this->compile_property_predicate($asset_query, $asset_type, $property_name_elem, $negated,
+          function ($condition, $field, $negated) {
+            if ($negated) {
+              $condition->isNotNull($field);
+            } else {
+              $condition->isNull($field);
+            }
+          }, TRUE);
+    }
+
+    $operator = FARMOS_WFS_FILTER_COMPARISON_OPERATORS[$op_name] ?? null;
+
+    if (! $operator) {
+      throw $this->filter_exception("Unsupported filter operation: '$op_name'");
+    }
+
+    list ($property_name_elem, $literal) = $this->property_name_and_literal($op_elem);
+
+    return $this->compile_property_predicate($asset_query, $asset_type, $property_name_elem, $negated,
+      function ($condition, $field, $negated, $plan_entry) use ($operator, $literal) {
+        $condition->condition($field, $this->literal_value($plan_entry, $literal),
+          $negated ? FARMOS_WFS_FILTER_NEGATED_OPERATORS[$operator] : $operator);
+      }, FALSE);
+  }
+
+  private function compile_feature_ids(SelectInterface $asset_query, array $id_elems, bool $negated) {
+    $filter_raw_ids = array_map(function ($e) {
+      return $e->localName == 'FeatureId' ? $e->getAttribute('fid') : ($e->getAttribute('gml:id') ?: $e->getAttribute('id'));
+    }, $id_elems);
+
+    $filter_ids = array_map(function ($raw_id) {
+      return preg_replace('/^[^.]+\.(.*)$/', '$1', $raw_id);
+    }, $filter_raw_ids);
+
+    return $asset_query->andConditionGroup()->condition('asset.uuid', $filter_ids, $negated ? 'NOT IN' : 'IN');
+  }
+
+  /**
+   * Creates the condition for a predicate on an asset property.
+   *
+   * @param callable $add_predicate
+   *          Called as $add_predicate($condition, $field, $negated, $plan_entry) to add the predicate on the property's
+   *          column to a condition or query.
+   * @param bool $is_null_check
+   *          Whether the predicate checks for the absence of values - which for properties stored in their own table
+   *          means that no rows exist.
+   */
+  private function compile_property_predicate(SelectInterface $asset_query, string $asset_type,
+    ?\DOMElement $property_name_elem, bool $negated, callable $add_predicate, bool $is_null_check) {
+    if (! $property_name_elem) {
+      throw $this->filter_exception("Illegal filter expression. Property comparisons require a PropertyName.");
+    }
+
+    $plan_entry = $this->resolve_property($asset_type, $property_name_elem->nodeValue);
+
+    $asset_storage = $this->entityTypeManager->getStorage('asset');
+
+    $table_mapping = $asset_storage->getTableMapping();
+
+    $storage_definition = $this->entityFieldManager->getFieldStorageDefinitions('asset')[$plan_entry['field_id']] ?? null;
+
+    if (! $storage_definition) {
+      throw $this->filter_exception("Filtering on property '{$plan_entry['property_name']}' is not supported");
+    }
+
+    $table = $table_mapping->getFieldTableName($plan_entry['field_id']);
+
+    $column = $table_mapping->getFieldColumnName($storage_definition, $storage_definition->getMainPropertyName());
+
+    $group = $asset_query->andConditionGroup();
+
+    $shared_table_aliases = [
+      $asset_storage->getBaseTable() => 'asset',
+      $asset_storage->getDataTable() => 'asset_field_data'
+    ];
+
+    if (isset($shared_table_aliases[$table]) && ! $plan_entry['is_taxonomy_term_ref']) {
+      $add_predicate($group, "{$shared_table_aliases[$table]}.$column", $negated, $plan_entry);
+
+      return $group;
+    }
+
+    $subquery_alias = 'filter_' . $asset_query->nextPlaceholder();
+
+    if (isset($shared_table_aliases[$table])) {
+      // A taxonomy term reference stored in a shared table - match by the name of the referenced term
+      $value_query = $this->connection->select($this->entityTypeManager->getStorage('taxonomy_term')->getDataTable(),
+        $subquery_alias);
+      $value_query->where("$subquery_alias.tid = {$shared_table_aliases[$table]}.$column");
+      $field = "$subquery_alias.name";
+    } else {
+      $value_query = $this->connection->select($table, $subquery_alias);
+      $value_query->where("$subquery_alias.entity_id = asset.id");
+      $value_query->condition("$subquery_alias.deleted", 0);
+      $field = "$subquery_alias.$column";
+
+      if ($plan_entry['is_taxonomy_term_ref']) {
+        $value_query->join($this->entityTypeManager->getStorage('taxonomy_term')->getDataTable(), "{$subquery_alias}_term",
+          "{$subquery_alias}_term.tid = $field");
+        $field = "{$subquery_alias}_term.name";
+      }
+    }
+
+    $value_query->addExpression('1');
+
+    if ($is_null_check) {
+      // A property is null when it has no values at all
+      if ($negated) {
+        $group->exists($value_query);
+      } else {
+        $group->notExists($value_query);
+      }
+
+      return $group;
+    }
+
+    // Multi-valued properties match when any of their values match, so negated predicates match when none do
+    $add_predicate($value_query, $field, FALSE, $plan_entry);
+
+    if ($negated) {
+      $group->notExists($value_query);
+    } else {
+      $group->exists($value_query);
+    }
+
+    return $group;
+  }
+
+  private function resolve_property(string $asset_type, string $raw_property_name) {
+    // Strip namespace prefixes (e.g. 'farmos:name') and XPath style child steps (e.g. 'asset_land_point/name')
+    $property_name = preg_replace('/^.*[\/:]/', '', trim($raw_property_name));
+
+    foreach ($this->propertyPlanner->get_property_plan($asset_type) as $plan_entry) {
+      if ($plan_entry['property_name'] == $property_name || $plan_entry['field_id'] == $property_name) {
+        return $plan_entry;
+      }
+    }
+
+    throw $this->filter_exception("Unknown or unsupported filter property: '$property_name'");
+  }
+
+  private function property_name_and_literal(\DOMElement $op_elem) {
+    $property_name_elem = farmos_wfs_get_xnode_children_with_tag($op_elem, 'PropertyName')[0] ?? null;
+    $literal_elem = farmos_wfs_get_xnode_children_with_tag($op_elem, 'Literal')[0] ?? null;
+
+    if (! $property_name_elem || ! $literal_elem) {
+      throw $this->filter_exception("Illegal filter expression. {$op_elem->localName} requires a PropertyName and a Literal.");
+    }
+
+    return [
+      $property_name_elem,
+      $literal_elem->nodeValue
+    ];
+  }
+
+  /**
+   * Converts a literal to the value stored for the given property.
+   */
+  private function literal_value(array $plan_entry, string $literal) {
+    switch ($plan_entry['field_type']) {
+      case 'timestamp':
+        try {
+          return (new \DateTime($literal))->getTimestamp();
+        } catch (\Exception $e) {
+          throw $this->filter_exception("Illegal date/time literal '$literal' for property '{$plan_entry['property_name']}'");
+        }
+
+      case 'boolean':
+        $value = filter_var($literal, FILTER_VALIDATE_BOOLEAN, FILTER_NULL_ON_FAILURE);
+
+        if (! isset($value)) {
+          throw $this->filter_exception("Illegal boolean literal '$literal' for property '{$plan_entry['property_name']}'");
+        }
+
+        return (int) $value;
+
+      case 'integer':
+        if (! is_numeric($literal)) {
+          throw $this->filter_exception("Illegal integer literal '$literal' for property '{$plan_entry['property_name']}'");
+        }
+
+        return (int) $literal;
+
+      default:
+        return $literal;
+    }
+  }
+
+  /**
+   * Converts an OGC PropertyIsLike pattern into an SQL LIKE pattern.
+   */
+  private function like_pattern(string $literal, string $wild_card, string $single_char, string $escape_char) {
+    $pattern = '';
+
+    $chars = preg_split('//u', $literal, -1, PREG_SPLIT_NO_EMPTY);
+
+    for ($i = 0; $i < count($chars); $i ++) {
+      $char = $chars[$i];
+
+      if ($char == $escape_char && $i + 1 < count($chars)) {
+        $pattern .= $this->connection->escapeLike($chars[++ $i]);
+      } elseif ($char == $wild_card) {
+        $pattern .= '%';
+      } elseif ($char == $single_char) {
+        $pattern .= '_';
+      } else {
+        $pattern .= $this->connection->escapeLike($char);
+      }
+    }
+
+    return $pattern;
+  }
+
+  /**
+   * Parses the gml:Envelope (or GML 2 gml:Box) of a BBOX operation.
+   *
+   * @return array The bounding box as [min latitude, min longitude, max latitude, max longitude] - matching the order
+   *         of the BBOX parameter.
+   */
+  private function parse_bbox_envelope(\DOMElement $bbox_elem) {
+    $children_with_tag = 'farmos_wfs_get_xnode_children_with_tag';
+
+    $envelope_elem = $children_with_tag($bbox_elem, 'Envelope')[0] ?? null;
+    $box_elem = $children_with_tag($bbox_elem, 'Box')[0] ?? null;
+
+    if (! $envelope_elem && ! $box_elem) {
+      throw $this->filter_exception("Illegal filter expression. {$bbox_elem->localName} requires a gml:Envelope.");
+    }
+
+    if ($envelope_elem) {
+      $lower_corner = preg_split('/\s+/', trim($children_with_tag($envelope_elem, 'lowerCorner')[0]->nodeValue ?? ''));
+      $upper_corner = preg_split('/\s+/', trim($children_with_tag($envelope_elem, 'upperCorner')[0]->nodeValue ?? ''));
+    } elseif ($box_elem) {
+      $corners = preg_split('/\s+/', trim($children_with_tag($box_elem, 'coordinates')[0]->nodeValue ?? ''));
+      $lower_corner = explode(',', $corners[0] ?? '');
+      $upper_corner = explode(',', $corners[1] ?? '');
+    }
+
+    $bbox = array_merge(array_slice($lower_corner, 0, 2), array_slice($upper_corner, 0, 2));
+
+    if (count($bbox) != 4 || count(array_filter($bbox, 'is_numeric')) != 4) {
+      throw $this->filter_exception(
+        "Illegal filter expression. {$bbox_elem->localName} envelope must have two numeric corners.");
+    }
+
+    return array_map('floatval', $bbox);
+  }
+
+  /**
+   * Parses an Intersects, Within, or DWithin operation.
+   *
+   * The geometry operand may be a gml:Envelope - with the same axis order as BBOX - or a gml:Point, gml:LineString, or
+   * gml:Polygon with the same axis order as the feature geometries.
+   */
+  private function parse_spatial_predicate(\DOMElement $op_elem) {
+    $op_name = $op_elem->localName;
+
+    $geometry_elems = farmos_wfs_get_xnode_children_with_tag($op_elem,
+      function ($local_name) {
+        return ! in_array($local_name, [
+          'PropertyName',
+          'Distance'
+        ]);
+      });
+
+    if (count($geometry_elems) != 1) {
+      throw $this->filter_exception("Illegal filter expression. $op_name requires a single geometry operand.");
+    }
+
+    if (in_array($geometry_elems[0]->localName, [
+      'Envelope',
+      'Box'
+    ])) {
+      list ($min_y, $min_x, $max_y, $max_x) = $this->parse_bbox_envelope($op_elem);
+
+      $geometry = new \Polygon(
+        [
+          new \LineString(
+            [
+              new \Point($min_x, $min_y),
+              new \Point($max_x, $min_y),
+              new \Point($max_x, $max_y),
+              new \Point($min_x, $max_y),
+              new \Point($min_x, $min_y)
+            ])
+        ]);
+    } else {
+      try {
+        $geometry = farmos_wfs_gml_three_point_one_point_one_to_geophp($geometry_elems[0]);
+      } catch (\Exception $e) {
+        throw $this->filter_exception("Illegal filter expression. Could not parse $op_name geometry: {$e->getMessage()}");
+      }
+    }
+
+    if ($op_name != 'DWithin') {
+      return new FarmWfsSpatialPredicate($op_name, $geometry);
+    }
+
+    $distance_elem = farmos_wfs_get_xnode_children_with_tag($op_elem, 'Distance')[0] ?? null;
+
+    if (! $distance_elem || ! is_numeric(trim($distance_elem->nodeValue)) || trim($distance_elem->nodeValue) < 0) {
+      throw $this->filter_exception("Illegal filter expression. DWithin requires a non-negative Distance.");
+    }
+
+    $units = strtolower(trim($distance_elem->getAttribute('units')));
+
+    $meters_per_unit = [
+      'm' => 1,
+      'meter' => 1,
+      'meters' => 1,
+      'metre' => 1,
+      'metres' => 1,
+      'urn:ogc:def:uom:epsg::9001' => 1,
+      'km' => 1000,
+      'kilometer' => 1000,
+      'kilometers' => 1000,
+      'kilometre' => 1000,
+      'kilometres' => 1000
+    ][$units] ?? null;
+
+    if (isset($meters_per_unit)) {
+      return new FarmWfsSpatialPredicate($op_name, $geometry, trim($distance_elem->nodeValue) * $meters_per_unit, TRUE);
+    }
+
+    if (! in_array($units, [
+      '',
+      'deg',
+      'degree',
+      'degrees',
+      'urn:ogc:def:uom:epsg::9102'
+    ])) {
+      throw $this->filter_exception("Unsupported DWithin distance units: '$units'");
+    }
+
+    return new FarmWfsSpatialPredicate($op_name, $geometry, trim($distance_elem->nodeValue));
+  }
+
+  private function filter_exception(string $message) {
+    return new FarmWfsException(
+      farmos_wfs_makeExceptionReport(
+        function ($eReport, $elem) use ($message) {
+          $eReport->appendChild(
+            $elem('Exception', array(
+              "exceptionCode" => "InvalidParameterValue",
+              "locator" => "filter"
+            ), $elem('ExceptionText', [], $message)));
+        }), 400);
+  }
+}
@@ -0,0 +1,294 @@
+<?php
+
+namespace Drupal\farmos_wfs;
+
+use Drupal\Component\Datetime\TimeInterface;
+use Drupal\Core\Cache\CacheBackendInterface;
+
+/**
+ * Geometries with fewer vertices than this are simplified on the fly instead of being cached.
+ */
+const FARMOS_WFS_SIMPLIFICATION_CACHE_MIN_VERTICES = 64;
+
+/**
+ * How long in seconds simplified geometries stay cached - entries of geometries which have since changed are never read
+ * again so they are left to expire.
+ */
+const FARMOS_WFS_SIMPLIFICATION_CACHE_LIFETIME = 7 * 24 * 60 * 60;
+
+/**
+ * Simplifies WKT geometries for GetFeature responses using the Douglas-Peucker algorithm.
+ *
+ * Tolerances are rounded down to a power of two so that requests at similar scales share cached results. The cache is
+ * keyed by a hash of the WKT value itself, so editing an asset or its location naturally moves on to a new entry while
+ * unchanged geometries keep being served from the cache and the stale entries expire. Polygon rings are only simplified
+ * as far as they stay valid rings which do not cross each other.
+ */
+class FarmWfsGeometrySimplifier {
+
+  protected $cache;
+
+  protected $time;
+
+  public function __construct(CacheBackendInterface $cache, TimeInterface $time) {
+    $this->cache = $cache;
+    $this->time = $time;
+  }
+
+  /**
+   * Rounds a tolerance down to the power of two bucket it is simplified and cached with.
+   */
+  function bucket_tolerance(float $tolerance) {
+    return pow(2, floor(log($tolerance, 2)));
+  }
+
+  /**
+   * Simplifies a list of WKT geometry values with the given tolerance.
+   *
+   * @param array $wkt_values
+   *          The WKT geometry values - e.g. keyed by asset id.
+   * @param float $tolerance
+   *          The tolerance in degrees - see bucket_tolerance.
+   *
+   * @return array The simplified WKT geometry values with the same keys.
+   */
+  function simplify_wkt_values(array $wkt_values, float $tolerance) {
+    $tolerance = $this->bucket_tolerance($tolerance);
+
+    $cids = [];
+
+    foreach ($wkt_values as $key => $wkt) {
+      if (! empty($wkt) && substr_count($wkt, ',') + 1 >= FARMOS_WFS_SIMPLIFICATION_CACHE_MIN_VERTICES) {
+        $cids[$key] = "farmos_wfs:simplified_geometry:$tolerance:" . hash('sha256', $wkt);
+      }
+    }
+
+    $cid_list = array_values($cids);
+
+    $cached = empty($cid_list) ? [] : $this->cache->getMultiple($cid_list);
+
+    $simplified_wkt_values = [];
+    $new_cache_items = [];
+    $expire = $this->time->getRequestTime() + FARMOS_WFS_SIMPLIFICATION_CACHE_LIFETIME;
+
+    foreach ($wkt_values as $key => $wkt) {
+      if (empty($wkt)) {
+        $simplified_wkt_values[$key] = $wkt;
+        continue;
+      }
+
+      $cid = $cids[$key] ?? null;
+
+      if (isset($cid) && isset($cached[$cid])) {
+        $simplified_wkt_values[$key] = $cached[$cid]->data;
+        continue;
+      }
+
+      $simplified_wkt_values[$key] = simplify_wkt($wkt, $tolerance);
+
+      if (isset($cid)) {
+        $new_cache_items[$cid] = [
+          'data' => $simplified_wkt_values[$key],
+          'expire' => $expire
+        ];
+      }
+    }
+
+    if (! empty($new_cache_items)) {
+      $this->cache->setMultiple($new_cache_items);
+    }
+
+    return $simplified_wkt_values;
+  }
+}
+
+/**
+ * Simplifies a point, line string, or polygon WKT geometry - other geometries are returned as is.
+ */
+function simplify_wkt(string $wkt, float $tolerance) {
+  $matches = [];
+  if (! preg_match('/^\s*(?P<type>\w+)\s*\((?P<body>.*)\)\s*$/s', $wkt, $matches)) {
+    return $wkt;
+  }
+
+  switch (strtolower($matches['type'])) {
+    case 'linestring':
+      $coordinates = wkt_coordinates($matches['body']);
+
+      return 'LINESTRING (' . format_wkt_coordinates(douglas_peucker($coordinates, $tolerance)) . ')';
+
+    case 'polygon':
+      $rings = array_map('Drupal\farmos_wfs\wkt_coordinates',
+        preg_split('/\)\s*,\s*\(/', trim(trim($matches['body']), '()')));
+
+      $simplified_rings = simplify_rings($rings, $tolerance);
+
+      return 'POLYGON (' . implode(', ',
+        array_map(function ($ring) {
+          return '(' . format_wkt_coordinates($ring) . ')';
+        }, $simplified_rings)) . ')';
+
+    default:
+      return $wkt;
+  }
+}
+
+/**
+ * Simplifies the rings of a polygon without changing its topology.
+ *
+ * Rings which would collapse are kept as is. If any simplified rings cross themselves or each other, the simplification
+ * is retried with half the tolerance and eventually the original rings are returned.
+ */
+function simplify_rings(array $rings, float $tolerance) {
+  for ($attempt = 0; $attempt < 4; $attempt ++, $tolerance /= 2) {
+    $simplified_rings = array_map(function ($ring) use ($tolerance) {
+      $simplified_ring = douglas_peucker($ring, $tolerance);
+
+      return count($simplified_ring) >= 4 ? $simplified_ring : $ring;
+    }, $rings);
+
+    if (! rings_cross($simplified_rings)) {
+      return $simplified_rings;
+    }
+  }
+
+  return $rings;
+}
+
+/**
+ * Simplifies a sequence of coordinates keeping its end points and every vertex further than the tolerance from the
+ * simplified line.
+ */
+function douglas_peucker(array $coordinates, float $tolerance) {
+  $last_index = count($coordinates) - 1;
+
+  if ($last_index < 2) {
+    return $coordinates;
+  }
+
+  $keep = [
+    0 => TRUE,
+    $last_index => TRUE
+  ];
+
+  // An explicit stack of [start, end] index ranges avoids deep recursion for long traces
+  $ranges = [
+    [
+      0,
+      $last_index
+    ]
+  ];
+
+  while (! empty($ranges)) {
+    list ($start, $end) = array_pop($ranges);
+
+    $max_distance = 0;
+    $max_index = null;
+
+    for ($idx = $start + 1; $idx < $end; $idx ++) {
+      $distance = FarmWfsSegments::point_segment_distance($coordinates[$idx], [
+        $coordinates[$start],
+        $coordinates[$end]
+      ]);
+
+      if ($distance > $max_distance) {
+        $max_distance = $distance;
+        $max_index = $idx;
+      }
+    }
+
+    if (isset($max_index) && $max_distance > $tolerance) {
+      $keep[$max_index] = TRUE;
+      $ranges[] = [
+        $start,
+        $max_index
+      ];
+      $ranges[] = [
+        $max_index,
+        $end
+      ];
+    }
+  }
+
+  ksort($keep);
+
+  return array_values(array_intersect_key($coordinates, $keep));
+}
+
+/**
+ * Tests whether any two non-adjacent segments of the given rings cross.
+ *
+ * The segments are swept in the order of their minimum x so that each one is only tested against the following segments
+ * whose bounding boxes overlap its own.
+ */
+function rings_cross(array $rings) {
+  $segments = [];
+
+  foreach ($rings as $ring_idx => $ring) {
+    for ($idx = 0; $idx < count($ring) - 1; $idx ++) {
+      $segments[] = [
+        $ring_idx,
+        $idx,
+        count($ring) - 1,
+        [
+          $ring[$idx],
+          $ring[$idx + 1]
+        ],
+        min($ring[$idx][0], $ring[$idx + 1][0]),
+        max($ring[$idx][0], $ring[$idx + 1][0]),
+        min($ring[$idx][1], $ring[$idx + 1][1]),
+        max($ring[$idx][1], $ring[$idx + 1][1])
+      ];
+    }
+  }
+
+  usort($segments, function ($a, $b) {
+    return $a[4] <=> $b[4];
+  });
+
+  $segment_count = count($segments);
+
+  for ($a_idx = 0; $a_idx < $segment_count; $a_idx ++) {
+    list ($a_ring, $a_segment_idx, $a_segment_count, $a, , $a_max_x, $a_min_y, $a_max_y) = $segments[$a_idx];
+
+    for ($b_idx = $a_idx + 1; $b_idx < $segment_count && $segments[$b_idx][4] <= $a_max_x; $b_idx ++) {
+      list ($b_ring, $b_segment_idx, , $b, , , $b_min_y, $b_max_y) = $segments[$b_idx];
+
+      if ($b_min_y > $a_max_y || $b_max_y < $a_min_y) {
+        continue;
+      }
+
+      $is_adjacent = $a_ring == $b_ring && (abs($a_segment_idx - $b_segment_idx) == 1 ||
+        abs($a_segment_idx - $b_segment_idx) == $a_segment_count - 1);
+
+      if (! $is_adjacent && FarmWfsSegments::segments_cross($a, $b)) {
+        return TRUE;
+      }
+    }
+  }
+
+  return FALSE;
+}
+
+/**
+ * Parses a WKT coordinate sequence like "1 2, 3 4" into [x, y, text] triples.
+ *
+ * The original text of each coordinate is kept so simplified geometries don't lose any precision.
+ */
+function wkt_coordinates(string $coordinates) {
+  return array_map(function ($coordinate) {
+    $coordinate = trim($coordinate);
+
+    list ($x, $y) = preg_split('/\s+/', $coordinate);
+
+    return [
+      (float) $x,
+      (float) $y,
+      $coordinate
+    ];
+  }, explode(',', $coordinates));
+}
+
+function format_wkt_coordinates(array $coordinates) {
+  return implode(', ', array_column($coordinates, 2));
+}
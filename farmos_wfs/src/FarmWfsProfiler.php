@@ -0,0 +1,253 @@
+<?php
+
+namespace Drupal\farmos_wfs;
+
+use Drupal\Core\Config\ConfigFactoryInterface;
+use Drupal\Core\Database\Connection;
+use Drupal\Core\Database\Database;
+use Drupal\Core\Database\Event\StatementEvent;
+use Drupal\Core\Database\Event\StatementExecutionEndEvent;
+use Drupal\Core\Session\AccountProxyInterface;
+use Psr\Log\LoggerInterface;
+use Symfony\Component\EventDispatcher\EventSubscriberInterface;
+
+/**
+ * Records where the time of a WFS request goes.
+ *
+ * The controller starts and finishes each request while the handlers measure their phases (e.g. resolving the queried
+ * assets or loading entities) and count what they produce. The metrics are exposed as a Server-Timing header to users
+ * with the 'view farmos_wfs server timing' permission and logged - for every request with the log_request_metrics
+ * setting or in detail once a request takes longer than the slow_request_threshold setting.
+ *
+ * Database queries are only counted and timed for requests whose metrics are reported - i.e. when the Server-Timing
+ * header is sent or log_request_metrics is enabled - since that has a cost for every query. On Drupal 10.1+ they are
+ * tallied from statement execution events without keeping anything per query. Older versions fall back to the query
+ * log which is drained after each measured phase so it doesn't grow with the number of features.
+ */
+class FarmWfsProfiler implements EventSubscriberInterface {
+
+  const DATABASE_LOGGING_KEY = 'farmos_wfs_profiler';
+
+  protected $configFactory;
+
+  protected $logger;
+
+  protected $connection;
+
+  protected $currentUser;
+
+  protected $operation = 'unknown';
+
+  protected $startTime = null;
+
+  protected $phaseDurations = [];
+
+  protected $counters = [];
+
+  /**
+   * How database queries are tallied for the current request; 'events', 'log', or null if they aren't.
+   */
+  protected $dbQueryTallyMethod = null;
+
+  /**
+   * The statement events enabled for tallying the queries of the current request - events which were already enabled
+   * (e.g. by another profiler) are left alone.
+   */
+  protected $enabledStatementEvents = [];
+
+  protected $dbQueryCount = 0;
+
+  protected $dbQueryDuration = 0;
+
+  public function __construct(ConfigFactoryInterface $config_factory, LoggerInterface $logger, Connection $connection,
+    AccountProxyInterface $current_user) {
+    $this->configFactory = $config_factory;
+    $this->logger = $logger;
+    $this->connection = $connection;
+    $this->currentUser = $current_user;
+  }
+
+  public static function getSubscribedEvents() {
+    return [
+      StatementExecutionEndEvent::class => 'on_statement_execution_end'
+    ];
+  }
+
+  function on_statement_execution_end(StatementExecutionEndEvent $event) {
+    if ($this->dbQueryTallyMethod == 'events') {
+      $this->dbQueryCount ++;
+      $this->dbQueryDuration += $event->getElapsedTime();
+    }
+  }
+
+  function start_request() {
+    $this->operation = 'unknown';
+    $this->startTime = hrtime(TRUE);
+    $this->phaseDurations = [];
+    $this->counters = [];
+    $this->dbQueryCount = 0;
+    $this->dbQueryDuration = 0;
+    $this->dbQueryTallyMethod = null;
+
+    if (! $this->is_sending_server_timing() &&
+      ! $this->configFactory->get('farmos_wfs.settings')->get('log_request_metrics')) {
+      return;
+    }
+
+    if (class_exists(StatementEvent::class) && method_exists($this->connection, 'enableEvents')) {
+      $this->dbQueryTallyMethod = 'events';
+      $this->enabledStatementEvents = array_values(
+        array_filter(StatementEvent::all(), function ($event_name) {
+          return ! $this->connection->isEventEnabled($event_name);
+        }));
+
+      if (! empty($this->enabledStatementEvents)) {
+        $this->connection->enableEvents($this->enabledStatementEvents);
+      }
+    } else {
+      $this->dbQueryTallyMethod = 'log';
+      Database::startLog(static::DATABASE_LOGGING_KEY);
+    }
+  }
+
+  /**
+   * Whether the metrics of the current request are sent to the client - see get_server_timing_header.
+   */
+  function is_sending_server_timing() {
+    return $this->currentUser->hasPermission('view farmos_wfs server timing');
+  }
+
+  function set_operation(string $operation) {
+    $this->operation = $operation;
+  }
+
+  /**
+   * Invokes a callback and adds its duration to a phase - phases which are measured repeatedly accumulate.
+   *
+   * @return mixed The result of the callback.
+   */
+  function measure(string $phase, callable $callback) {
+    $start_time = hrtime(TRUE);
+
+    try {
+      return $callback();
+    } finally {
+      $this->phaseDurations[$phase] = ($this->phaseDurations[$phase] ?? 0) + (hrtime(TRUE) - $start_time) / 1e6;
+
+      $this->drain_query_log();
+    }
+  }
+
+  function count(string $counter, int $amount = 1) {
+    $this->counters[$counter] = ($this->counters[$counter] ?? 0) + $amount;
+  }
+
+  /**
+   * Gets the metrics recorded so far.
+   *
+   * @return array The metrics with the keys; operation, total_ms, phases_ms, db_queries, db_ms, peak_memory, and
+   *         counters. The db_queries and db_ms values are null if database queries aren't being tallied.
+   */
+  function get_metrics() {
+    $this->drain_query_log();
+
+    $is_tallying_db_queries = isset($this->dbQueryTallyMethod);
+
+    return [
+      'operation' => $this->operation,
+      'total_ms' => isset($this->startTime) ? (hrtime(TRUE) - $this->startTime) / 1e6 : 0,
+      'phases_ms' => $this->phaseDurations,
+      'db_queries' => $is_tallying_db_queries ? $this->dbQueryCount : null,
+      'db_ms' => $is_tallying_db_queries ? $this->dbQueryDuration * 1000 : null,
+      'peak_memory' => memory_get_peak_usage(TRUE),
+      'counters' => $this->counters
+    ];
+  }
+
+  /**
+   * Formats the metrics recorded so far as a Server-Timing header value.
+   */
+  function get_server_timing_header() {
+    $metrics = $this->get_metrics();
+
+    $entries = [
+      sprintf('total;dur=%.1f', $metrics['total_ms'])
+    ];
+
+    if (isset($metrics['db_queries'])) {
+      $entries[] = sprintf('db;desc="%d queries";dur=%.1f', $metrics['db_queries'], $metrics['db_ms']);
+    }
+
+    foreach ($metrics['phases_ms'] as $phase => $duration) {
+      $entries[] = sprintf('%s;dur=%.1f', $phase, $duration);
+    }
+
+    return implode(', ', $entries);
+  }
+
+  /**
+   * Logs the metrics of the request and stops recording them.
+   */
+  function finish_request() {
+    if (! isset($this->startTime)) {
+      return;
+    }
+
+    $metrics = $this->get_metrics();
+
+    $this->startTime = null;
+
+    if ($this->dbQueryTallyMethod == 'events') {
+      if (! empty($this->enabledStatementEvents)) {
+        $this->connection->disableEvents($this->enabledStatementEvents);
+      }
+
+      $this->enabledStatementEvents = [];
+    } elseif ($this->dbQueryTallyMethod == 'log') {
+      // Ends the query log
+      Database::getLog(static::DATABASE_LOGGING_KEY);
+    }
+
+    $this->dbQueryTallyMethod = null;
+
+    $settings = $this->configFactory->get('farmos_wfs.settings');
+
+    $slow_request_threshold = (int) $settings->get('slow_request_threshold');
+
+    $context = [
+      '@operation' => $metrics['operation'],
+      '@total_ms' => round($metrics['total_ms'], 1),
+      '@db_queries' => $metrics['db_queries'],
+      '@db_ms' => round($metrics['db_ms'] ?? 0, 1),
+      '@peak_memory' => $metrics['peak_memory'],
+      '@features' => $metrics['counters']['features'] ?? 0,
+      '@bytes_out' => $metrics['counters']['bytes_out'] ?? 0,
+      '@details' => json_encode($metrics)
+    ];
+
+    if ($slow_request_threshold > 0 && $metrics['total_ms'] >= $slow_request_threshold) {
+      $this->logger->warning('Slow @operation request took @total_ms ms: @details', $context);
+    } elseif ($settings->get('log_request_metrics')) {
+      $this->logger->info(
+        '@operation request took @total_ms ms with @db_queries queries (@db_ms ms), @features features, @bytes_out bytes out, and @peak_memory bytes peak memory',
+        $context);
+    }
+  }
+
+  /**
+   * Tallies and discards the queries in the query log so far - only used when statement events aren't available.
+   */
+  private function drain_query_log() {
+    if ($this->dbQueryTallyMethod != 'log') {
+      return;
+    }
+
+    // Reading the query log ends it so it is restarted to keep counting the queries of the rest of the request
+    $query_durations = array_column(Database::getLog(static::DATABASE_LOGGING_KEY), 'time');
+
+    Database::startLog(static::DATABASE_LOGGING_KEY);
+
+    $this->dbQueryCount += count($query_durations);
+    $this->dbQueryDuration += array_sum($query_durations);
+  }
+}
@@ -3,9 +3,12 @@
 namespace Drupal\farmos_wfs;
 
 use Drupal\Component\Datetime\TimeInterface;
+use Drupal\Core\Config\ConfigFactoryInterface;
 use Drupal\Core\Database\Connection;
+use Drupal\Core\Database\Query\SelectInterface;
 use Drupal\Core\Entity\EntityTypeManagerInterface;
 use Drupal\Core\Entity\Sql\SqlContentEntityStorage;
+use Drupal\Core\State\StateInterface;
 
 class FarmWfsQueryFactory {
 
@@ -15,17 +18,84 @@ class FarmWfsQueryFactory {
 
   protected $time;
 
+  protected $configFactory;
+
+  protected $state;
+
   public function __construct(Connection $connection, EntityTypeManagerInterface $entity_type_manager,
-    TimeInterface $time) {
+    TimeInterface $time, ConfigFactoryInterface $config_factory, StateInterface $state) {
     $this->connection = $connection;
     $this->entityTypeManager = $entity_type_manager;
     $this->time = $time;
+    $this->configFactory = $config_factory;
+    $this->state = $state;
   }
 
   /**
    * Creates a query to fetch asset ids by asset type and geometry types.
+   *
+   * When no asset type is given, assets of all types are matched. The query reads the asset locations from the
+   * maintained asset location index when it is enabled and otherwise computes them from the movement logs.
+   */
+  function create_query(?string $asset_type, array $geometry_types) {
+    if ($this->is_asset_location_index_enabled()) {
+      return $this->create_indexed_query($asset_type, $geometry_types);
+    }
+
+    return $this->create_computed_query($asset_type, $geometry_types);
+  }
+
+  /**
+   * Whether queries read the asset locations from the asset location index.
+   *
+   * That requires the use_asset_location_index setting and an index which has been rebuilt since the last time assets
+   * or logs changed without it being maintained - see FarmWfsAssetLocationIndex::needs_rebuild.
+   */
+  function is_asset_location_index_enabled() {
+    return $this->is_asset_location_index_maintained() &&
+      ! $this->state->get('farmos_wfs.asset_location_index_needs_rebuild', TRUE);
+  }
+
+  /**
+   * Whether the asset location index is kept up to date as assets and logs change.
+   */
+  function is_asset_location_index_maintained() {
+    return (bool) $this->configFactory->get('farmos_wfs.settings')->get('use_asset_location_index');
+  }
+
+  /**
+   * Creates a query to fetch asset ids by asset type and geometry types from the asset location index.
+   */
+  function create_indexed_query(?string $asset_type, array $geometry_types) {
+    $asset_storage = $this->entityTypeManager->getStorage('asset');
+
+    $asset_query = $this->connection->select($asset_storage->getBaseTable(), 'asset');
+
+    $asset_query->addTag('farmos_wfs_asset_location_index');
+
+    $asset_query->addField('asset', 'id', 'asset_id');
+
+    $asset_query->join($asset_storage->getDataTable(), 'asset_field_data', 'asset.id = asset_field_data.id');
+
+    $asset_query->join(FARMOS_WFS_ASSET_LOCATION_INDEX_TABLE, 'asset_location', 'asset.id = asset_location.asset_id');
+
+    if (isset($asset_type)) {
+      $asset_query->condition('asset.type', $asset_type);
+      // Lets the database use the index on the asset type and geometry type columns of the location index
+      $asset_query->condition('asset_location.asset_type', $asset_type);
+    }
+
+    $asset_query->condition($this->create_geometry_type_condition($asset_query, $geometry_types));
+
+    return $asset_query;
+  }
+
+  /**
+   * Creates a query to fetch asset ids by asset type and geometry types computing the asset locations from the logs.
+   *
+   * Optionally, the query can be restricted to a given set of asset ids.
    */
-  function create_query(string $asset_type, array $geometry_types) {
+  function create_computed_query(?string $asset_type, array $geometry_types, ?array $asset_ids = null) {
     $asset_storage = $this->entityTypeManager->getStorage('asset');
     $log_storage = $this->entityTypeManager->getStorage('log');
 
@@ -40,6 +110,10 @@ class FarmWfsQueryFactory {
 
     $latest_movement_log_query = $this->create_latest_movement_log_query($log_storage, $log_table_mapping);
 
+    if (isset($asset_ids)) {
+      $latest_movement_log_query->condition('log_asset.asset_target_id', $asset_ids, 'IN');
+    }
+
     $asset_query = $this->connection->select($asset_storage->getBaseTable(), 'asset');
 
     $asset_query->addField('asset', 'id', 'asset_id');
@@ -61,25 +135,380 @@ class FarmWfsQueryFactory {
     $asset_query->leftJoin($log_geometry_table, 'log_geometry',
       'most_recent_movement_log_ids.log_id = log_geometry.entity_id AND log_geometry.deleted = 0');
 
-    $asset_query->condition('asset.type', $asset_type);
+    if (isset($asset_type)) {
+      $asset_query->condition('asset.type', $asset_type);
+    }
+
+    if (isset($asset_ids)) {
+      $asset_query->condition('asset.id', $asset_ids, 'IN');
+    }
+
+    $asset_query->condition($this->create_geometry_type_condition($asset_query, $geometry_types));
+
+    return $asset_query;
+  }
+
+  /**
+   * Creates a condition matching assets whose effective geometry is of one of the given geometry types.
+   *
+   * Empty geometries (e.g. "POINT EMPTY") have no bounding box and are not matched, so the number of rows a query
+   * returns is also the number of features which get serialized for it.
+   *
+   * Like create_bbox_condition, the condition can be combined with other conditions on a query created by create_query.
+   */
+  function create_geometry_type_condition(SelectInterface $asset_query, array $geometry_types) {
+    if ($asset_query->hasTag('farmos_wfs_asset_location_index')) {
+      return $asset_query->andConditionGroup()
+        ->condition('asset_location.geometry_geo_type', $geometry_types, 'IN')
+        ->isNotNull('asset_location.geometry_top');
+    }
 
     $fixed_or_mobile_query_group = $asset_query->orConditionGroup();
 
     $fixed_or_mobile_query_group->condition(
       $fixed_or_mobile_query_group->andConditionGroup()
         ->condition('asset_field_data.is_fixed', 1)
-        ->condition('intrinsic_geometry.intrinsic_geometry_geo_type', $geometry_types, 'IN'));
+        ->condition('intrinsic_geometry.intrinsic_geometry_geo_type', $geometry_types, 'IN')
+        ->isNotNull('intrinsic_geometry.intrinsic_geometry_top'));
 
     $fixed_or_mobile_query_group->condition(
       $fixed_or_mobile_query_group->andConditionGroup()
         ->condition('asset_field_data.is_fixed', 0)
-        ->condition('log_geometry.geometry_geo_type', $geometry_types, 'IN'));
+        ->condition('log_geometry.geometry_geo_type', $geometry_types, 'IN')
+        ->isNotNull('log_geometry.geometry_top'));
+
+    return $fixed_or_mobile_query_group;
+  }
+
+  /**
+   * Adds the effective geometry type and bounding box columns to a query created by create_query.
+   *
+   * For fixed assets these come from the asset's intrinsic geometry and for mobile assets from the geometry of their
+   * latest movement log. The is_fixed and movement_log_id columns identify where the geometry value itself lives - see
+   * load_geometry_values.
+   */
+  function add_geometry_fields(SelectInterface $asset_query) {
+    if ($asset_query->hasTag('farmos_wfs_asset_location_index')) {
+      $asset_query->addField('asset_location', 'is_fixed');
+      $asset_query->addField('asset_location', 'movement_log_id');
+
+      foreach ([
+        'geo_type',
+        'top',
+        'right',
+        'bottom',
+        'left'
+      ] as $column) {
+        $asset_query->addField('asset_location', "geometry_$column");
+      }
+
+      return $asset_query;
+    }
 
-    $asset_query->condition($fixed_or_mobile_query_group);
+    $asset_query->addField('asset_field_data', 'is_fixed');
+    $asset_query->addField('most_recent_movement_log_ids', 'log_id', 'movement_log_id');
+
+    foreach ([
+      'geo_type',
+      'top',
+      'right',
+      'bottom',
+      'left'
+    ] as $column) {
+      $asset_query->addExpression($this->get_geometry_column_expression($asset_query, $column), "geometry_$column");
+    }
 
     return $asset_query;
   }
 
+  /**
+   * Gets the SQL expression of an effective geometry column (e.g. 'geo_type' or 'top') of a query created by
+   * create_query.
+   */
+  function get_geometry_column_expression(SelectInterface $asset_query, string $column) {
+    if ($asset_query->hasTag('farmos_wfs_asset_location_index')) {
+      return "asset_location.geometry_$column";
+    }
+
+    return "CASE WHEN asset_field_data.is_fixed = 1 THEN intrinsic_geometry.intrinsic_geometry_$column ELSE log_geometry.geometry_$column END";
+  }
+
+  /**
+   * Restricts a query created by create_query to assets whose effective geometry bounding box intersects a given bbox.
+   *
+   * @param array $bbox
+   *          The bounding box as [min latitude, min longitude, max latitude, max longitude].
+   */
+  function add_bbox_condition(SelectInterface $asset_query, array $bbox) {
+    $asset_query->condition($this->create_bbox_condition($asset_query, $bbox));
+
+    return $asset_query;
+  }
+
+  /**
+   * Creates a condition matching assets whose effective geometry bounding box intersects a given bbox.
+   *
+   * The condition can be combined with other conditions on a query created by create_query - e.g. by the OGC Filter
+   * compiler.
+   *
+   * @param bool $negate
+   *          Whether to instead match assets whose effective geometry bounding box does not intersect the bbox.
+   */
+  function create_bbox_condition(SelectInterface $asset_query, array $bbox, bool $negate = FALSE) {
+    $bbox_condition = function ($table_alias, $column_prefix) use ($asset_query, $bbox, $negate) {
+      if ($negate) {
+        return $asset_query->orConditionGroup()
+          ->condition("$table_alias.{$column_prefix}_top", $bbox[0], '<')
+          ->condition("$table_alias.{$column_prefix}_right", $bbox[1], '<')
+          ->condition("$table_alias.{$column_prefix}_bottom", $bbox[2], '>')
+          ->condition("$table_alias.{$column_prefix}_left", $bbox[3], '>');
+      }
+
+      return $asset_query->andConditionGroup()
+        ->condition("$table_alias.{$column_prefix}_top", $bbox[0], '>=')
+        ->condition("$table_alias.{$column_prefix}_right", $bbox[1], '>=')
+        ->condition("$table_alias.{$column_prefix}_bottom", $bbox[2], '<=')
+        ->condition("$table_alias.{$column_prefix}_left", $bbox[3], '<=');
+    };
+
+    if ($asset_query->hasTag('farmos_wfs_asset_location_index')) {
+      return $bbox_condition('asset_location', 'geometry');
+    }
+
+    $fixed_or_mobile_query_group = $asset_query->orConditionGroup();
+
+    $fixed_or_mobile_query_group->condition(
+      $fixed_or_mobile_query_group->andConditionGroup()
+        ->condition('asset_field_data.is_fixed', 1)
+        ->condition($bbox_condition('intrinsic_geometry', 'intrinsic_geometry')));
+
+    $fixed_or_mobile_query_group->condition(
+      $fixed_or_mobile_query_group->andConditionGroup()
+        ->condition('asset_field_data.is_fixed', 0)
+        ->condition($bbox_condition('log_geometry', 'geometry')));
+
+    return $fixed_or_mobile_query_group;
+  }
+
+  /**
+   * Loads the WKT geometry values for rows fetched from a query with add_geometry_fields.
+   *
+   * @return array The WKT geometry values keyed by asset id.
+   */
+  function load_geometry_values(array $rows) {
+    $asset_storage = $this->entityTypeManager->getStorage('asset');
+    $log_storage = $this->entityTypeManager->getStorage('log');
+
+    $fixed_asset_ids = [];
+    $asset_ids_by_movement_log_id = [];
+
+    foreach ($rows as $row) {
+      if ($row->is_fixed) {
+        $fixed_asset_ids[] = $row->asset_id;
+      } elseif (isset($row->movement_log_id)) {
+        $asset_ids_by_movement_log_id[$row->movement_log_id][] = $row->asset_id;
+      }
+    }
+
+    $geometry_values = [];
+
+    if (! empty($fixed_asset_ids)) {
+      $intrinsic_geometry_query = $this->connection->select(
+        $asset_storage->getTableMapping()
+          ->getFieldTableName('intrinsic_geometry'), 'intrinsic_geometry');
+
+      $intrinsic_geometry_query->addField('intrinsic_geometry', 'entity_id');
+      $intrinsic_geometry_query->addField('intrinsic_geometry', 'intrinsic_geometry_value');
+      $intrinsic_geometry_query->condition('intrinsic_geometry.entity_id', $fixed_asset_ids, 'IN');
+      $intrinsic_geometry_query->condition('intrinsic_geometry.deleted', 0);
+
+      foreach ($intrinsic_geometry_query->execute() as $geometry_row) {
+        $geometry_values[$geometry_row->entity_id] = $geometry_row->intrinsic_geometry_value;
+      }
+    }
+
+    if (! empty($asset_ids_by_movement_log_id)) {
+      $log_geometry_query = $this->connection->select(
+        $log_storage->getTableMapping()
+          ->getFieldTableName('geometry'), 'log_geometry');
+
+      $log_geometry_query->addField('log_geometry', 'entity_id');
+      $log_geometry_query->addField('log_geometry', 'geometry_value');
+      $log_geometry_query->condition('log_geometry.entity_id', array_keys($asset_ids_by_movement_log_id), 'IN');
+      $log_geometry_query->condition('log_geometry.deleted', 0);
+
+      foreach ($log_geometry_query->execute() as $geometry_row) {
+        foreach ($asset_ids_by_movement_log_id[$geometry_row->entity_id] as $asset_id) {
+          $geometry_values[$asset_id] = $geometry_row->geometry_value;
+        }
+      }
+    }
+
+    return $geometry_values;
+  }
+
+  /**
+   * Adds columns for the values of the given properties to a query created by create_query.
+   *
+   * This only works when every property is a single-valued field stored in the asset base or data table. Otherwise the
+   * query is left unchanged and the values need to come from the asset entities.
+   *
+   * @return array|null The column aliases of the property values keyed by field id plus the 'uuid' alias or null if
+   *         the properties cannot all be read from the query.
+   */
+  function add_property_fields(SelectInterface $asset_query, array $property_plan) {
+    $asset_storage = $this->entityTypeManager->getStorage('asset');
+
+    $table_mapping = $asset_storage->getTableMapping();
+
+    $storage_definitions = $asset_storage->getFieldStorageDefinitions();
+
+    $shared_table_aliases = [
+      $asset_storage->getBaseTable() => 'asset',
+      $asset_storage->getDataTable() => 'asset_field_data'
+    ];
+
+    $property_columns = [];
+
+    foreach ($property_plan as $property) {
+      $storage_definition = $storage_definitions[$property['field_id']] ?? null;
+
+      if (! $storage_definition || $property['is_taxonomy_term_ref'] || $storage_definition->isMultiple()) {
+        return null;
+      }
+
+      $table_alias = $shared_table_aliases[$table_mapping->getFieldTableName($property['field_id'])] ?? null;
+
+      if (! $table_alias) {
+        return null;
+      }
+
+      $property_columns[$property['field_id']] = [
+        $table_alias,
+        $table_mapping->getFieldColumnName($storage_definition, 'value')
+      ];
+    }
+
+    $aliases = [
+      'uuid' => $asset_query->addField('asset', 'uuid', 'asset_uuid')
+    ];
+
+    foreach ($property_columns as $field_id => list ($table_alias, $column)) {
+      $aliases[$field_id] = $asset_query->addField($table_alias, $column, "property_$field_id");
+    }
+
+    return $aliases;
+  }
+
+  /**
+   * Loads the names of taxonomy terms with a single query.
+   *
+   * @return array The term names keyed by term id.
+   */
+  function load_taxonomy_term_names(array $term_ids) {
+    if (empty($term_ids)) {
+      return [];
+    }
+
+    $term_storage = $this->entityTypeManager->getStorage('taxonomy_term');
+
+    $term_name_query = $this->connection->select($term_storage->getDataTable(), 'term_field_data');
+
+    $term_name_query->addField('term_field_data', 'tid');
+    $term_name_query->addField('term_field_data', 'name');
+    $term_name_query->condition('term_field_data.tid', $term_ids, 'IN');
+    $term_name_query->condition('term_field_data.default_langcode', 1);
+
+    return $term_name_query->execute()->fetchAllKeyed();
+  }
+
+  /**
+   * Summarizes the assets matched by a query created by create_query with a single aggregate query.
+   *
+   * The summary changes whenever a matched asset - or the movement log locating it - is added, removed, or changed. That
+   * makes it a cheap validator for responses derived from the matched assets.
+   *
+   * @return array The asset count, asset id sum, latest asset change, movement log id sum, and latest movement log
+   *         change.
+   */
+  function load_change_state(SelectInterface $asset_query) {
+    $state_query = clone $asset_query;
+
+    $fields = &$state_query->getFields();
+    $fields = [];
+
+    $expressions = &$state_query->getExpressions();
+    $expressions = [];
+
+    $order_by = &$state_query->getOrderBy();
+    $order_by = [];
+
+    $state_query->range();
+
+    $movement_log_id_column = $this->join_movement_log_data($state_query);
+
+    $state_query->addExpression('COUNT(asset.id)', 'asset_count');
+    $state_query->addExpression('SUM(asset.id)', 'asset_id_sum');
+    $state_query->addExpression('MAX(asset_field_data.changed)', 'asset_changed');
+    $state_query->addExpression("SUM($movement_log_id_column)", 'movement_log_id_sum');
+    $state_query->addExpression('MAX(movement_log_field_data.changed)', 'movement_log_changed');
+
+    return $state_query->execute()->fetchAssoc();
+  }
+
+  /**
+   * Creates a condition matching assets which changed - or whose location changed - at or after a given time.
+   *
+   * The location of a mobile asset changes when its latest movement log is saved or when a movement log with a future
+   * timestamp becomes effective. It also changes when a movement log is deleted or stops being an effective movement -
+   * which is recorded by the log hooks (see FarmWfsAssetTombstones::record_location_changes).
+   */
+  function create_changed_since_condition(SelectInterface $asset_query, int $changed_since) {
+    $this->join_movement_log_data($asset_query);
+
+    if (! isset($asset_query->getTables()['asset_location_change'])) {
+      $asset_query->leftJoin(FARMOS_WFS_ASSET_LOCATION_CHANGE_TABLE, 'asset_location_change',
+        'asset.id = asset_location_change.asset_id');
+    }
+
+    return $asset_query->orConditionGroup()
+      ->condition('asset_field_data.changed', $changed_since, '>=')
+      ->condition('movement_log_field_data.changed', $changed_since, '>=')
+      ->condition('movement_log_field_data.timestamp', $changed_since, '>=')
+      ->condition('asset_location_change.changed', $changed_since, '>=');
+  }
+
+  /**
+   * Joins the data of the latest movement log of each asset as 'movement_log_field_data' to a query created by
+   * create_query unless it is already joined.
+   *
+   * @return string The column holding the id of the latest movement log.
+   */
+  private function join_movement_log_data(SelectInterface $asset_query) {
+    $movement_log_id_column = $asset_query->hasTag('farmos_wfs_asset_location_index') ? 'asset_location.movement_log_id' : 'most_recent_movement_log_ids.log_id';
+
+    if (! isset($asset_query->getTables()['movement_log_field_data'])) {
+      $asset_query->leftJoin($this->entityTypeManager->getStorage('log')->getDataTable(), 'movement_log_field_data',
+        "$movement_log_id_column = movement_log_field_data.id");
+    }
+
+    return $movement_log_id_column;
+  }
+
+  /**
+   * Summarizes all taxonomy terms with a single aggregate query - see load_change_state.
+   */
+  function load_taxonomy_term_change_state() {
+    $term_storage = $this->entityTypeManager->getStorage('taxonomy_term');
+
+    $state_query = $this->connection->select($term_storage->getDataTable(), 'term_field_data');
+
+    $state_query->addExpression('COUNT(term_field_data.tid)', 'term_count');
+    $state_query->addExpression('MAX(term_field_data.changed)', 'term_changed');
+
+    return $state_query->execute()->fetchAssoc();
+  }
+
   private function create_latest_movement_log_query(SqlContentEntityStorage $log_storage, $log_table_mapping) {
     $latest_movement_log_query = $this->connection->select($log_storage->getBaseTable(), 'log');
 
@@ -0,0 +1,54 @@
+<?php
+
+namespace Drupal\farmos_wfs;
+
+/**
+ * Planar geometry helpers for line segments given as [start, end] coordinate pairs.
+ *
+ * Shared by the spatial predicate evaluation and the geometry simplification.
+ */
+class FarmWfsSegments {
+
+  public static function point_segment_distance(array $point, array $segment) {
+    list ($start, $end) = $segment;
+
+    $dx = $end[0] - $start[0];
+    $dy = $end[1] - $start[1];
+
+    $length_squared = $dx * $dx + $dy * $dy;
+
+    $t = $length_squared == 0 ? 0 : max(0,
+      min(1, (($point[0] - $start[0]) * $dx + ($point[1] - $start[1]) * $dy) / $length_squared));
+
+    return hypot($point[0] - ($start[0] + $t * $dx), $point[1] - ($start[1] + $t * $dy));
+  }
+
+  /**
+   * Gets the orientation of the triangle (a, b, c) as 1 for counter-clockwise, -1 for clockwise, or 0 for collinear.
+   */
+  public static function orientation(array $a, array $b, array $c) {
+    return $b[0] * $c[1] - $b[1] * $c[0] - $a[0] * $c[1] + $a[1] * $c[0] + $a[0] * $b[1] - $a[1] * $b[0] <=> 0;
+  }
+
+  public static function segments_intersect(array $s1, array $s2) {
+    if (static::segments_cross($s1, $s2)) {
+      return TRUE;
+    }
+
+    // Touching or collinear overlapping segments
+    return static::point_segment_distance($s1[0], $s2) == 0 || static::point_segment_distance($s1[1], $s2) == 0 ||
+      static::point_segment_distance($s2[0], $s1) == 0 || static::point_segment_distance($s2[1], $s1) == 0;
+  }
+
+  /**
+   * Tests whether two segments properly cross - intersecting at a single point which is interior to both.
+   */
+  public static function segments_cross(array $s1, array $s2) {
+    $o1 = static::orientation($s1[0], $s1[1], $s2[0]);
+    $o2 = static::orientation($s1[0], $s1[1], $s2[1]);
+    $o3 = static::orientation($s2[0], $s2[1], $s1[0]);
+    $o4 = static::orientation($s2[0], $s2[1], $s1[1]);
+
+    return $o1 * $o2 < 0 && $o3 * $o4 < 0;
+  }
+}
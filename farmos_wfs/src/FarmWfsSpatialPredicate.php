@@ -0,0 +1,374 @@
+<?php
+
+namespace Drupal\farmos_wfs;
+
+/**
+ * Approximate meters per degree of latitude - used to evaluate DWithin distances given in meters.
+ */
+const FARMOS_WFS_METERS_PER_DEGREE_LATITUDE = 110574;
+
+/**
+ * Approximate meters per degree of longitude at the equator.
+ */
+const FARMOS_WFS_METERS_PER_DEGREE_LONGITUDE_AT_EQUATOR = 111320;
+
+/**
+ * An exact spatial predicate (Intersects, Within, or DWithin) from an OGC Filter.
+ *
+ * The geometry columns only store bounding boxes, so spatial predicates are evaluated in two steps; get_bbox provides a
+ * bounding box which the database can use to find candidate assets and matches tests the actual geometry of each
+ * candidate. Coordinates are [longitude, latitude] pairs - the same axis order the feature geometries use.
+ */
+class FarmWfsSpatialPredicate {
+
+  protected $operator;
+
+  protected $geometry;
+
+  protected $distance;
+
+  protected $distanceInMeters;
+
+  /**
+   * @param string $operator
+   *          One of 'Intersects', 'Within', or 'DWithin'.
+   * @param \Geometry $geometry
+   *          The geoPHP geometry operand of the predicate.
+   * @param float $distance
+   *          The distance for DWithin predicates.
+   * @param bool $distance_in_meters
+   *          Whether the distance is in meters rather than degrees.
+   */
+  public function __construct(string $operator, \Geometry $geometry, float $distance = 0,
+    bool $distance_in_meters = FALSE) {
+    $this->operator = $operator;
+    $this->geometry = $geometry;
+    $this->distance = $distance;
+    $this->distanceInMeters = $distance_in_meters;
+  }
+
+  /**
+   * Gets a bounding box which contains the bounding boxes of all geometries which can match the predicate.
+   *
+   * @return array The bounding box as [min latitude, min longitude, max latitude, max longitude].
+   */
+  function get_bbox() {
+    $bbox = $this->geometry->getBBox();
+
+    list ($x_scale, $y_scale) = $this->distance_scales();
+
+    $x_margin = $this->operator == 'DWithin' ? $this->distance / $x_scale : 0;
+    $y_margin = $this->operator == 'DWithin' ? $this->distance / $y_scale : 0;
+
+    return [
+      $bbox['miny'] - $y_margin,
+      $bbox['minx'] - $x_margin,
+      $bbox['maxy'] + $y_margin,
+      $bbox['maxx'] + $x_margin
+    ];
+  }
+
+  /**
+   * Tests whether a geometry matches the predicate.
+   */
+  function matches(?\Geometry $geometry) {
+    if (! $geometry || $geometry->isEmpty()) {
+      return FALSE;
+    }
+
+    $candidate_parts = geometry_parts($geometry);
+    $operand_parts = geometry_parts($this->geometry);
+
+    switch ($this->operator) {
+      case 'Intersects':
+        return geometry_parts_intersect($candidate_parts, $operand_parts);
+
+      case 'Within':
+        return geometry_parts_within($candidate_parts, $operand_parts);
+
+      case 'DWithin':
+        list ($x_scale, $y_scale) = $this->distance_scales();
+
+        return geometry_parts_distance(scale_geometry_parts($candidate_parts, $x_scale, $y_scale),
+          scale_geometry_parts($operand_parts, $x_scale, $y_scale)) <= $this->distance;
+    }
+
+    throw new \Exception("Unsupported spatial operator: {$this->operator}");
+  }
+
+  /**
+   * Gets the factors to convert longitude and latitude deltas into the distance units.
+   *
+   * Distances in meters are evaluated on an equirectangular projection centered on the operand geometry which is
+   * accurate enough for the extent of a farm.
+   */
+  private function distance_scales() {
+    if (! $this->distanceInMeters) {
+      return [
+        1,
+        1
+      ];
+    }
+
+    $bbox = $this->geometry->getBBox();
+
+    $center_latitude = ($bbox['miny'] + $bbox['maxy']) / 2;
+
+    return [
+      max(FARMOS_WFS_METERS_PER_DEGREE_LONGITUDE_AT_EQUATOR * cos(deg2rad($center_latitude)), 1),
+      FARMOS_WFS_METERS_PER_DEGREE_LATITUDE
+    ];
+  }
+}
+
+/**
+ * Breaks a geoPHP geometry into its points, paths (line strings and polygon rings), and polygons (lists of rings).
+ *
+ * Coordinates are represented as [x, y] arrays.
+ */
+function geometry_parts(\Geometry $geometry, array $parts = [
+  'points' => [],
+  'paths' => [],
+  'polygons' => []
+]) {
+  if ($geometry->isEmpty()) {
+    return $parts;
+  }
+
+  switch ($geometry->geometryType()) {
+    case 'Point':
+      $parts['points'][] = [
+        (float) $geometry->x(),
+        (float) $geometry->y()
+      ];
+      return $parts;
+
+    case 'LineString':
+      $parts['paths'][] = line_string_coordinates($geometry);
+      return $parts;
+
+    case 'Polygon':
+      $rings = array_map(__NAMESPACE__ . '\line_string_coordinates', $geometry->getComponents());
+      $parts['paths'] = array_merge($parts['paths'], $rings);
+      $parts['polygons'][] = $rings;
+      return $parts;
+  }
+
+  foreach ($geometry->getComponents() as $component) {
+    $parts = geometry_parts($component, $parts);
+  }
+
+  return $parts;
+}
+
+function line_string_coordinates(\Geometry $line_string) {
+  return array_map(function ($point) {
+    return [
+      (float) $point->x(),
+      (float) $point->y()
+    ];
+  }, $line_string->getComponents());
+}
+
+function scale_geometry_parts(array $parts, float $x_scale, float $y_scale) {
+  $scale = function ($coordinate) use ($x_scale, $y_scale) {
+    return [
+      $coordinate[0] * $x_scale,
+      $coordinate[1] * $y_scale
+    ];
+  };
+
+  $scale_path = function ($path) use ($scale) {
+    return array_map($scale, $path);
+  };
+
+  return [
+    'points' => array_map($scale, $parts['points']),
+    'paths' => array_map($scale_path, $parts['paths']),
+    'polygons' => array_map(function ($rings) use ($scale_path) {
+      return array_map($scale_path, $rings);
+    }, $parts['polygons'])
+  ];
+}
+
+/**
+ * Lists the segments of the paths of a geometry as [start, end] coordinate pairs.
+ */
+function geometry_parts_segments(array $parts) {
+  $segments = [];
+
+  foreach ($parts['paths'] as $path) {
+    for ($i = 1; $i < count($path); $i ++) {
+      $segments[] = [
+        $path[$i - 1],
+        $path[$i]
+      ];
+    }
+  }
+
+  return $segments;
+}
+
+/**
+ * Lists every coordinate of a geometry - including points and the vertices of paths.
+ */
+function geometry_parts_vertices(array $parts) {
+  return array_merge($parts['points'], ...$parts['paths']);
+}
+
+function geometry_parts_intersect(array $a, array $b) {
+  $a_segments = geometry_parts_segments($a);
+  $b_segments = geometry_parts_segments($b);
+
+  foreach ($a_segments as $a_segment) {
+    foreach ($b_segments as $b_segment) {
+      if (FarmWfsSegments::segments_intersect($a_segment, $b_segment)) {
+        return TRUE;
+      }
+    }
+  }
+
+  // Having no crossing edges, the geometries still intersect when a point or a whole path of one is covered by the
+  // other - testing a single vertex of each path suffices for that
+  $representative_vertices = function ($parts) {
+    return array_merge($parts['points'],
+      array_map(function ($path) {
+        return $path[0];
+      }, array_filter($parts['paths'])));
+  };
+
+  foreach ([
+    [
+      $a,
+      $b,
+      $b_segments
+    ],
+    [
+      $b,
+      $a,
+      $a_segments
+    ]
+  ] as list ($parts, $other_parts, $other_segments)) {
+    foreach ($representative_vertices($parts) as $vertex) {
+      if (coordinate_covered_by_parts($vertex, $other_parts, $other_segments)) {
+        return TRUE;
+      }
+    }
+  }
+
+  return FALSE;
+}
+
+/**
+ * Tests whether geometry $a lies within geometry $b.
+ *
+ * Every vertex and the midpoint of every edge of $a must be covered by $b and no edge of $a may cross the boundary of
+ * $b.
+ */
+function geometry_parts_within(array $a, array $b) {
+  $b_segments = geometry_parts_segments($b);
+
+  foreach (geometry_parts_vertices($a) as $vertex) {
+    if (! coordinate_covered_by_parts($vertex, $b, $b_segments)) {
+      return FALSE;
+    }
+  }
+
+  foreach (geometry_parts_segments($a) as $a_segment) {
+    $midpoint = [
+      ($a_segment[0][0] + $a_segment[1][0]) / 2,
+      ($a_segment[0][1] + $a_segment[1][1]) / 2
+    ];
+
+    if (! coordinate_covered_by_parts($midpoint, $b, $b_segments)) {
+      return FALSE;
+    }
+
+    if (! empty($b['polygons'])) {
+      foreach ($b_segments as $b_segment) {
+        if (FarmWfsSegments::segments_cross($a_segment, $b_segment)) {
+          return FALSE;
+        }
+      }
+    }
+  }
+
+  return TRUE;
+}
+
+function geometry_parts_distance(array $a, array $b) {
+  if (geometry_parts_intersect($a, $b)) {
+    return 0;
+  }
+
+  $a_segments = geometry_parts_segments($a);
+  $b_segments = geometry_parts_segments($b);
+
+  $distance = INF;
+
+  foreach ($a['points'] as $a_point) {
+    foreach ($b['points'] as $b_point) {
+      $distance = min($distance, hypot($a_point[0] - $b_point[0], $a_point[1] - $b_point[1]));
+    }
+    foreach ($b_segments as $b_segment) {
+      $distance = min($distance, FarmWfsSegments::point_segment_distance($a_point, $b_segment));
+    }
+  }
+
+  foreach ($a_segments as $a_segment) {
+    foreach ($b['points'] as $b_point) {
+      $distance = min($distance, FarmWfsSegments::point_segment_distance($b_point, $a_segment));
+    }
+    foreach ($b_segments as $b_segment) {
+      // Non-intersecting segments are closest at one of their end points
+      $distance = min($distance, FarmWfsSegments::point_segment_distance($a_segment[0], $b_segment),
+        FarmWfsSegments::point_segment_distance($a_segment[1], $b_segment),
+        FarmWfsSegments::point_segment_distance($b_segment[0], $a_segment),
+        FarmWfsSegments::point_segment_distance($b_segment[1], $a_segment));
+    }
+  }
+
+  return $distance;
+}
+
+function coordinate_covered_by_parts(array $coordinate, array $parts, array $segments) {
+  foreach ($parts['points'] as $point) {
+    if ($point == $coordinate) {
+      return TRUE;
+    }
+  }
+
+  foreach ($segments as $segment) {
+    if (FarmWfsSegments::point_segment_distance($coordinate, $segment) == 0) {
+      return TRUE;
+    }
+  }
+
+  foreach ($parts['polygons'] as $rings) {
+    if (point_in_polygon($coordinate, $rings)) {
+      return TRUE;
+    }
+  }
+
+  return FALSE;
+}
+
+/**
+ * Tests whether a coordinate lies in the interior of a polygon given as its exterior ring followed by its holes.
+ */
+function point_in_polygon(array $coordinate, array $rings) {
+  $inside = FALSE;
+
+  // Using the even-odd rule over all rings excludes the holes
+  foreach ($rings as $ring) {
+    for ($i = 0, $j = count($ring) - 1; $i < count($ring); $j = $i ++) {
+      if (($ring[$i][1] > $coordinate[1]) != ($ring[$j][1] > $coordinate[1]) &&
+        $coordinate[0] <
+        ($ring[$j][0] - $ring[$i][0]) * ($coordinate[1] - $ring[$i][1]) / ($ring[$j][1] - $ring[$i][1]) + $ring[$i][0]) {
+        $inside = ! $inside;
+      }
+    }
+  }
+
+  return $inside;
+}
@@ -2,12 +2,17 @@
 
 namespace Drupal\farmos_wfs\Handler;
 
+use Drupal\Component\Datetime\TimeInterface;
+use Drupal\Core\Cache\CacheBackendInterface;
+use Drupal\Core\Config\ConfigFactoryInterface;
 use Drupal\Core\Entity\EntityFieldManagerInterface;
 use Drupal\Core\Entity\EntityTypeBundleInfoInterface;
 use Drupal\Core\Entity\EntityTypeManagerInterface;
 use Drupal\farmos_wfs\FarmWfsFeatureType;
 use Drupal\farmos_wfs\FarmWfsFeatureTypeFactoryValidator;
+use Drupal\farmos_wfs\FarmWfsFeatureTypePropertyPlanner;
 use Drupal\farmos_wfs\Exception\FarmWfsException;
+use Symfony\Component\HttpFoundation\RequestStack;
 
 /**
  * Defines FarmWfsDescribeFeatureTypeHandler class.
@@ -22,13 +27,35 @@ class FarmWfsDescribeFeatureTypeHandler {
 
   protected $featureTypeFactoryValidator;
 
+  protected $featureTypePropertyPlanner;
+
+  protected $requestStack;
+
+  protected $configFactory;
+
+  /**
+   * The cache backend which holds rendered schema documents.
+   *
+   * @var \Drupal\Core\Cache\CacheBackendInterface
+   */
+  protected $cache;
+
+  protected $time;
+
   public function __construct(EntityTypeManagerInterface $entity_type_manager,
     EntityTypeBundleInfoInterface $entity_bundle_info, EntityFieldManagerInterface $entity_field_manager,
-    FarmWfsFeatureTypeFactoryValidator $feature_type_factory_validator) {
+    FarmWfsFeatureTypeFactoryValidator $feature_type_factory_validator,
+    FarmWfsFeatureTypePropertyPlanner $feature_type_property_planner, RequestStack $request_stack,
+    ConfigFactoryInterface $config_factory, CacheBackendInterface $cache, TimeInterface $time) {
     $this->entityTypeManager = $entity_type_manager;
     $this->entityTypeBundleInfo = $entity_bundle_info;
     $this->entityFieldManager = $entity_field_manager;
     $this->featureTypeFactoryValidator = $feature_type_factory_validator;
+    $this->featureTypePropertyPlanner = $feature_type_property_planner;
+    $this->requestStack = $request_stack;
+    $this->configFactory = $config_factory;
+    $this->cache = $cache;
+    $this->time = $time;
   }
 
   public function handle(array $query_params) {
@@ -49,6 +76,46 @@ class FarmWfsDescribeFeatureTypeHandler {
           }), 400);
     }
 
+    // Requests for the same set of types in any order share the same schema
+    usort($feature_types, function ($a, $b) {
+      return strcmp($a->unqualifiedTypeName(), $b->unqualifiedTypeName());
+    });
+
+    $type_names = array_unique(array_map(function ($feature_type) {
+      return $feature_type->unqualifiedTypeName();
+    }, $feature_types));
+
+    // The schema only depends on the requested feature types and the asset fields/bundles - not the host or user
+    $cid = 'farmos_wfs:describe_feature_type:' . hash('sha256', implode(',', $type_names));
+
+    $cached = $this->cache->get($cid);
+
+    if ($cached) {
+      $schema = $cached->data;
+    } else {
+      $xml = $this->build_schema_doc($feature_types)->saveXML();
+
+      $schema = [
+        'xml' => $xml,
+        'etag' => hash('sha256', $xml),
+        'last_modified' => $this->time->getRequestTime()
+      ];
+
+      $this->cache->set($cid, $schema, CacheBackendInterface::CACHE_PERMANENT,
+        [
+          'entity_field_info',
+          'entity_bundles'
+        ]);
+    }
+
+    $client_max_age = (int) ($this->configFactory->get('farmos_wfs.settings')
+      ->get('describe_feature_type_client_max_age') ?? 0);
+
+    return farmos_wfs_makeConditionalXmlResponse($this->requestStack->getCurrentRequest(), $schema['xml'],
+      $schema['etag'], $schema['last_modified'], $client_max_age);
+  }
+
+  private function build_schema_doc(array $feature_types) {
     if (empty($feature_types)) {
       $asset_types = array_keys($this->entityTypeBundleInfo->getBundleInfo('asset'));
 
@@ -111,68 +178,28 @@ class FarmWfsDescribeFeatureTypeHandler {
                                     $elem('xsd:sequence', array(),
                                       function ($sequence, $elem) use ($feature_type) {
 
-                                        $field_definitions = $this->entityFieldManager->getFieldDefinitions('asset',
+                                        $property_plan = $this->featureTypePropertyPlanner->get_property_plan(
                                           $feature_type->getAssetType());
 
-                                        foreach ($field_definitions as $field_id => $field_definition) {
-
-                                          $field_type = $field_definition->getType();
-
-                                          $supported_field_types = [
-                                            'string',
-                                            'text_long',
-                                            'timestamp',
-                                            'boolean',
-                                            'uuid',
-                                            'list_string',
-                                            'string_long',
-                                            'integer',
-                                            'state',
-                                          ];
-
-                                          if ($field_definition->isReadOnly()) {
-                                            $property_name = '__' . $field_id;
-                                          } else {
-                                            $property_name = $field_id;
-                                          }
-
-                                          $is_taxonomy_term_ref = $field_type == "entity_reference" && $field_definition->getSetting('target_type') == "taxonomy_term";
+                                        foreach ($property_plan as $property) {
 
-                                          if (in_array($field_type, $supported_field_types) || $is_taxonomy_term_ref) {
+                                          $elem_attrs = [];
 
-                                            $elem_attrs = [];
+                                          $elem_attrs["name"] = $property['property_name'];
+                                          $elem_attrs["type"] = $property['schema_type'];
 
-                                            $elem_attrs["name"] = $property_name;
-
-                                            if ($field_type == 'string' || $field_type == 'text_long' ||
-                                              $field_type == 'list_string' || $field_type == 'string_long' ||
-                                              $is_taxonomy_term_ref) {
-                                              $elem_attrs["type"] = "string";
-                                            } elseif ($field_type == 'timestamp') {
-                                              $elem_attrs["type"] = "dateTime";
-                                            } elseif ($field_type == 'boolean') {
-                                              $elem_attrs["type"] = "boolean";
-                                            } elseif ($field_type == 'uuid') {
-                                              $elem_attrs["type"] = "string";
-                                            } elseif ($field_type == 'integer') {
-                                              $elem_attrs["type"] = "integer";
-                                            } elseif ($field_type == 'state') {
-                                              $elem_attrs["type"] = "string";
-                                            }
-
-                                            if (! $field_definition->isRequired()) {
-                                              $elem_attrs['nillable'] = 'true';
-                                              $elem_attrs['minOccurs'] = '0';
-                                            }
-
-                                            $cardinality = $field_definition->getCardinality();
+                                          if (! $property['is_required']) {
+                                            $elem_attrs['nillable'] = 'true';
+                                            $elem_attrs['minOccurs'] = '0';
+                                          }
 
-                                            if ($cardinality > 1) {
-                                              $elem_attrs['maxOccurs'] = "$cardinality";
-                                            }
+                                          $cardinality = $property['cardinality'];
 
-                                            $sequence->appendChild($elem('xsd:element', $elem_attrs));
+                                          if ($cardinality > 1) {
+                                            $elem_attrs['maxOccurs'] = "$cardinality";
                                           }
+
+                                          $sequence->appendChild($elem('xsd:element', $elem_attrs));
                                         }
 
                                         $sequence->appendChild(
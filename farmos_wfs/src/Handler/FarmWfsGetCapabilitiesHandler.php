@@ -2,10 +2,13 @@
 
 namespace Drupal\farmos_wfs\Handler;
 
+use Drupal\Component\Datetime\TimeInterface;
 use Drupal\Component\Utility\Xss;
+use Drupal\Core\Cache\CacheBackendInterface;
 use Drupal\Core\Config\ConfigFactoryInterface;
 use Drupal\Core\Entity\EntityTypeBundleInfo;
 use Drupal\Core\Session\AccountProxyInterface;
+use Drupal\Core\Session\PermissionsHashGeneratorInterface;
 use Drupal\farmos_wfs\FarmWfsFeatureType;
 use Drupal\farmos_wfs\FarmWfsFeatureTypeBboxQuerier;
 use Symfony\Component\HttpFoundation\RequestStack;
@@ -44,6 +47,27 @@ class FarmWfsGetCapabilitiesHandler {
 
   protected $featureTypeBboxQuerier;
 
+  /**
+   * The cache backend which holds rendered capabilities documents.
+   *
+   * @var \Drupal\Core\Cache\CacheBackendInterface
+   */
+  protected $cache;
+
+  /**
+   * The permissions hash generator.
+   *
+   * @var \Drupal\Core\Session\PermissionsHashGeneratorInterface
+   */
+  protected $permissionsHashGenerator;
+
+  /**
+   * The time service.
+   *
+   * @var \Drupal\Component\Datetime\TimeInterface
+   */
+  protected $time;
+
   /**
    * Constructs a new FarmWfsController object.
    *
@@ -55,15 +79,25 @@ class FarmWfsGetCapabilitiesHandler {
    *          The config factory.
    * @param \Drupal\Core\Session\AccountProxyInterface $currentUser
    *          The current user.
+   * @param \Drupal\Core\Cache\CacheBackendInterface $cache
+   *          The cache backend which holds rendered capabilities documents.
+   * @param \Drupal\Core\Session\PermissionsHashGeneratorInterface $permissions_hash_generator
+   *          The permissions hash generator.
+   * @param \Drupal\Component\Datetime\TimeInterface $time
+   *          The time service.
    */
   public function __construct(RequestStack $request_stack, ConfigFactoryInterface $config_factory,
     EntityTypeBundleInfo $entityTypeBundleInfo, AccountProxyInterface $currentUser,
-    FarmWfsFeatureTypeBboxQuerier $feature_type_bbox_querier) {
+    FarmWfsFeatureTypeBboxQuerier $feature_type_bbox_querier, CacheBackendInterface $cache,
+    PermissionsHashGeneratorInterface $permissions_hash_generator, TimeInterface $time) {
     $this->requestStack = $request_stack;
     $this->configFactory = $config_factory;
     $this->entityTypeBundleInfo = $entityTypeBundleInfo;
     $this->currentUser = $currentUser;
     $this->featureTypeBboxQuerier = $feature_type_bbox_querier;
+    $this->cache = $cache;
+    $this->permissionsHashGenerator = $permissions_hash_generator;
+    $this->time = $time;
   }
 
   public function handle(array $query_params) {
@@ -71,6 +105,44 @@ class FarmWfsGetCapabilitiesHandler {
 
     $host = $current_request->getSchemeAndHttpHost();
 
+    // The document only varies by host and - through the advertised transaction operations - by the user's permissions
+    $cid = 'farmos_wfs:capabilities:' .
+      hash('sha256', $host . ':' . $this->permissionsHashGenerator->generate($this->currentUser));
+
+    $cached = $this->cache->get($cid);
+
+    if ($cached) {
+      $capabilities = $cached->data;
+    } else {
+      $xml = $this->build_capabilities_doc($host)->saveXML();
+
+      $capabilities = [
+        'xml' => $xml,
+        'etag' => hash('sha256', $xml),
+        'last_modified' => $this->time->getRequestTime()
+      ];
+
+      $max_age = (int) ($this->configFactory->get('farmos_wfs.settings')
+        ->get('capabilities_cache_max_age') ?? 3600);
+
+      // Movement logs with a timestamp in the future silently become effective so the cache entries also need to expire
+      if ($max_age > 0) {
+        $this->cache->set($cid, $capabilities, $this->time->getRequestTime() + $max_age,
+          [
+            'asset_list',
+            'log_list',
+            'entity_bundles',
+            'config:system.site',
+            'config:farmos_wfs.settings'
+          ]);
+      }
+    }
+
+    return farmos_wfs_makeConditionalXmlResponse($current_request, $capabilities['xml'], $capabilities['etag'],
+      $capabilities['last_modified']);
+  }
+
+  private function build_capabilities_doc(string $host) {
     return farmos_wfs_makeDoc(
       function ($doc, $elem) use ($host) {
         $doc->appendChild(
@@ -154,6 +226,13 @@ class FarmWfsGetCapabilitiesHandler {
                                           $http->appendChild($elem('ows:Get', array(
                                             "xlink:href" => "$host/wfs"
                                           )));
+
+                                          if ($operationName == 'GetFeature') {
+
+                                            $http->appendChild($elem('ows:Post', array(
+                                              "xlink:href" => "$host/wfs"
+                                            )));
+                                          }
                                         }
                                       }));
                                 }));
@@ -180,9 +259,25 @@ class FarmWfsGetCapabilitiesHandler {
                               $operation->appendChild(
                                 $elem('ows:Parameter', array(
                                   'name' => "outputFormat"
+                                ),
+                                  function ($param, $elem) use ($operationName) {
+                                    $param->appendChild($elem('ows:Value', [], FARMOS_WFS_GML_OUTPUT_FORMAT));
+
+                                    if ($operationName == 'GetFeature') {
+                                      $param->appendChild($elem('ows:Value', [], FARMOS_WFS_GEOJSON_OUTPUT_FORMAT));
+                                    }
+                                  }));
+                            }
+
+                            if ($operationName == 'GetFeature') {
+
+                              $operation->appendChild(
+                                $elem('ows:Parameter', array(
+                                  'name' => "resultType"
                                 ),
                                   function ($param, $elem) {
-                                    $param->appendChild($elem('ows:Value', [], "text/xml; subtype=gml/3.1.1"));
+                                    $param->appendChild($elem('ows:Value', [], "results"));
+                                    $param->appendChild($elem('ows:Value', [], "hits"));
                                   }));
                             }
 
@@ -218,9 +313,11 @@ class FarmWfsGetCapabilitiesHandler {
 
                     $asset_bundles = $this->entityTypeBundleInfo->getBundleInfo('asset');
 
+                    $bboxes_by_asset_type = $this->featureTypeBboxQuerier->get_all_bounding_boxes();
+
                     foreach ($asset_bundles as $asset_type => $asset_bundle_info) {
 
-                      $bboxes_by_geometry_type = $this->featureTypeBboxQuerier->get_bounding_boxes($asset_type);
+                      $bboxes_by_geometry_type = $bboxes_by_asset_type[$asset_type] ?? [];
 
                       foreach (FARMOS_WFS_RECOGNIZED_GEOMETRY_TYPES as $geometry_type) {
 
@@ -251,10 +348,11 @@ class FarmWfsGetCapabilitiesHandler {
                               $featureType->appendChild(
                                 $elem('wfs:OutputFormats', [],
                                   function ($outputFormats, $elem) {
-                                    $outputFormats->appendChild($elem('wfs:Format', [], "text/xml; subtype=gml/3.1.1"));
+                                    $outputFormats->appendChild($elem('wfs:Format', [], FARMOS_WFS_GML_OUTPUT_FORMAT));
+                                    $outputFormats->appendChild($elem('wfs:Format', [], FARMOS_WFS_GEOJSON_OUTPUT_FORMAT));
                                   }));
 
-                              $bbox = $bboxes_by_geometry_type[$feature_type->getGeometryTypeName()];
+                              $bbox = $bboxes_by_geometry_type[$feature_type->getGeometryTypeName()] ?? [];
 
                               if (! empty($bbox)) {
 
@@ -286,11 +384,53 @@ class FarmWfsGetCapabilitiesHandler {
                             $elem('ogc:SpatialOperators', [],
                               function ($spatialOperators, $elem) {
 
-                                $spatialOperators->appendChild($elem('ogc:SpatialOperator', array(
-                                  'name' => "BBOX"
-                                )));
+                                foreach ([
+                                  'BBOX',
+                                  'Intersects',
+                                  'Within',
+                                  'DWithin'
+                                ] as $spatial_operator) {
+                                  $spatialOperators->appendChild(
+                                    $elem('ogc:SpatialOperator', array(
+                                      'name' => $spatial_operator
+                                    )));
+                                }
                               }));
                         }));
+
+                    $filterCapabilities->appendChild(
+                      $elem('ogc:Scalar_Capabilities', [],
+                        function ($scalarCapabilities, $elem) {
+
+                          $scalarCapabilities->appendChild($elem('ogc:LogicalOperators', []));
+
+                          $scalarCapabilities->appendChild(
+                            $elem('ogc:ComparisonOperators', [],
+                              function ($comparisonOperators, $elem) {
+
+                                foreach ([
+                                  'LessThan',
+                                  'GreaterThan',
+                                  'LessThanEqualTo',
+                                  'GreaterThanEqualTo',
+                                  'EqualTo',
+                                  'NotEqualTo',
+                                  'Like',
+                                  'Between',
+                                  'NullCheck'
+                                ] as $comparison_operator) {
+                                  $comparisonOperators->appendChild(
+                                    $elem('ogc:ComparisonOperator', [], $comparison_operator));
+                                }
+                              }));
+                        }));
+
+                    $filterCapabilities->appendChild(
+                      $elem('ogc:Id_Capabilities', [],
+                        function ($idCapabilities, $elem) {
+
+                          $idCapabilities->appendChild($elem('ogc:FID', []));
+                        }));
                   }));
             }));
       });
@@ -2,17 +2,42 @@
 
 namespace Drupal\farmos_wfs\Handler;
 
+use Drupal\Component\Datetime\TimeInterface;
+use Drupal\Core\Config\ConfigFactoryInterface;
+use Drupal\Core\Database\Query\SelectInterface;
 use Drupal\Core\Entity\EntityFieldManagerInterface;
 use Drupal\Core\Entity\EntityTypeBundleInfoInterface;
 use Drupal\Core\Entity\EntityTypeManagerInterface;
-use Drupal\farm_location\AssetLocationInterface;
+use Drupal\farmos_wfs\FarmWfsAssetTombstones;
 use Drupal\farmos_wfs\FarmWfsFeatureTypeFactoryValidator;
+use Drupal\farmos_wfs\FarmWfsGeometrySimplifier;
+use Drupal\farmos_wfs\FarmWfsProfiler;
+use Drupal\farmos_wfs\FarmWfsFeatureTypePropertyPlanner;
+use Drupal\farmos_wfs\FarmWfsQueryFactory;
 use Drupal\farmos_wfs\Exception\FarmWfsException;
 use Drupal\farmos_wfs\QueryResolver\FarmWfsBboxQueryResolver;
 use Drupal\farmos_wfs\QueryResolver\FarmWfsFilterQueryResolver;
 use Drupal\farmos_wfs\QueryResolver\FarmWfsSimpleQueryResolver;
+use Symfony\Component\HttpFoundation\JsonResponse;
 use Symfony\Component\HttpFoundation\RequestStack;
-use Geometry;
+use Symfony\Component\HttpFoundation\Response;
+
+/**
+ * The properties GetFeature results can be sorted by mapped to their query columns.
+ */
+const FARMOS_WFS_SORTABLE_PROPERTIES = [
+  'id' => 'asset.id',
+  'name' => 'asset_field_data.name',
+  'status' => 'asset_field_data.status',
+  'created' => 'asset_field_data.created',
+  'changed' => 'asset_field_data.changed'
+];
+
+/**
+ * The number of tolerance steps across the BBOX extent when the simplification tolerance is derived from it - roughly
+ * the width of a map in pixels.
+ */
+const FARMOS_WFS_AUTO_SIMPLIFICATION_RESOLUTION = 1024;
 
 /**
  * Defines FarmWfsGetFeatureHandler class.
@@ -21,6 +46,8 @@ class FarmWfsGetFeatureHandler {
 
   protected $requestStack;
 
+  protected $configFactory;
+
   protected $entityTypeManager;
 
   protected $entityTypeBundleInfo;
@@ -29,37 +56,54 @@ class FarmWfsGetFeatureHandler {
 
   protected $featureTypeFactoryValidator;
 
+  protected $featureTypePropertyPlanner;
+
   protected $simpleQueryResolver;
 
   protected $filterQueryResolver;
 
   protected $bboxQueryResolver;
 
-  protected $assetLocation;
+  protected $queryFactory;
 
-  public function __construct(RequestStack $request_stack, EntityTypeManagerInterface $entity_type_manager,
-    EntityTypeBundleInfoInterface $entity_bundle_info, EntityFieldManagerInterface $entity_field_manager,
+  protected $assetTombstones;
+
+  protected $geometrySimplifier;
+
+  protected $profiler;
+
+  protected $time;
+
+  public function __construct(RequestStack $request_stack, ConfigFactoryInterface $config_factory,
+    EntityTypeManagerInterface $entity_type_manager, EntityTypeBundleInfoInterface $entity_bundle_info,
+    EntityFieldManagerInterface $entity_field_manager,
     FarmWfsFeatureTypeFactoryValidator $feature_type_factory_validator,
+    FarmWfsFeatureTypePropertyPlanner $feature_type_property_planner,
     FarmWfsSimpleQueryResolver $simple_query_resolver, FarmWfsFilterQueryResolver $filter_query_resolver,
-    FarmWfsBboxQueryResolver $bbox_query_resolver, AssetLocationInterface $asset_location) {
+    FarmWfsBboxQueryResolver $bbox_query_resolver, FarmWfsQueryFactory $query_factory,
+    FarmWfsAssetTombstones $asset_tombstones, FarmWfsGeometrySimplifier $geometry_simplifier,
+    FarmWfsProfiler $profiler, TimeInterface $time) {
     $this->requestStack = $request_stack;
+    $this->configFactory = $config_factory;
     $this->entityTypeManager = $entity_type_manager;
     $this->entityTypeBundleInfo = $entity_bundle_info;
     $this->entityFieldManager = $entity_field_manager;
     $this->featureTypeFactoryValidator = $feature_type_factory_validator;
+    $this->featureTypePropertyPlanner = $feature_type_property_planner;
 
     $this->simpleQueryResolver = $simple_query_resolver;
     $this->filterQueryResolver = $filter_query_resolver;
     $this->bboxQueryResolver = $bbox_query_resolver;
 
-    $this->assetLocation = $asset_location;
+    $this->queryFactory = $query_factory;
+
+    $this->assetTombstones = $asset_tombstones;
+    $this->geometrySimplifier = $geometry_simplifier;
+    $this->profiler = $profiler;
+    $this->time = $time;
   }
 
   public function handle(array $query_params) {
-    $current_request = $this->requestStack->getCurrentRequest();
-
-    $host = $current_request->getSchemeAndHttpHost();
-
     $feature_types = [];
     $unknown_type_names = [];
     list ($feature_types, $unknown_type_names) = $this->featureTypeFactoryValidator->type_names_string_to_validated_feature_types(
@@ -87,21 +131,6 @@ class FarmWfsGetFeatureHandler {
         });
     }
 
-    if (count($feature_types) > 1) {
-      return farmos_wfs_makeExceptionReport(
-        function ($eReport, $elem) {
-          $eReport->appendChild(
-            $elem('Exception', array(
-              "exceptionCode" => "InvalidParameterValue",
-              "locator" => "typename"
-            ),
-              $elem('ExceptionText', [],
-                "GetFeature currently only supports retrieving features from a single feature type")));
-        });
-    }
-
-    $feature_type = $feature_types[0];
-
     $bbox = array_filter(explode(',', $query_params['BBOX'] ?? ''));
 
     if (! empty($bbox) && (count($bbox) < 4 || count($bbox) > 5)) {
@@ -126,293 +155,1380 @@ class FarmWfsGetFeatureHandler {
         });
     }
 
-    $filter = $query_params['FILTER'] ?? null;
+    $sort_orders = parse_sort_by($query_params['SORTBY'] ?? '');
+
+    $max_features = parse_integer_param($query_params, 'MAXFEATURES', 1);
+    $start_index = parse_integer_param($query_params, 'STARTINDEX', 0) ?? 0;
+
+    $result_type = parse_result_type($query_params['RESULTTYPE'] ?? 'results');
+
+    $output_format = parse_output_format($query_params['OUTPUTFORMAT'] ?? '');
+
+    // With several type names, the FILTER and PROPERTYNAME parameters may hold a parenthesized value per type
+    $raw_filters = split_parenthesized_param_values($query_params['FILTER'] ?? '', count($feature_types), 'filter');
+    $raw_property_names = split_parenthesized_param_values($query_params['PROPERTYNAME'] ?? '', count($feature_types),
+      'propertyName');
+
+    if (! empty($bbox) && ! empty(array_filter($raw_filters))) {
+      throw new FarmWfsException(
+        farmos_wfs_makeExceptionReport(
+          function ($eReport, $elem) {
+            $eReport->appendChild(
+              $elem('Exception', array(
+                "exceptionCode" => "InvalidParameterValue",
+                "locator" => "filter"
+              ),
+                $elem('ExceptionText', [],
+                  "Illegal request; please supply only one of the 'filter' or 'bbox' parameters")));
+          }), 400);
+    }
+
+    $changed_since = $this->parse_changed_since($query_params['CHANGEDSINCE'] ?? '');
+
+    $queries = [];
+
+    foreach ($feature_types as $idx => $feature_type) {
+      $filter_elem = $raw_filters[$idx] ? parse_filter_xml($raw_filters[$idx]) : null;
+
+      // Like for XML-POST requests, 'auto' tolerances fall back to the extent the query's filter is restricted to
+      $simplification_tolerance = $this->parse_simplification_tolerance($query_params['SIMPLIFY'] ?? '',
+        $bbox ?: ($filter_elem ? $this->filterQueryResolver->get_bbox($filter_elem) ?? [] : []));
+
+      $queries[] = [
+        'feature_type' => $feature_type,
+        'bbox' => $bbox,
+        'filter_elem' => $filter_elem,
+        'property_plan' => $this->project_property_plan(
+          $this->featureTypePropertyPlanner->get_property_plan($feature_type->getAssetType()),
+          parse_property_names($raw_property_names[$idx])),
+        'sort_orders' => $sort_orders,
+        'changed_since' => $changed_since,
+        'simplification_tolerance' => $simplification_tolerance
+      ];
+    }
+
+    return $this->respond($queries, $max_features, $start_index, $result_type, $output_format);
+  }
+
+  /**
+   * Handles XML-POST GetFeature requests - answering all of their wfs:Query elements in a single response.
+   */
+  public function handle_post(array $query_params, \DOMElement $get_feature_elem) {
+    $children_with_tag = 'farmos_wfs_get_xnode_children_with_tag';
+
+    $paging_params = [
+      'MAXFEATURES' => $get_feature_elem->getAttribute('maxFeatures'),
+      'STARTINDEX' => $get_feature_elem->getAttribute('startIndex')
+    ];
+
+    $max_features = parse_integer_param($paging_params, 'MAXFEATURES', 1);
+    $start_index = parse_integer_param($paging_params, 'STARTINDEX', 0) ?? 0;
+
+    $result_type = parse_result_type($get_feature_elem->getAttribute('resultType') ?: 'results');
+
+    $output_format = parse_output_format($get_feature_elem->getAttribute('outputFormat'));
+
+    $changed_since = $this->parse_changed_since(
+      $get_feature_elem->getAttribute('changedSince') ?: ($query_params['CHANGEDSINCE'] ?? ''));
+
+    $raw_simplification_tolerance = $get_feature_elem->getAttribute('simplify') ?: ($query_params['SIMPLIFY'] ?? '');
+
+    $queries = [];
+
+    foreach ($children_with_tag($get_feature_elem, 'Query') as $query_elem) {
+      $type_name = $query_elem->getAttribute('typeName');
+
+      list ($feature_types, $unknown_type_names) = $this->featureTypeFactoryValidator->type_names_string_to_validated_feature_types(
+        $type_name);
 
-    $filter_elem = null;
-    if ($filter) {
-      try {
-        $filter_doc = farmos_wfs_loadXml($filter);
-      } catch (\Exception $e) {
+      if (! empty($unknown_type_names) || count($feature_types) != 1) {
         throw new FarmWfsException(
           farmos_wfs_makeExceptionReport(
-            function ($eReport, $elem) use ($e) {
+            function ($eReport, $elem) use ($type_name) {
               $eReport->appendChild(
                 $elem('Exception', array(
                   "exceptionCode" => "InvalidParameterValue",
-                  "locator" => "filter"
-                ), $elem('ExceptionText', [], "Invalid filter parameter xml: {$e->getMessage()}")));
+                  "locator" => "typeName"
+                ), $elem('ExceptionText', [], "Each wfs:Query must name a single known feature type, but got '$type_name'")));
             }), 400);
       }
 
-      if (! $filter_doc->documentElement || $filter_doc->documentElement->localName != "Filter") {
+      $property_names = array_map(function ($property_name_elem) {
+        return $property_name_elem->nodeValue;
+      }, $children_with_tag($query_elem, 'PropertyName'));
+
+      $sort_by = implode(',',
+        array_map(
+          function ($sort_property_elem) use ($children_with_tag) {
+            $property_name = $children_with_tag($sort_property_elem, 'PropertyName')[0]->nodeValue ?? '';
+            $sort_order = $children_with_tag($sort_property_elem, 'SortOrder')[0]->nodeValue ?? 'ASC';
+
+            return trim($property_name) . ' ' . trim($sort_order);
+          }, $children_with_tag($children_with_tag($query_elem, 'SortBy')[0] ?? null, 'SortProperty')));
+
+      $filter_elem = $children_with_tag($query_elem, 'Filter')[0] ?? null;
+
+      // Without a BBOX parameter, 'auto' tolerances are derived from the extent the query's filter is restricted to
+      $simplification_tolerance = $this->parse_simplification_tolerance($raw_simplification_tolerance,
+        $filter_elem ? $this->filterQueryResolver->get_bbox($filter_elem) ?? [] : []);
+
+      $queries[] = [
+        'feature_type' => $feature_types[0],
+        'bbox' => [],
+        'filter_elem' => $filter_elem,
+        'property_plan' => $this->project_property_plan(
+          $this->featureTypePropertyPlanner->get_property_plan($feature_types[0]->getAssetType()),
+          parse_property_names(implode(',', $property_names))),
+        'sort_orders' => parse_sort_by($sort_by),
+        'changed_since' => $changed_since,
+        'simplification_tolerance' => $simplification_tolerance
+      ];
+    }
 
-        throw new FarmWfsException(
-          farmos_wfs_makeExceptionReport(
-            function ($eReport, $elem) {
-              $eReport->appendChild(
-                $elem('Exception', [],
-                  $elem('ExceptionText', [], "Could not understand filter parameter: root element must be a Filter")));
-            }), 400);
+    if (empty($queries)) {
+      throw new FarmWfsException(
+        farmos_wfs_makeExceptionReport(
+          function ($eReport, $elem) {
+            $eReport->appendChild(
+              $elem('Exception', array(
+                "exceptionCode" => "MissingParameterValue",
+                "locator" => "query"
+              ), $elem('ExceptionText', [], "A GetFeature request must contain at least one wfs:Query")));
+          }), 400);
+    }
+
+    return $this->respond($queries, $max_features, $start_index, $result_type, $output_format);
+  }
+
+  /**
+   * Answers a list of queries - each with the keys; feature_type, bbox, filter_elem, property_plan, and sort_orders - in
+   * a single feature collection.
+   *
+   * The features of each query follow those of the previous one and maxFeatures/startIndex apply to the whole list.
+   *
+   * The feature collection carries the request time as its timeStamp. All changes after it are still to be returned
+   * so it is the cursor for the next incremental request - see parse_changed_since.
+   */
+  private function respond(array $queries, ?int $max_features, int $start_index, string $result_type,
+    string $output_format) {
+    $current_request = $this->requestStack->getCurrentRequest();
+
+    $host = $current_request->getSchemeAndHttpHost();
+
+    $time_stamp = gmdate('Y-m-d\TH:i:s\Z', $this->time->getRequestTime());
+
+    $type_names = implode(',',
+      array_unique(array_map(function ($query) {
+        return $query['feature_type']->qualifiedTypeName();
+      }, $queries)));
+
+    list ($combined_asset_query, $asset_queries) = $this->profiler->measure('resolve',
+      function () use ($queries) {
+        $combined_asset_query = count($queries) > 1 ? $this->create_combined_query($queries) : null;
+
+        return [
+          $combined_asset_query,
+          $combined_asset_query ? [
+            $combined_asset_query
+          ] : array_map([
+            $this,
+            'create_feature_query'
+          ], $queries)
+        ];
+      });
+
+    if ($result_type == 'hits') {
+      $total_count = 0;
+
+      foreach ($asset_queries as $asset_query) {
+        $total_count += (int) $asset_query->countQuery()
+          ->execute()
+          ->fetchField();
+      }
+
+      $number_of_features = max(0, $total_count - $start_index);
+
+      if (isset($max_features)) {
+        $number_of_features = min($number_of_features, $max_features);
       }
 
-      $filter_elem = $filter_doc->documentElement;
+      if ($output_format == FARMOS_WFS_GEOJSON_OUTPUT_FORMAT) {
+        return new JsonResponse([
+          'type' => 'FeatureCollection',
+          'numberOfFeatures' => $number_of_features,
+          'timeStamp' => $time_stamp,
+          'features' => []
+        ]);
+      }
+
+      return farmos_wfs_makeDoc(
+        function ($doc, $elem) use ($host, $type_names, $number_of_features, $time_stamp) {
+          $doc->appendChild(
+            $elem('wfs:FeatureCollection',
+              $this->feature_collection_attributes($host, $type_names, $number_of_features, $time_stamp)));
+        });
+    }
+
+    $content_encoding = farmos_wfs_negotiate_content_encoding($current_request);
+
+    $deleted_feature_ids = $this->load_deleted_feature_ids($queries);
+
+    // Clients refreshing unchanged layers are answered before any features are fetched
+    $etag = $this->profiler->measure('etag',
+      function () use ($host, $queries, $asset_queries, $deleted_feature_ids, $max_features, $start_index,
+      $output_format, $content_encoding) {
+        return $this->feature_collection_etag($host, $queries, $asset_queries, $deleted_feature_ids, $max_features,
+          $start_index, $output_format, $content_encoding);
+      });
+
+    $not_modified_response = new Response();
+    $this->set_validation_headers($not_modified_response, $etag);
+
+    if ($not_modified_response->isNotModified($current_request)) {
+      return $not_modified_response;
     }
 
-    if (! empty($bbox) && $filter_elem) {
+    list ($feature_rows, $property_aliases) = $this->profiler->measure('fetch',
+      function () use ($combined_asset_query, $queries, $asset_queries, $max_features, $start_index) {
+        if ($combined_asset_query) {
+          return $this->fetch_combined_feature_rows($combined_asset_query, $queries, $max_features, $start_index);
+        }
+
+        return $this->fetch_feature_rows($queries, $asset_queries, $max_features, $start_index);
+      });
+
+    if ($output_format == FARMOS_WFS_GEOJSON_OUTPUT_FORMAT) {
+      return $this->set_validation_headers(
+        farmos_wfs_makeStreamedJsonResponse(
+          function ($write) use ($queries, $property_aliases, $feature_rows, $deleted_feature_ids, $time_stamp) {
+            $write(
+              '{"type":"FeatureCollection","numberOfFeatures":' . count($feature_rows) . ',"timeStamp":' .
+              json_encode($time_stamp) . ',"features":[');
+
+            $limits = array();
+            $is_first_feature = TRUE;
+
+            $this->each_feature($queries, $property_aliases, $feature_rows,
+              function ($query, $uuid, $property_values, $wkt, $bbox) use ($write, &$limits, &$is_first_feature) {
+                accumulate_limits($limits, $bbox);
+
+                $write(($is_first_feature ? '' : ',') .
+                  json_encode(
+                    geojson_feature($query['feature_type'], $query['property_plan'], $uuid, $property_values, $wkt, $bbox),
+                    JSON_UNESCAPED_SLASHES | JSON_UNESCAPED_UNICODE | JSON_PRESERVE_ZERO_FRACTION));
+
+                $is_first_feature = FALSE;
+              });
+
+            $write(']');
+
+            if (! empty($deleted_feature_ids)) {
+              $write(',"deletedFeatureIds":' . json_encode($deleted_feature_ids, JSON_UNESCAPED_SLASHES));
+            }
+
+            if (! empty($limits)) {
+              $write(',"bbox":' . json_encode(geojson_bbox($limits), JSON_PRESERVE_ZERO_FRACTION));
+            }
+
+            $write('}');
+          }, 200, $content_encoding), $etag);
+    }
+
+    return $this->set_validation_headers(
+      farmos_wfs_makeStreamedXmlResponse(
+        function ($writer, $elem, $flush) use ($host, $type_names, $queries, $property_aliases, $feature_rows,
+        $deleted_feature_ids, $time_stamp) {
+          $elem('wfs:FeatureCollection',
+            $this->feature_collection_attributes($host, $type_names, count($feature_rows), $time_stamp),
+            function ($writer, $elem) use ($flush, $queries, $property_aliases, $feature_rows, $deleted_feature_ids) {
+
+              $limits = array();
+
+              $this->each_feature($queries, $property_aliases, $feature_rows,
+                function ($query, $uuid, $property_values, $wkt, $bbox) use ($elem, $flush, &$limits) {
+                  accumulate_limits($limits, $bbox);
+
+                  $elem('gml:featureMember', [],
+                    function ($writer, $elem) use ($query, $uuid, $property_values, $wkt, $bbox) {
+                      $this->write_feature($elem, $query['feature_type'], $query['property_plan'], $uuid,
+                        $property_values, $wkt, $bbox);
+                    });
+
+                  // Hand each feature to the client as soon as it has been written
+                  $flush();
+                });
+
+              // Incremental responses list the features deleted since the cursor as a farmOS WFS extension
+              if (! empty($deleted_feature_ids)) {
+                $elem('farmos:deletedFeatures', [],
+                  function ($writer, $elem) use ($deleted_feature_ids) {
+                    foreach ($deleted_feature_ids as $deleted_feature_id) {
+                      $elem('ogc:FeatureId', array(
+                        'fid' => $deleted_feature_id
+                      ));
+                    }
+                  });
+              }
+
+              // The collection envelope can only be known once every feature has been written so it trails them
+              if (! empty($limits)) {
+                gml_bounded_by($limits, $elem);
+              }
+            });
+        }, 200, $content_encoding), $etag);
+  }
+
+  /**
+   * Derives a strong validator for a feature collection from the request and the state of the matched assets.
+   *
+   * The asset state is summarized by aggregate queries (see FarmWfsQueryFactory::load_change_state) so no features
+   * need to be fetched to tell whether a client's copy is still current.
+   */
+  private function feature_collection_etag(string $host, array $queries, array $asset_queries,
+    array $deleted_feature_ids, ?int $max_features, int $start_index, string $output_format, ?string $content_encoding) {
+    $signature = [
+      FARMOS_WFS_IMPLEMENTATION_VERSION,
+      $host,
+      $output_format,
+      $content_encoding,
+      $max_features,
+      $start_index,
+      $deleted_feature_ids
+    ];
+
+    $has_taxonomy_term_refs = FALSE;
+
+    foreach ($queries as $query) {
+      $signature[] = [
+        $query['feature_type']->qualifiedTypeName(),
+        $query['bbox'],
+        $query['filter_elem'] ? $query['filter_elem']->C14N() : null,
+        array_column($query['property_plan'], 'property_name'),
+        $query['sort_orders'],
+        $query['changed_since'],
+        $query['simplification_tolerance']
+      ];
+
+      $has_taxonomy_term_refs = $has_taxonomy_term_refs ||
+        in_array(TRUE, array_column($query['property_plan'], 'is_taxonomy_term_ref'), TRUE);
+    }
+
+    foreach ($asset_queries as $asset_query) {
+      $signature[] = $this->queryFactory->load_change_state($asset_query);
+    }
+
+    // Term references are serialized by name so renaming a term changes the features referencing it
+    if ($has_taxonomy_term_refs) {
+      $signature[] = $this->queryFactory->load_taxonomy_term_change_state();
+    }
+
+    return hash('sha256', serialize($signature));
+  }
+
+  /**
+   * Loads the ids of the features deleted since the cursor of incremental queries.
+   *
+   * Deleted assets are only known by their type so their ids are reported for each queried feature type of it.
+   */
+  private function load_deleted_feature_ids(array $queries) {
+    $deleted_feature_ids = [];
+
+    foreach ($queries as $query) {
+      if (! isset($query['changed_since'])) {
+        continue;
+      }
+
+      $feature_type = $query['feature_type'];
+
+      foreach ($this->assetTombstones->load_deleted_asset_uuids($feature_type->getAssetType(), $query['changed_since']) as $uuid) {
+        $deleted_feature_ids[] = "{$feature_type->unqualifiedTypeName()}.{$uuid}";
+      }
+    }
+
+    return array_values(array_unique($deleted_feature_ids));
+  }
+
+  /**
+   * Parses the CHANGEDSINCE vendor parameter - a Unix timestamp or an ISO 8601 date/time.
+   *
+   * @return int|null The cursor as a Unix timestamp or null if all features are requested.
+   */
+  private function parse_changed_since(string $raw_changed_since) {
+    $raw_changed_since = trim($raw_changed_since);
+
+    if ($raw_changed_since === '') {
+      return null;
+    }
+
+    $changed_since = ctype_digit($raw_changed_since) ? (int) $raw_changed_since : strtotime($raw_changed_since);
+
+    if ($changed_since === FALSE) {
       throw new FarmWfsException(
         farmos_wfs_makeExceptionReport(
           function ($eReport, $elem) {
             $eReport->appendChild(
               $elem('Exception', array(
                 "exceptionCode" => "InvalidParameterValue",
-                "locator" => "filter"
+                "locator" => "changedSince"
+              ), $elem('ExceptionText', [], "The changedSince parameter must be a Unix timestamp or an ISO 8601 date/time")));
+          }), 400);
+    }
+
+    // Deletions are only remembered for a while so older cursors cannot be answered incrementally
+    if ($changed_since < $this->assetTombstones->get_earliest_cursor()) {
+      throw new FarmWfsException(
+        farmos_wfs_makeExceptionReport(
+          function ($eReport, $elem) {
+            $eReport->appendChild(
+              $elem('Exception', array(
+                "exceptionCode" => "InvalidParameterValue",
+                "locator" => "changedSince"
               ),
                 $elem('ExceptionText', [],
-                  "Illegal request; please supply only one of the 'filter' or 'bbox' parameters")));
+                  "The changedSince parameter is older than the retained deletions; request all features instead")));
           }), 400);
     }
 
-    $asset_type = $feature_type->getAssetType();
+    return $changed_since;
+  }
+
+  /**
+   * Parses the SIMPLIFY vendor parameter - a tolerance in degrees or 'auto' to derive it from the extent of a bbox.
+   *
+   * @return float|null The bucketed tolerance (see FarmWfsGeometrySimplifier::bucket_tolerance) or null if geometries
+   *         should be served at full resolution.
+   */
+  private function parse_simplification_tolerance(string $raw_tolerance, array $bbox) {
+    $raw_tolerance = strtolower(trim($raw_tolerance));
+
+    if ($raw_tolerance === '') {
+      return null;
+    }
+
+    if ($raw_tolerance == 'auto' && count($bbox) >= 4) {
+      $extent = max(abs((float) $bbox[2] - (float) $bbox[0]), abs((float) $bbox[3] - (float) $bbox[1]));
+
+      $tolerance = $extent / FARMOS_WFS_AUTO_SIMPLIFICATION_RESOLUTION;
+    } elseif (is_numeric($raw_tolerance) && (float) $raw_tolerance >= 0) {
+      $tolerance = (float) $raw_tolerance;
+    } else {
+      throw new FarmWfsException(
+        farmos_wfs_makeExceptionReport(
+          function ($eReport, $elem) {
+            $eReport->appendChild(
+              $elem('Exception', array(
+                "exceptionCode" => "InvalidParameterValue",
+                "locator" => "simplify"
+              ),
+                $elem('ExceptionText', [],
+                  "The simplify parameter must be a non-negative tolerance in degrees or 'auto' together with a bbox or a filter restricted to a BBOX, Intersects, Within, or DWithin operation")));
+          }), 400);
+    }
+
+    return $tolerance > 0 ? $this->geometrySimplifier->bucket_tolerance($tolerance) : null;
+  }
+
+  private function set_validation_headers(Response $response, string $etag) {
+    $response->setPrivate();
+    $response->headers->addCacheControlDirective('no-cache');
+    $response->setEtag($etag);
+
+    return $response;
+  }
+
+  /**
+   * Invokes a callback with the uuid, property values, geometry, and bounding box of each feature row.
+   *
+   * This is shared by the output formats so they serialize the same features. Features whose asset is gone or whose
+   * geometry is empty are skipped.
+   */
+  private function each_feature(array $queries, array $property_aliases, array $feature_rows, callable $callback) {
+    $asset_storage = $this->entityTypeManager->getStorage('asset');
+
+    $batch_size = max(1, (int) ($this->configFactory->get('farmos_wfs.settings')
+      ->get('get_feature_batch_size') ?? 200));
+
+    // Only keep a bounded number of asset entities (and their field items) in memory at a time
+    foreach (array_chunk($feature_rows, $batch_size) as $batch_rows) {
+
+      // When only a few simple properties are requested, their values come straight from the query instead of the asset
+      // entities
+      $entity_asset_ids_by_query_index = [];
+
+      foreach ($batch_rows as $row) {
+        if (! isset($property_aliases[$row->query_index])) {
+          $entity_asset_ids_by_query_index[$row->query_index][] = $row->asset_id;
+        }
+      }
+
+      $batch_asset_ids = array_merge([], ...array_values($entity_asset_ids_by_query_index));
+
+      $assets = $this->profiler->measure('load', function () use ($asset_storage, $batch_asset_ids) {
+        return empty($batch_asset_ids) ? [] : $asset_storage->loadMultiple($batch_asset_ids);
+      });
+
+      list ($geometry_values, $simplified_geometry_values_by_tolerance) = $this->profiler->measure('geometry',
+        function () use ($queries, $batch_rows) {
+          $geometry_values = $this->queryFactory->load_geometry_values($batch_rows);
+
+          // Only the served geometries are simplified - the stored ones (which Transactions operate on) stay untouched.
+          // Each query may have its own tolerance so the same asset can be served at several of them.
+          $wkt_values_by_tolerance = [];
+
+          foreach ($batch_rows as $row) {
+            $tolerance = $queries[$row->query_index]['simplification_tolerance'];
+
+            if (isset($tolerance) && isset($geometry_values[$row->asset_id])) {
+              $wkt_values_by_tolerance[(string) $tolerance][$row->asset_id] = $geometry_values[$row->asset_id];
+            }
+          }
+
+          $simplified_geometry_values_by_tolerance = [];
+
+          foreach ($wkt_values_by_tolerance as $tolerance => $wkt_values) {
+            $simplified_geometry_values_by_tolerance[$tolerance] = $this->geometrySimplifier->simplify_wkt_values(
+              $wkt_values, (float) $tolerance);
+          }
+
+          return [
+            $geometry_values,
+            $simplified_geometry_values_by_tolerance
+          ];
+        });
+
+      $term_names = $this->profiler->measure('load',
+        function () use ($queries, $entity_asset_ids_by_query_index, $assets) {
+          $term_names = [];
+
+          foreach ($entity_asset_ids_by_query_index as $query_index => $asset_ids) {
+            $term_names += $this->load_referenced_term_names($queries[$query_index]['property_plan'],
+              array_intersect_key($assets, array_flip($asset_ids)));
+          }
+
+          return $term_names;
+        });
+
+      foreach ($batch_rows as $row) {
+
+        $row_property_aliases = $property_aliases[$row->query_index];
+
+        $tolerance = $queries[$row->query_index]['simplification_tolerance'];
+
+        if (isset($tolerance)) {
+          $wkt = $simplified_geometry_values_by_tolerance[(string) $tolerance][$row->asset_id] ?? null;
+        } else {
+          $wkt = $geometry_values[$row->asset_id] ?? null;
+        }
+
+        if (isset($row_property_aliases)) {
+          $uuid = $row->{$row_property_aliases['uuid']};
+          $property_values = function ($property) use ($row, $row_property_aliases) {
+            $value = $row->{$row_property_aliases[$property['field_id']]};
+
+            return isset($value) ? [
+              $property['formatter']($value)
+            ] : [];
+          };
+        } else {
+          $asset = $assets[$row->asset_id] ?? null;
+
+          // If the asset is gone, bail.
+          if (! $asset) {
+            continue;
+          }
+
+          $uuid = $asset->uuid();
+          $property_values = function ($property) use ($asset, $term_names) {
+            return $this->entity_property_values($property, $term_names, $asset);
+          };
+        }
+
+        // Empty geometries are already excluded by the query so this only happens if the location changed in the meantime
+        if (empty($wkt) || stripos($wkt, 'EMPTY') !== FALSE) {
+          continue;
+        }
+
+        // The bounding box is already indexed by geofield so it doesn't need to be derived from the geometry
+        $bbox = array(
+          'minx' => (float) $row->geometry_left,
+          'miny' => (float) $row->geometry_bottom,
+          'maxx' => (float) $row->geometry_right,
+          'maxy' => (float) $row->geometry_top
+        );
+
+        $this->profiler->count('features');
+
+        $callback($queries[$row->query_index], $uuid, $property_values, $wkt, $bbox);
+      }
+
+      if (! empty($assets)) {
+        $asset_storage->resetCache($batch_asset_ids);
+      }
+    }
+  }
+
+  /**
+   * Creates the query selecting the asset ids matched by a single query.
+   */
+  private function create_feature_query(array $query) {
+    $asset_type = $query['feature_type']->getAssetType();
     $geometry_types = [
-      $feature_type->getGeometryTypeName()
+      $query['feature_type']->getGeometryTypeName()
     ];
 
-    $asset_ids = [];
-    if (! empty($bbox)) {
-      $asset_ids = $this->bboxQueryResolver->resolve_query($asset_type, $geometry_types, $bbox);
-    } elseif ($filter_elem) {
-      $asset_ids = $this->filterQueryResolver->resolve_query($asset_type, $geometry_types, $filter_elem);
+    if (! empty($query['bbox'])) {
+      $asset_query = $this->bboxQueryResolver->create_query($asset_type, $geometry_types, $query['bbox']);
+    } elseif ($query['filter_elem']) {
+      $asset_query = $this->filterQueryResolver->create_query($asset_type, $geometry_types, $query['filter_elem']);
     } else {
-      $asset_ids = $this->simpleQueryResolver->resolve_query($asset_type, $geometry_types);
+      $asset_query = $this->simpleQueryResolver->create_query($asset_type, $geometry_types);
     }
 
-    $asset_storage = $this->entityTypeManager->getStorage('asset');
+    if (isset($query['changed_since'])) {
+      $asset_query->condition($this->queryFactory->create_changed_since_condition($asset_query, $query['changed_since']));
+    }
 
-    $assets = $asset_storage->loadMultiple($asset_ids);
+    return $this->add_sort_orders($asset_query, $query['sort_orders']);
+  }
 
-    return farmos_wfs_makeDoc(
-      function ($doc, $elem) use ($host, $query_params, $feature_type, $assets) {
-        $doc->appendChild(
-          $elem('wfs:FeatureCollection',
-            array(
-              "xmlns:farmos" => "https://farmos.org/wfs",
-              'xmlns:gml' => "http://www.opengis.net/gml",
-              'xmlns:wfs' => "http://www.opengis.net/wfs",
-              'xmlns:ogc' => "http://www.opengis.net/ogc",
-              'xmlns:xsi' => "http://www.w3.org/2001/XMLSchema-instance",
-              'xsi:schemaLocation' => "https://farmos.org/wfs " .
-              "$host/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=DescribeFeatureType&TYPENAME={$query_params['TYPENAME']}&OUTPUTFORMAT=text/xml;%20subtype=gml/3.1.1 " .
-              "http://www.opengis.net/wfs http://schemas.opengis.net/wfs/1.1.0/wfs.xsd"
-            ),
-            function ($featureCollection, $elem) use ($feature_type, $assets) {
+  /**
+   * Creates a single query selecting the asset ids matched by all the given queries.
+   *
+   * The (potentially expensive) base query - including the resolution of the latest movement logs - then only runs
+   * once. This requires that each query targets a different feature type so the matched rows can be told apart by their
+   * asset and geometry types, that all queries are sorted the same way, and that no exact spatial predicates need to be
+   * evaluated.
+   *
+   * The rows are tagged with the index of their query in a query_index column and ordered by it first so they come out
+   * in the same order as if the queries ran one after another - which lets the database do the paging.
+   *
+   * @return \Drupal\Core\Database\Query\SelectInterface|null The combined query or null if the queries cannot be
+   *         combined.
+   */
+  private function create_combined_query(array $queries) {
+    $feature_type_keys = array_map(function ($query) {
+      return feature_type_key($query['feature_type']->getAssetType(), $query['feature_type']->getGeometryTypeName());
+    }, $queries);
+
+    if (count(array_unique($feature_type_keys)) != count($feature_type_keys)) {
+      return null;
+    }
 
-              $limits = array();
-              $accumulate_limit = function ($source, $edge, $accumulator) use (&$limits) {
-                if (! isset($source[$edge])) {
-                  return;
-                }
-                if (! isset($limits[$edge])) {
-                  $limits[$edge] = (float) $source[$edge];
-                } else {
-                  $limits[$edge] = $accumulator((float) $source[$edge], $limits[$edge]);
-                }
-              };
+    $sort_orders = $queries[0]['sort_orders'];
 
-              foreach ($assets as $asset) {
+    foreach ($queries as $query) {
+      if ($query['sort_orders'] != $sort_orders) {
+        return null;
+      }
+    }
 
-                $wkt = $this->assetLocation->getGeometry($asset);
+    $asset_types = array_values(
+      array_unique(array_map(function ($query) {
+        return $query['feature_type']->getAssetType();
+      }, $queries)));
+
+    $geometry_types = array_values(
+      array_unique(array_map(function ($query) {
+        return $query['feature_type']->getGeometryTypeName();
+      }, $queries)));
+
+    $asset_query = $this->queryFactory->create_query(null, $geometry_types);
+
+    $asset_query->condition('asset.type', $asset_types, 'IN');
+
+    $queries_condition = $asset_query->orConditionGroup();
+
+    foreach ($queries as $query) {
+      $query_condition = $asset_query->andConditionGroup()
+        ->condition('asset.type', $query['feature_type']->getAssetType())
+        ->condition(
+        $this->queryFactory->create_geometry_type_condition($asset_query,
+          [
+            $query['feature_type']->getGeometryTypeName()
+          ]));
+
+      if (! empty($query['bbox'])) {
+        $query_condition->condition($this->queryFactory->create_bbox_condition($asset_query, $query['bbox']));
+      } elseif ($query['filter_elem']) {
+        $query_condition->condition(
+          $this->filterQueryResolver->create_condition($asset_query, $query['feature_type']->getAssetType(),
+            $query['filter_elem']));
+      }
 
-                // Get WKT from the field. If empty, bail.
-                if (empty($wkt)) {
-                  continue;
-                }
+      if (isset($query['changed_since'])) {
+        $query_condition->condition(
+          $this->queryFactory->create_changed_since_condition($asset_query, $query['changed_since']));
+      }
 
-                $geom = \geoPHP::load($wkt, 'wkt');
+      $queries_condition->condition($query_condition);
+    }
 
-                // If the geometry is empty, bail.
-                if ($geom->isEmpty()) {
-                  continue;
-                }
+    if (! empty($asset_query->getMetaData('farmos_wfs_spatial_predicates'))) {
+      return null;
+    }
 
-                $bbox = $geom->getBBox();
+    $asset_query->condition($queries_condition);
 
-                $accumulate_limit($bbox, 'minx', 'min');
-                $accumulate_limit($bbox, 'miny', 'min');
-                $accumulate_limit($bbox, 'maxy', 'max');
-                $accumulate_limit($bbox, 'maxx', 'max');
+    $geometry_type_expression = $this->queryFactory->get_geometry_column_expression($asset_query, 'geo_type');
 
-                $featureCollection->appendChild(
-                  $elem('gml:featureMember', [],
-                    function ($featureMember, $elem) use ($feature_type, $asset, $geom, $bbox) {
+    $query_index_cases = [];
+    $query_index_args = [];
 
-                      $featureMember->appendChild(
-                        $elem($feature_type->qualifiedTypeName(),
-                          array(
-                            'gml:id' => "{$feature_type->unqualifiedTypeName()}.{$asset->uuid()}"
-                          ),
-                          function ($feature, $elem) use ($asset, $geom, $bbox) {
+    foreach ($queries as $query_index => $query) {
+      $query_index_cases[] = "WHEN asset.type = :farmos_wfs_query_asset_type_$query_index AND $geometry_type_expression = :farmos_wfs_query_geometry_type_$query_index THEN $query_index";
+      $query_index_args[":farmos_wfs_query_asset_type_$query_index"] = $query['feature_type']->getAssetType();
+      $query_index_args[":farmos_wfs_query_geometry_type_$query_index"] = $query['feature_type']->getGeometryTypeName();
+    }
 
-                            $feature->appendChild(gml_bounded_by($bbox, $elem));
+    $asset_query->addExpression('CASE ' . implode(' ', $query_index_cases) . ' END', 'query_index', $query_index_args);
+    $asset_query->orderBy('query_index');
 
-                            $feature->appendChild(
-                              $elem('farmos:geometry', [],
-                                function ($geometry, $elem) use ($asset, $geom) {
+    return $this->add_sort_orders($asset_query, $sort_orders);
+  }
 
-                                  $geometry->appendChild(geophp_to_gml_three_point_one_point_one($geom, $elem));
-                                }));
+  private function add_sort_orders(SelectInterface $asset_query, array $sort_orders) {
+    foreach ($sort_orders as list ($sort_column, $sort_direction)) {
+      $asset_query->orderBy($sort_column, $sort_direction);
+    }
 
-                            $field_definitions = $asset->getFieldDefinitions();
+    // Break ties by the asset id so that paging through the results with startIndex is stable
+    if (! in_array('asset.id', array_column($sort_orders, 0))) {
+      $asset_query->orderBy('asset.id');
+    }
 
-                            foreach ($field_definitions as $field_id => $field_definition) {
+    return $asset_query;
+  }
 
-                              $field_type = $field_definition->getType();
+  /**
+   * Fetches the feature rows of each query in turn.
+   *
+   * @return array The feature rows - tagged with the index of their query - and the property value column aliases (see
+   *         FarmWfsQueryFactory::add_property_fields) keyed by query index.
+   */
+  private function fetch_feature_rows(array $queries, array $asset_queries, ?int $max_features, int $start_index) {
+    $feature_rows = [];
+    $property_aliases = [];
+
+    foreach ($queries as $query_index => $query) {
+      if (isset($max_features) && count($feature_rows) >= $max_features) {
+        break;
+      }
 
-                              $supported_field_types = [
-                                'string',
-                                'text_long',
-                                'timestamp',
-                                'boolean',
-                                'uuid',
-                                'list_string',
-                                'string_long',
-                                'integer',
-                                'state',
-                              ];
+      $asset_query = $asset_queries[$query_index];
 
-                              if ($field_definition->isReadOnly()) {
-                                $property_name = 'farmos:__' . $field_id;
-                              } else {
-                                $property_name = 'farmos:' . $field_id;
-                              }
+      // Skip whole queries whose features all lie before the start index
+      if ($start_index > 0) {
+        $count = (int) $asset_query->countQuery()
+          ->execute()
+          ->fetchField();
 
-                              if ($field_type == "entity_reference" && $field_definition->getSetting('target_type') == "taxonomy_term") {
-                                $ref_entities = $asset->get($field_id)->referencedEntities();
+        if ($count <= $start_index) {
+          $start_index -= $count;
+          continue;
+        }
+      }
 
-                                foreach ($ref_entities as $ref_entity) {
-                                  $feature->appendChild($elem($property_name, [], $ref_entity->get('name')->getValue()[0]['value']));
-                                }
-                              }
+      if (isset($max_features) || $start_index > 0) {
+        $asset_query->range($start_index, isset($max_features) ? $max_features - count($feature_rows) : PHP_INT_MAX);
+      }
 
-                              if (in_array($field_type, $supported_field_types)) {
+      $start_index = 0;
 
-                                $field_data = $asset->get($field_id);
+      $this->queryFactory->add_geometry_fields($asset_query);
 
-                                if ($field_data->isEmpty()) {
-                                  continue;
-                                }
+      $property_aliases[$query_index] = $this->queryFactory->add_property_fields($asset_query, $query['property_plan']);
 
-                                foreach ($field_data as $item) {
-                                  $property_value = $item->getValue()['value'];
+      foreach ($asset_query->execute() as $row) {
+        $row->query_index = $query_index;
+        $feature_rows[] = $row;
+      }
+    }
+
+    return [
+      $feature_rows,
+      $property_aliases
+    ];
+  }
 
-                                  if ($field_type == 'timestamp') {
-                                    $datetime = new \DateTime("@{$property_value}");
+  /**
+   * Fetches the feature rows of all queries from a query created by create_combined_query.
+   *
+   * @return array The feature rows - tagged with the index of their query - and the property value column aliases (see
+   *         FarmWfsQueryFactory::add_property_fields) keyed by query index.
+   */
+  private function fetch_combined_feature_rows(SelectInterface $combined_asset_query, array $queries,
+    ?int $max_features, int $start_index) {
+    $this->queryFactory->add_geometry_fields($combined_asset_query);
+
+    $combined_property_plan = [];
+
+    foreach ($queries as $query) {
+      foreach ($query['property_plan'] as $property) {
+        $combined_property_plan[$property['field_id']] = $property;
+      }
+    }
 
-                                    $property_value = $datetime->format(\DateTime::ISO8601);
-                                  }
+    $property_aliases = $this->queryFactory->add_property_fields($combined_asset_query,
+      array_values($combined_property_plan));
 
-                                  $feature->appendChild($elem($property_name, [], $property_value));
-                                }
-                              }
-                            }
-                          }));
-                    }));
-              }
+    if (isset($max_features) || $start_index > 0) {
+      $combined_asset_query->range($start_index, $max_features ?? PHP_INT_MAX);
+    }
 
-              if (! empty($limits)) {
-                $featureCollection->appendChild(gml_bounded_by($limits, $elem));
-              }
-            }));
+    $feature_rows = [];
+
+    foreach ($combined_asset_query->execute() as $row) {
+      $row->query_index = (int) $row->query_index;
+      $feature_rows[] = $row;
+    }
+
+    return [
+      $feature_rows,
+      array_fill_keys(array_keys($queries), $property_aliases)
+    ];
+  }
+
+  /**
+   * Loads the names of all taxonomy terms referenced by a batch of assets at once.
+   */
+  private function load_referenced_term_names(array $property_plan, array $assets) {
+    $term_ids = [];
+
+    foreach ($property_plan as $property) {
+
+      if (! $property['is_taxonomy_term_ref']) {
+        continue;
+      }
+
+      foreach ($assets as $asset) {
+        foreach ($asset->get($property['field_id']) as $item) {
+          if (isset($item->target_id)) {
+            $term_ids[$item->target_id] = TRUE;
+          }
+        }
+      }
+    }
+
+    return $this->queryFactory->load_taxonomy_term_names(array_keys($term_ids));
+  }
+
+  /**
+   * Restricts a property plan to the properties requested via the PROPERTYNAME parameter.
+   *
+   * Required properties are always included as are the geometries.
+   */
+  private function project_property_plan(array $property_plan, ?array $property_names) {
+    if (! isset($property_names)) {
+      return $property_plan;
+    }
+
+    $known_property_names = [
+      'geometry'
+    ];
+
+    foreach ($property_plan as $property) {
+      $known_property_names[] = $property['property_name'];
+      $known_property_names[] = $property['field_id'];
+    }
+
+    $unknown_property_names = array_diff($property_names, $known_property_names);
+
+    if (! empty($unknown_property_names)) {
+      $unknown_property_names_str = implode(', ', $unknown_property_names);
+
+      throw new FarmWfsException(
+        farmos_wfs_makeExceptionReport(
+          function ($eReport, $elem) use ($unknown_property_names_str) {
+            $eReport->appendChild(
+              $elem('Exception', array(
+                "exceptionCode" => "InvalidParameterValue",
+                "locator" => "propertyName"
+              ), $elem('ExceptionText', [], "Unknown properties: $unknown_property_names_str")));
+          }), 400);
+    }
+
+    return array_values(
+      array_filter($property_plan,
+        function ($property) use ($property_names) {
+          return $property['is_required'] || in_array($property['property_name'], $property_names) ||
+            in_array($property['field_id'], $property_names);
+        }));
+  }
+
+  /**
+   * Gets the serialized values of a property from an asset entity.
+   */
+  private function entity_property_values(array $property, array $term_names, $asset) {
+    $values = [];
+
+    foreach ($asset->get($property['field_id']) as $item) {
+      if ($property['is_taxonomy_term_ref']) {
+        if (isset($term_names[$item->target_id])) {
+          $values[] = (string) $term_names[$item->target_id];
+        }
+        continue;
+      }
+
+      $values[] = $property['formatter']($item->getValue()['value']);
+    }
+
+    return $values;
+  }
+
+  /**
+   * Writes a feature element.
+   *
+   * @param callable $property_values
+   *          Called with each entry of the property plan to get the serialized values of that property.
+   */
+  private function write_feature($elem, $feature_type, array $property_plan, string $uuid, callable $property_values,
+    string $wkt, array $bbox) {
+    $elem($feature_type->qualifiedTypeName(),
+      array(
+        'gml:id' => "{$feature_type->unqualifiedTypeName()}.{$uuid}"
+      ),
+      function ($writer, $elem) use ($property_plan, $property_values, $wkt, $bbox) {
+
+        gml_bounded_by($bbox, $elem);
+
+        $elem('farmos:geometry', [],
+          function ($writer, $elem) use ($wkt) {
+
+            wkt_to_gml_three_point_one_point_one($wkt, $elem);
+          });
+
+        foreach ($property_plan as $property) {
+          foreach ($property_values($property) as $value) {
+            $elem($property['element_name'], [], $value);
+          }
+        }
       });
   }
+
+  private function feature_collection_attributes($host, string $type_names, int $number_of_features,
+    string $time_stamp) {
+    return array(
+      "xmlns:farmos" => "https://farmos.org/wfs",
+      'xmlns:gml' => "http://www.opengis.net/gml",
+      'xmlns:wfs' => "http://www.opengis.net/wfs",
+      'xmlns:ogc' => "http://www.opengis.net/ogc",
+      'xmlns:xsi' => "http://www.w3.org/2001/XMLSchema-instance",
+      'xsi:schemaLocation' => "https://farmos.org/wfs " .
+      "$host/wfs?SERVICE=WFS&VERSION=1.1.0&REQUEST=DescribeFeatureType&TYPENAME={$type_names}&OUTPUTFORMAT=text/xml;%20subtype=gml/3.1.1 " .
+      "http://www.opengis.net/wfs http://schemas.opengis.net/wfs/1.1.0/wfs.xsd",
+      'numberOfFeatures' => "$number_of_features",
+      'timeStamp' => $time_stamp
+    );
+  }
+}
+
+function parse_integer_param(array $query_params, string $param_name, int $minimum_value) {
+  $raw_value = $query_params[$param_name] ?? null;
+
+  if (! isset($raw_value) || $raw_value === '') {
+    return null;
+  }
+
+  if (! ctype_digit($raw_value) || (int) $raw_value < $minimum_value) {
+    throw new FarmWfsException(
+      farmos_wfs_makeExceptionReport(
+        function ($eReport, $elem) use ($param_name, $minimum_value) {
+          $eReport->appendChild(
+            $elem('Exception', array(
+              "exceptionCode" => "InvalidParameterValue",
+              "locator" => strtolower($param_name)
+            ),
+              $elem('ExceptionText', [],
+                "The $param_name parameter must be an integer greater than or equal to $minimum_value")));
+        }), 400);
+  }
+
+  return (int) $raw_value;
+}
+
+/**
+ * Parses a SORTBY parameter value - e.g. "changed DESC,name" or "farmos:changed D".
+ *
+ * @return array A list of [column, direction] pairs.
+ */
+function parse_sort_by(string $raw_sort_by) {
+  $raw_sort_by = trim($raw_sort_by);
+
+  if ($raw_sort_by === '') {
+    return [];
+  }
+
+  $sort_orders = [];
+
+  foreach (explode(',', $raw_sort_by) as $raw_sort_order) {
+    $sort_order_parts = preg_split('/\s+/', trim($raw_sort_order));
+
+    // Read-only properties are served with a '__' prefix - e.g. '__changed'
+    $property_name = preg_replace('/^(.*:)?(__)?/', '', $sort_order_parts[0]);
+
+    $sort_direction = [
+      'A' => 'ASC',
+      'ASC' => 'ASC',
+      'D' => 'DESC',
+      'DESC' => 'DESC'
+    ][strtoupper($sort_order_parts[1] ?? 'ASC')] ?? null;
+
+    $sort_column = FARMOS_WFS_SORTABLE_PROPERTIES[$property_name] ?? null;
+
+    if (! $sort_column || ! $sort_direction || count($sort_order_parts) > 2) {
+      throw new FarmWfsException(
+        farmos_wfs_makeExceptionReport(
+          function ($eReport, $elem) use ($raw_sort_order) {
+            $sortable_properties_str = implode(', ', array_keys(FARMOS_WFS_SORTABLE_PROPERTIES));
+
+            $eReport->appendChild(
+              $elem('Exception', array(
+                "exceptionCode" => "InvalidParameterValue",
+                "locator" => "sortBy"
+              ),
+                $elem('ExceptionText', [],
+                  "Unsupported sort order '$raw_sort_order'. Results can be sorted by; $sortable_properties_str - ascending (A) or descending (D)")));
+          }), 400);
+    }
+
+    $sort_orders[] = [
+      $sort_column,
+      $sort_direction
+    ];
+  }
+
+  return $sort_orders;
+}
+
+/**
+ * Parses a PROPERTYNAME parameter value - e.g. "farmos:name,farmos:geometry" or "(name,geometry)".
+ *
+ * @return array|null The unqualified property names or null if no properties were specified.
+ */
+function parse_property_names(string $raw_property_names) {
+  $raw_property_names = trim($raw_property_names);
+
+  if ($raw_property_names === '' || $raw_property_names == '*') {
+    return null;
+  }
+
+  return array_values(
+    array_filter(
+      array_map(function ($raw_property_name) {
+        return preg_replace('/^.*[\/:]/', '', trim($raw_property_name));
+      }, preg_split('/[,()]/', $raw_property_names))));
+}
+
+function parse_result_type(string $result_type) {
+  if (! in_array($result_type, [
+    'results',
+    'hits'
+  ])) {
+    throw new FarmWfsException(
+      farmos_wfs_makeExceptionReport(
+        function ($eReport, $elem) {
+          $eReport->appendChild(
+            $elem('Exception', array(
+              "exceptionCode" => "InvalidParameterValue",
+              "locator" => "resultType"
+            ), $elem('ExceptionText', [], "The resultType parameter must be one of 'results' or 'hits'")));
+        }), 400);
+  }
+
+  return $result_type;
+}
+
+/**
+ * Parses an outputFormat parameter value into one of the supported output formats - GML 3.1.1 by default.
+ */
+function parse_output_format(string $output_format) {
+  $normalized_output_format = strtolower(str_replace(' ', '', trim($output_format)));
+
+  if (in_array($normalized_output_format, [
+    '',
+    'text/xml;subtype=gml/3.1.1',
+    'text/xml',
+    'gml3'
+  ])) {
+    return FARMOS_WFS_GML_OUTPUT_FORMAT;
+  }
+
+  if (in_array($normalized_output_format, [
+    'application/json',
+    'application/geo+json',
+    'json',
+    'geojson'
+  ])) {
+    return FARMOS_WFS_GEOJSON_OUTPUT_FORMAT;
+  }
+
+  throw new FarmWfsException(
+    farmos_wfs_makeExceptionReport(
+      function ($eReport, $elem) use ($output_format) {
+        $eReport->appendChild(
+          $elem('Exception', array(
+            "exceptionCode" => "InvalidParameterValue",
+            "locator" => "outputFormat"
+          ), $elem('ExceptionText', [], "Unsupported outputFormat '$output_format'")));
+      }), 400);
+}
+
+function parse_filter_xml(string $filter) {
+  try {
+    $filter_doc = farmos_wfs_loadXml($filter);
+  } catch (\Exception $e) {
+    throw new FarmWfsException(
+      farmos_wfs_makeExceptionReport(
+        function ($eReport, $elem) use ($e) {
+          $eReport->appendChild(
+            $elem('Exception', array(
+              "exceptionCode" => "InvalidParameterValue",
+              "locator" => "filter"
+            ), $elem('ExceptionText', [], "Invalid filter parameter xml: {$e->getMessage()}")));
+        }), 400);
+  }
+
+  if (! $filter_doc->documentElement || $filter_doc->documentElement->localName != "Filter") {
+
+    throw new FarmWfsException(
+      farmos_wfs_makeExceptionReport(
+        function ($eReport, $elem) {
+          $eReport->appendChild(
+            $elem('Exception', [],
+              $elem('ExceptionText', [], "Could not understand filter parameter: root element must be a Filter")));
+        }), 400);
+  }
+
+  return $filter_doc->documentElement;
+}
+
+/**
+ * Splits a parameter value into the values for each of several requested types.
+ *
+ * Per type values are given as a parenthesized list - e.g. "(name,geometry)(status)". Otherwise the same value applies
+ * to every type.
+ *
+ * @return array The values for each type.
+ */
+function split_parenthesized_param_values(string $raw_value, int $type_count, string $locator) {
+  $raw_value = trim($raw_value);
+
+  if (substr($raw_value, 0, 1) != '(') {
+    return array_fill(0, $type_count, $raw_value);
+  }
+
+  $matches = [];
+  preg_match_all('/\((?<value>(?:[^()]++|\((?&value)\))*)\)/', $raw_value, $matches);
+
+  if (count($matches['value']) != $type_count) {
+    throw new FarmWfsException(
+      farmos_wfs_makeExceptionReport(
+        function ($eReport, $elem) use ($locator, $type_count) {
+          $eReport->appendChild(
+            $elem('Exception', array(
+              "exceptionCode" => "InvalidParameterValue",
+              "locator" => $locator
+            ), $elem('ExceptionText', [], "Expected a parenthesized $locator value for each of the $type_count types")));
+        }), 400);
+  }
+
+  return $matches['value'];
+}
+
+function feature_type_key(string $asset_type, string $geometry_type_name) {
+  return "$asset_type:$geometry_type_name";
+}
+
+function accumulate_limits(array &$limits, array $bbox) {
+  foreach ([
+    'minx' => 'min',
+    'miny' => 'min',
+    'maxx' => 'max',
+    'maxy' => 'max'
+  ] as $edge => $accumulator) {
+    $limits[$edge] = isset($limits[$edge]) ? $accumulator($bbox[$edge], $limits[$edge]) : $bbox[$edge];
+  }
 }
 
 function gml_bounded_by($limits, $elem) {
-  return $elem('gml:boundedBy', [],
-    function ($boundedBy, $elem) use ($limits) {
-
-      $boundedBy->appendChild(
-        $elem('gml:Envelope', array(
-          'srsName' => FARMOS_WFS_DEFAULT_CRS
-        ),
-          function ($envelope, $elem) use ($limits) {
-            $envelope->appendChild($elem('gml:lowerCorner', [], "{$limits['minx']} {$limits['miny']}"));
-            $envelope->appendChild($elem('gml:upperCorner', [], "{$limits['maxx']} {$limits['maxy']}"));
-          }));
+  $elem('gml:boundedBy', [],
+    function ($writer, $elem) use ($limits) {
+
+      $elem('gml:Envelope', array(
+        'srsName' => FARMOS_WFS_DEFAULT_CRS
+      ),
+        function ($writer, $elem) use ($limits) {
+          $elem('gml:lowerCorner', [], "{$limits['minx']} {$limits['miny']}");
+          $elem('gml:upperCorner', [], "{$limits['maxx']} {$limits['maxy']}");
+        });
     });
 }
 
-function geophp_to_gml_three_point_one_point_one(Geometry $geometry, $elem) {
-  // TODO: Consider refactoring to reduce duplication in these cases
-  switch ($geometry->geometryType()) {
+/**
+ * Writes a WKT geometry as GML 3.1.1 without building a geoPHP object graph for it.
+ */
+function wkt_to_gml_three_point_one_point_one(string $wkt, $elem) {
+  $matches = [];
+  if (! preg_match('/^\s*(?P<type>\w+)\s*\((?P<body>.*)\)\s*$/s', $wkt, $matches)) {
+    throw new \Exception("Unsupported WKT geometry: $wkt");
+  }
+
+  $geometry_type = FARMOS_WFS_RECOGNIZED_GEOMETRY_TYPES_LOWERCASE_TO_UPPERCASE[strtolower($matches['type'])] ?? $matches['type'];
+
+  switch ($geometry_type) {
     case 'Point':
 
-      return $elem('gml:Point', array(
+      $elem('gml:Point', array(
         'srsName' => FARMOS_WFS_DEFAULT_CRS
       ),
-        function ($point, $elem) use ($geometry) {
+        function ($writer, $elem) use ($matches) {
 
-          $point->appendChild(
-            $elem('gml:pos', array(
-              'srsDimension' => '2'
-            ), function ($pos, $elem) use ($geometry) {
-
-              $pos->nodeValue = $geometry->getX() . ' ' . $geometry->getY();
-            }));
+          $elem('gml:pos', array(
+            'srsDimension' => '2'
+          ), wkt_coordinates_to_pos_list($matches['body']));
         });
+      break;
+
     case 'LineString':
 
-      return $elem('gml:LineString', array(
+      $elem('gml:LineString', array(
         'srsName' => FARMOS_WFS_DEFAULT_CRS
       ),
-        function ($lineString, $elem) use ($geometry) {
-
-          $lineString->appendChild(
-            $elem('gml:posList', array(
-              'srsDimension' => '2'
-            ),
-              function ($posList, $elem) use ($geometry) {
+        function ($writer, $elem) use ($matches) {
 
-                $posList->nodeValue = implode(' ',
-                  array_map(function ($point) {
-                    return $point->getX() . ' ' . $point->getY();
-                  }, $geometry->getPoints()));
-              }));
+          $elem('gml:posList', array(
+            'srsDimension' => '2'
+          ), wkt_coordinates_to_pos_list($matches['body']));
         });
+      break;
 
     case 'Polygon':
 
-      return $elem('gml:Polygon', array(
+      $rings = preg_split('/\)\s*,\s*\(/', trim(trim($matches['body']), '()'));
+
+      $elem('gml:Polygon', array(
         'srsName' => FARMOS_WFS_DEFAULT_CRS
       ),
-        function ($polygon, $elem) use ($geometry) {
-
-          foreach ($geometry->getComponents() as $ringIdx => $ring) {
-
-            $polygon->appendChild(
-              $elem($ringIdx == 0 ? 'gml:exterior' : 'gml:interior', [],
-                function ($surface, $elem) use ($ring) {
-
-                  $surface->appendChild(
-                    $elem('gml:LinearRing', [],
-                      function ($linearRing, $elem) use ($ring) {
-
-                        $linearRing->appendChild(
-                          $elem('gml:posList', array(
-                            'srsDimension' => '2'
-                          ),
-                            function ($posList, $elem) use ($ring) {
-
-                              $posList->nodeValue = implode(' ',
-                                array_map(function ($point) {
-                                  return $point->getX() . ' ' . $point->getY();
-                                }, $ring->getPoints()));
-                            }));
-                      }));
-                }));
+        function ($writer, $elem) use ($rings) {
+
+          foreach ($rings as $ringIdx => $ring) {
+
+            $elem($ringIdx == 0 ? 'gml:exterior' : 'gml:interior', [],
+              function ($writer, $elem) use ($ring) {
+
+                $elem('gml:LinearRing', [],
+                  function ($writer, $elem) use ($ring) {
+
+                    $elem('gml:posList', array(
+                      'srsDimension' => '2'
+                    ), wkt_coordinates_to_pos_list($ring));
+                  });
+              });
           }
         });
+      break;
+
+    default:
+      throw new \Exception("Unsupported geometry type: $geometry_type");
+  }
+}
+
+/**
+ * Converts a WKT coordinate sequence like "1 2, 3 4" into a GML posList like "1 2 3 4".
+ */
+function wkt_coordinates_to_pos_list(string $coordinates) {
+  return preg_replace('/\s*,\s*|\s+/', ' ', trim($coordinates));
+}
+
+/**
+ * Builds a GeoJSON feature from the same values which are written as a GML feature by write_feature.
+ */
+function geojson_feature($feature_type, array $property_plan, string $uuid, callable $property_values, string $wkt,
+  array $bbox) {
+  $properties = [];
+
+  foreach ($property_plan as $property) {
+    $values = array_map(function ($value) use ($property) {
+      return geojson_property_value($property, $value);
+    }, $property_values($property));
+
+    $properties[$property['property_name']] = $property['cardinality'] == 1 ? ($values[0] ?? null) : $values;
+  }
+
+  return [
+    'type' => 'Feature',
+    'id' => "{$feature_type->unqualifiedTypeName()}.{$uuid}",
+    'bbox' => geojson_bbox($bbox),
+    'geometry' => wkt_to_geojson_geometry($wkt),
+    'properties' => $properties
+  ];
+}
+
+function geojson_property_value(array $property, string $value) {
+  switch ($property['schema_type']) {
+    case 'boolean':
+      return in_array(strtolower($value), [
+        '1',
+        'true'
+      ]);
+
+    case 'integer':
+      return (int) $value;
+
+    default:
+      return $value;
+  }
+}
+
+function geojson_bbox(array $limits) {
+  return [
+    $limits['minx'],
+    $limits['miny'],
+    $limits['maxx'],
+    $limits['maxy']
+  ];
+}
+
+/**
+ * Converts a WKT geometry to a GeoJSON geometry without building a geoPHP object graph for it.
+ */
+function wkt_to_geojson_geometry(string $wkt) {
+  $matches = [];
+  if (! preg_match('/^\s*(?P<type>\w+)\s*\((?P<body>.*)\)\s*$/s', $wkt, $matches)) {
+    throw new \Exception("Unsupported WKT geometry: $wkt");
+  }
+
+  $geometry_type = FARMOS_WFS_RECOGNIZED_GEOMETRY_TYPES_LOWERCASE_TO_UPPERCASE[strtolower($matches['type'])] ?? $matches['type'];
+
+  switch ($geometry_type) {
+    case 'Point':
+      $coordinates = wkt_coordinates_to_positions($matches['body'])[0];
+      break;
+
+    case 'LineString':
+      $coordinates = wkt_coordinates_to_positions($matches['body']);
+      break;
+
+    case 'Polygon':
+      $coordinates = array_map('Drupal\farmos_wfs\Handler\wkt_coordinates_to_positions',
+        preg_split('/\)\s*,\s*\(/', trim(trim($matches['body']), '()')));
+      break;
 
     default:
-      throw new \Exception("Unsupported geometry type: {$geometry->geometryType()}");
+      throw new \Exception("Unsupported geometry type: $geometry_type");
   }
+
+  return [
+    'type' => $geometry_type,
+    'coordinates' => $coordinates
+  ];
+}
+
+/**
+ * Converts a WKT coordinate sequence like "1 2, 3 4" into a list of GeoJSON positions like [[1, 2], [3, 4]].
+ */
+function wkt_coordinates_to_positions(string $coordinates) {
+  return array_map(function ($coordinate) {
+    return array_map('floatval', preg_split('/\s+/', trim($coordinate)));
+  }, explode(',', $coordinates));
 }
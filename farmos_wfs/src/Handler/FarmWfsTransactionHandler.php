@@ -2,11 +2,13 @@
 
 namespace Drupal\farmos_wfs\Handler;
 
+use Drupal\Core\Database\Connection;
 use Drupal\Core\Entity\EntityFieldManagerInterface;
 use Drupal\Core\Entity\EntityTypeManagerInterface;
 use Drupal\asset\Entity\Asset;
 use Drupal\farmos_wfs\FarmWfsFeatureType;
 use Drupal\farmos_wfs\FarmWfsFeatureTypeFactoryValidator;
+use Drupal\farmos_wfs\FarmWfsProfiler;
 use Drupal\farmos_wfs\Exception\FarmWfsException;
 use Drupal\farmos_wfs\QueryResolver\FarmWfsFilterQueryResolver;
 
@@ -23,46 +25,79 @@ class FarmWfsTransactionHandler {
 
   protected $filterQueryResolver;
 
+  protected $connection;
+
+  protected $profiler;
+
   public function __construct(EntityTypeManagerInterface $entity_type_manager,
     EntityFieldManagerInterface $entity_field_manager,
     FarmWfsFeatureTypeFactoryValidator $feature_type_factory_validator,
-    FarmWfsFilterQueryResolver $filter_query_resolver) {
+    FarmWfsFilterQueryResolver $filter_query_resolver, Connection $connection, FarmWfsProfiler $profiler) {
     $this->entityTypeManager = $entity_type_manager;
     $this->entityFieldManager = $entity_field_manager;
     $this->featureTypeFactoryValidator = $feature_type_factory_validator;
     $this->filterQueryResolver = $filter_query_resolver;
+    $this->connection = $connection;
+    $this->profiler = $profiler;
   }
 
+  /**
+   * Handles a wfs:Transaction request.
+   *
+   * Transactions are processed in two phases. First the whole document is parsed into operation records and the
+   * resulting entities are built and validated without writing anything. Then the validated operations are applied in a
+   * single database transaction with the cache tags invalidated by the saved entities only being invalidated once it has
+   * been committed. With releaseAction="ALL" (the default) any failing feature rejects the whole transaction - before
+   * any writes if it fails validation - while with releaseAction="SOME" only the failing features are skipped or rolled
+   * back to their savepoint and the remaining features are still committed.
+   */
   public function handle(array $query_params, \DOMElement $transaction_elem) {
-    $action_handlers = array(
-      'Insert' => 'handle_insert',
-      'Update' => 'handle_update',
-      'Delete' => 'handle_delete'
-    );
+    $release_action = strtoupper($transaction_elem->getAttribute('releaseAction') ?: 'ALL');
 
-    $set_asset_property_method = $this->create_asset_property_setter();
+    if (! in_array($release_action, [
+      'ALL',
+      'SOME'
+    ])) {
+      throw new FarmWfsException(
+        farmos_wfs_makeExceptionReport(
+          function ($eReport, $elem) use ($release_action) {
+            $eReport->appendChild(
+              $elem('Exception', array(
+                'exceptionCode' => "InvalidParameterValue",
+                'locator' => "releaseAction"
+              ), $elem('ExceptionText', [], "Unsupported releaseAction '$release_action': must be one of ALL or SOME")));
+          }), 400);
+    }
 
-    $transactionResults = new TransactionResults();
+    $transactionResults = new TransactionResults($release_action == 'ALL');
 
-    foreach ($transaction_elem->childNodes as $transaction_action_elem) {
+    $taxonomy_term_lookup = new TaxonomyTermLookup($this->entityTypeManager->getStorage('taxonomy_term'));
 
-      if ($transaction_action_elem instanceof \DOMText && $transaction_action_elem->isWhitespaceInElementContent()) {
-        continue;
-      }
+    // Phase one - parse the document and build/validate the changed entities without writing anything
+    $operations = $this->profiler->measure('prepare',
+      function () use ($transaction_elem, $transactionResults, $taxonomy_term_lookup) {
+        $operations = $this->parse_operations($transaction_elem, $transactionResults);
 
-      $action_handler = $action_handlers[$transaction_action_elem->localName] ?? null;
+        $taxonomy_term_lookup->warm($this->collect_taxonomy_term_names_by_vocabulary($operations));
 
-      if (! $action_handler) {
-        return farmos_wfs_makeExceptionReport(
-          function ($eReport, $elem) use ($transaction_action_elem) {
-            $eReport->appendChild(
-              $elem('Exception', [],
-                $elem('ExceptionText', [],
-                  "Could not understand request body action '{$transaction_action_elem->localName}': Transaction actions must be one of Insert, Update, or Delete")));
-          });
-      }
+        $set_asset_property_method = $this->create_asset_property_setter($taxonomy_term_lookup);
 
-      $this->$action_handler($transaction_action_elem, $transactionResults, $set_asset_property_method);
+        foreach ($operations as $idx => $operation) {
+          if ($transactionResults->isAborted()) {
+            break;
+          }
+
+          $operations[$idx] = $this->prepare_operation($operation, $transactionResults, $set_asset_property_method);
+        }
+
+        return $operations;
+      });
+
+    // Phase two - write the validated operations
+    if (! $transactionResults->isAborted()) {
+      $this->profiler->measure('apply', function () use ($operations, $transactionResults, $taxonomy_term_lookup) {
+        $this->apply_operations($operations, $transactionResults, $taxonomy_term_lookup);
+      });
     }
 
     return farmos_wfs_makeDoc(
@@ -141,66 +176,222 @@ class FarmWfsTransactionHandler {
                             $feature->appendChild($elem('wfs:Message', [], $message));
                           }));
                     }
+
+                    foreach ($transactionResults->deleteFailureMessages as $failed_delete_idx => $message) {
+
+                      $insertResults->appendChild(
+                        $elem('wfs:Action', array(
+                          'locator' => "failed_delete-$failed_delete_idx"
+                        ),
+                          function ($feature, $elem) use ($message) {
+
+                            $feature->appendChild($elem('wfs:Message', [], $message));
+                          }));
+                    }
                   }));
             }));
       });
   }
 
-  private function handle_insert(\DOMElement $transaction_action_elem, $transactionResults, $set_asset_property_method) {
-    $handle = $transaction_action_elem->attributes['handle'] ?? null;
+  /**
+   * Parses the actions of a transaction into operation records.
+   *
+   * Each record has the keys; action, feature_type, and depending on the action; handle, properties - a list of
+   * property name/value pairs, geometry_wkt, and asset_ids - the ids of the assets matched by the action's filter.
+   */
+  private function parse_operations(\DOMElement $transaction_elem, TransactionResults $transactionResults) {
+    $children_with_tag = 'farmos_wfs_get_xnode_children_with_tag';
 
-    foreach ($transaction_action_elem->childNodes as $feature_to_insert) {
+    $operations = [];
+
+    foreach ($children_with_tag($transaction_elem) as $transaction_action_elem) {
+
+      switch ($transaction_action_elem->localName) {
+        case 'Insert':
+          $handle = $transaction_action_elem->getAttribute('handle') ?: null;
+
+          foreach ($children_with_tag($transaction_action_elem) as $feature_to_insert) {
+            $feature_type = $this->validated_feature_type($feature_to_insert->localName);
+
+            $properties = array_map(
+              function ($property_elem) {
+                return [
+                  $property_elem->localName,
+                  $property_elem->nodeValue
+                ];
+              }, $children_with_tag($feature_to_insert, function ($localName) {
+                return $localName != 'geometry';
+              }));
+
+            try {
+              $geometry_wkt = geometry_property_to_wkt($feature_type,
+                $children_with_tag($feature_to_insert, 'geometry')[0] ?? null);
+            } catch (\Exception $e) {
+              $transactionResults->recordInsertionFailure($handle, $e->getMessage());
+              continue;
+            }
+
+            $operations[] = [
+              'action' => 'Insert',
+              'handle' => $handle,
+              'feature_type' => $feature_type,
+              'properties' => $properties,
+              'geometry_wkt' => $geometry_wkt
+            ];
+          }
+          break;
+
+        case 'Update':
+          $feature_type = $this->validated_feature_type($transaction_action_elem->getAttribute('typeName'));
+
+          $properties = [];
+          $geometry_wkt = null;
+
+          $property_pairs = properties_as_name_value_elem_pairs_with_geometry_last($transaction_action_elem);
+
+          try {
+            foreach ($property_pairs as list ($name, $value_elem)) {
+              if ($name == 'geometry') {
+                $geometry_wkt = geometry_property_to_wkt($feature_type, $value_elem);
+              } else {
+                $properties[] = [
+                  $name,
+                  $value_elem ? $value_elem->nodeValue : null
+                ];
+              }
+            }
+          } catch (\Exception $e) {
+            $transactionResults->recordUpdateFailure($e->getMessage());
+            break;
+          }
 
-      if ($feature_to_insert instanceof \DOMText && $feature_to_insert->isWhitespaceInElementContent()) {
-        continue;
+          $operations[] = [
+            'action' => 'Update',
+            'feature_type' => $feature_type,
+            'properties' => $properties,
+            'geometry_wkt' => $geometry_wkt,
+            'asset_ids' => $this->resolve_filtered_asset_ids($feature_type, $transaction_action_elem)
+          ];
+          break;
+
+        case 'Delete':
+          $feature_type = $this->validated_feature_type($transaction_action_elem->getAttribute('typeName'));
+
+          $operations[] = [
+            'action' => 'Delete',
+            'feature_type' => $feature_type,
+            'asset_ids' => $this->resolve_filtered_asset_ids($feature_type, $transaction_action_elem)
+          ];
+          break;
+
+        default:
+          throw new FarmWfsException(
+            farmos_wfs_makeExceptionReport(
+              function ($eReport, $elem) use ($transaction_action_elem) {
+                $eReport->appendChild(
+                  $elem('Exception', [],
+                    $elem('ExceptionText', [],
+                      "Could not understand request body action '{$transaction_action_elem->localName}': Transaction actions must be one of Insert, Update, or Delete")));
+              }), 400);
       }
+    }
+
+    return $operations;
+  }
 
-      list ($feature_types, $unknown_type_names) = $this->featureTypeFactoryValidator->type_name_to_validated_feature_types(
-        $feature_to_insert->localName);
+  private function validated_feature_type(string $type_name) {
+    list ($feature_types, $unknown_type_names) = $this->featureTypeFactoryValidator->type_name_to_validated_feature_types(
+      $type_name);
 
-      if (! empty($unknown_type_names)) {
-        $unknown_type_name = $unknown_type_names[0];
+    if (! empty($unknown_type_names) || empty($feature_types)) {
+      $unknown_type_name = $unknown_type_names[0] ?? $type_name;
 
-        throw new FarmWfsException(
-          farmos_wfs_makeExceptionReport(
-            function ($eReport, $elem) use ($unknown_type_name) {
-              $eReport->appendChild(
-                $elem('Exception', [],
-                  $elem('ExceptionText', [],
-                    "Could not understand request body: Unknown feature type '$unknown_type_name'")));
-            }), 400);
-      }
+      throw new FarmWfsException(
+        farmos_wfs_makeExceptionReport(
+          function ($eReport, $elem) use ($unknown_type_name) {
+            $eReport->appendChild(
+              $elem('Exception', [],
+                $elem('ExceptionText', [],
+                  "Could not understand request body: Unknown feature type '$unknown_type_name'")));
+          }), 400);
+    }
+
+    return $feature_types[0];
+  }
 
-      $feature_type = $feature_types[0];
+  private function resolve_filtered_asset_ids(FarmWfsFeatureType $feature_type, \DOMElement $transaction_action_elem) {
+    $filter_elem = farmos_wfs_get_xnode_children_with_tag($transaction_action_elem, 'Filter')[0] ?? null;
 
-      $asset_storage = $this->entityTypeManager->getStorage('asset');
+    $geometry_types = [
+      $feature_type->getGeometryTypeName()
+    ];
 
-      $asset = $asset_storage->create([
-        'type' => $feature_type->getAssetType(),
-      ]);
+    return $this->filterQueryResolver->resolve_query($feature_type->getAssetType(), $geometry_types, $filter_elem);
+  }
 
-      $children_with_tag = 'farmos_wfs_get_xnode_children_with_tag';
+  /**
+   * Builds and validates the entities an Insert or Update operation would save.
+   *
+   * The built entities are added to the operation record as a list of [asset, movement logs] pairs under the
+   * 'entities' key. Features which fail validation are recorded as failures and left out.
+   */
+  private function prepare_operation(array $operation, TransactionResults $transactionResults,
+    $set_asset_property_method) {
+    $feature_type = $operation['feature_type'];
 
-      $property_elements = $children_with_tag($feature_to_insert,
-        function ($localName) {
-          return $localName != 'geometry';
-        });
+    $asset_storage = $this->entityTypeManager->getStorage('asset');
 
-      $geometry_property_element = $children_with_tag($feature_to_insert, 'geometry')[0] ?? null;
+    switch ($operation['action']) {
+      case 'Insert':
+        $assets = [
+          $asset_storage->create([
+            'type' => $feature_type->getAssetType()
+          ])
+        ];
+        $record_failure = function ($message) use ($transactionResults, $operation) {
+          $transactionResults->recordInsertionFailure($operation['handle'], $message);
+        };
+        $invalid_message_prefix = "Inserted asset would not be valid.";
+        break;
+
+      case 'Update':
+        $assets = $asset_storage->loadMultiple($operation['asset_ids']);
+        $record_failure = function ($message) use ($transactionResults) {
+          $transactionResults->recordUpdateFailure($message);
+        };
+        $invalid_message_prefix = "Updated asset would not be valid.";
+        break;
+
+      default:
+        return $operation;
+    }
+
+    $properties = $operation['properties'];
+
+    // The geometry is set last since whether it is set on the asset or a movement log depends on the is_fixed property
+    if (isset($operation['geometry_wkt'])) {
+      $properties[] = [
+        'geometry',
+        $operation['geometry_wkt']
+      ];
+    }
 
-      if ($geometry_property_element) {
-        $property_elements[] = $geometry_property_element;
+    $operation['entities'] = [];
+
+    foreach ($assets as $asset) {
+
+      if ($transactionResults->isAborted()) {
+        break;
       }
 
       $asset_logs_to_save = [];
 
-      foreach ($property_elements as $feature_property_elem) {
+      foreach ($properties as list ($name, $value)) {
         try {
-          $logs_to_save = $set_asset_property_method($feature_type, $feature_property_elem->localName,
-            $feature_property_elem, $asset);
-          $asset_logs_to_save += $logs_to_save;
+          $asset_logs_to_save = array_merge($asset_logs_to_save,
+            $set_asset_property_method($feature_type, $name, $value, $asset));
         } catch (\Exception $e) {
-          $transactionResults->recordInsertionFailure($handle, $e->getMessage());
+          $record_failure($e->getMessage());
           continue 2;
         }
       }
@@ -208,81 +399,177 @@ class FarmWfsTransactionHandler {
       $constraint_violation_list = $asset->validate();
 
       if ($constraint_violation_list && $constraint_violation_list->count() > 0) {
-        $transactionResults->recordInsertionFailure($handle,
-          "Inserted asset would not be valid. Constraint violation at path '{$constraint_violation_list->get(0)->getPropertyPath()}': {$constraint_violation_list->get(0)->getMessage()}");
+        $record_failure(
+          "$invalid_message_prefix Constraint violation at path '{$constraint_violation_list->get(0)->getPropertyPath()}': {$constraint_violation_list->get(0)->getMessage()}");
         continue;
       }
 
-      $asset->save();
+      $operation['entities'][] = [
+        $asset,
+        $asset_logs_to_save
+      ];
+    }
 
-      foreach ($asset_logs_to_save as $log_to_save) {
-        $log_to_save->set('asset', [
-          'target_id' => $asset->id()
-        ]);
-        $log_to_save->save();
+    return $operation;
+  }
+
+  /**
+   * Writes the prepared operations in a single database transaction.
+   *
+   * The cache tags invalidated by the saved entities are merged and only invalidated once the transaction has been
+   * committed by core's transaction-aware cache tags checksum.
+   */
+  private function apply_operations(array $operations, TransactionResults $transactionResults,
+    TaxonomyTermLookup $taxonomy_term_lookup) {
+    $transaction = $this->connection->startTransaction();
+
+    // Updates were prepared before any writes so they may target assets which an earlier Delete has since removed
+    $deleted_asset_ids = [];
+
+    try {
+      $taxonomy_term_lookup->save_new_terms();
+
+      foreach ($operations as $operation) {
+
+        if ($transactionResults->isAborted()) {
+          break;
+        }
+
+        switch ($operation['action']) {
+          case 'Insert':
+            foreach ($operation['entities'] as list ($asset, $asset_logs_to_save)) {
+              try {
+                $this->save_in_savepoint($asset, $asset_logs_to_save);
+              } catch (\Exception $e) {
+                $transactionResults->recordInsertionFailure($operation['handle'], $e->getMessage());
+                continue;
+              }
+
+              $transactionResults->recordInsertionSuccess($operation['handle'],
+                "{$operation['feature_type']->unqualifiedTypeName()}.{$asset->uuid()}");
+            }
+            break;
+
+          case 'Update':
+            foreach ($operation['entities'] as list ($asset, $asset_logs_to_save)) {
+              if (isset($deleted_asset_ids[$asset->id()])) {
+                $transactionResults->recordUpdateFailure(
+                  "Could not update asset {$asset->uuid()}: it was deleted earlier in the transaction");
+                continue;
+              }
+
+              try {
+                $this->save_in_savepoint($asset, $asset_logs_to_save);
+              } catch (\Exception $e) {
+                $transactionResults->recordUpdateFailure($e->getMessage());
+                continue;
+              }
+
+              $transactionResults->recordUpdateSuccess();
+            }
+            break;
+
+          case 'Delete':
+            $deleted_asset_ids += array_fill_keys(
+              $this->delete_assets($operation['asset_ids'], $transactionResults), TRUE);
+            break;
+        }
       }
 
-      $transactionResults->recordInsertionSuccess($handle, "{$feature_type->unqualifiedTypeName()}.{$asset->uuid()}");
+      if ($transactionResults->isAborted()) {
+        $transaction->rollBack();
+        $transactionResults->discardSuccesses();
+      }
+    } catch (\Exception $e) {
+      $transaction->rollBack();
+      throw $e;
     }
+
+    // Commits the transaction
+    unset($transaction);
   }
 
-  private function handle_update(\DOMElement $transaction_action_elem, $transactionResults, $set_asset_property_method) {
-    list ($feature_types, $unknown_type_names) = $this->featureTypeFactoryValidator->type_name_to_validated_feature_types(
-      $transaction_action_elem->getAttribute('typeName'));
+  /**
+   * Deletes the given assets.
+   *
+   * @return array The ids of the assets which were deleted.
+   */
+  private function delete_assets(array $asset_ids, TransactionResults $transactionResults) {
+    $asset_storage = $this->entityTypeManager->getStorage('asset');
 
-    if (! empty($unknown_type_names)) {
-      $unknown_type_name = $unknown_type_names[0];
+    $deleted_asset_ids = [];
 
-      throw new FarmWfsException(
-        farmos_wfs_makeExceptionReport(
-          function ($eReport, $elem) use ($unknown_type_name) {
-            $eReport->appendChild(
-              $elem('Exception', [],
-                $elem('ExceptionText', [],
-                  "Could not understand request body: Unknown feature type '$unknown_type_name'")));
-          }), 400);
-    }
+    // Assets are loaded and deleted in batches so that memory usage stays bounded and the storage can delete each batch
+    // with a single query per table
+    foreach (array_chunk($asset_ids, FARMOS_WFS_DELETE_BATCH_SIZE) as $asset_ids_batch) {
+      $assets = $asset_storage->loadMultiple($asset_ids_batch);
 
-    $feature_type = $feature_types[0];
+      $savepoint = $this->connection->startTransaction();
 
-    $children_with_tag = 'farmos_wfs_get_xnode_children_with_tag';
+      try {
+        $asset_storage->delete($assets);
+      } catch (\Exception $e) {
+        $savepoint->rollBack();
+        unset($savepoint);
 
-    $filter_elem = $children_with_tag($transaction_action_elem, 'Filter')[0] ?? null;
+        // Retry the batch one asset at a time to find out which of the assets cannot be deleted
+        $deleted_asset_ids = array_merge($deleted_asset_ids, $this->delete_individually($assets, $transactionResults));
+      }
 
-    $geometry_types = [
-      $feature_type->getGeometryTypeName()
-    ];
+      if (isset($savepoint)) {
+        unset($savepoint);
 
-    $asset_ids = $this->filterQueryResolver->resolve_query($feature_type->getAssetType(), $geometry_types, $filter_elem);
+        foreach ($assets as $asset) {
+          $transactionResults->recordDeleteSuccess();
+          $deleted_asset_ids[] = $asset->id();
+        }
+      }
 
-    $asset_storage = $this->entityTypeManager->getStorage('asset');
+      $asset_storage->resetCache(array_keys($assets));
 
-    $assets = $asset_storage->loadMultiple($asset_ids);
+      if ($transactionResults->isAborted()) {
+        break;
+      }
+    }
 
-    $properties = properties_as_name_value_elem_pairs_with_geometry_last($transaction_action_elem);
+    return $deleted_asset_ids;
+  }
+
+  private function delete_individually(array $assets, $transactionResults) {
+    $deleted_asset_ids = [];
 
     foreach ($assets as $asset) {
+      $savepoint = $this->connection->startTransaction();
 
-      $asset_logs_to_save = [];
+      try {
+        $asset->delete();
+      } catch (\Exception $e) {
+        $savepoint->rollBack();
+        $transactionResults->recordDeleteFailure($e->getMessage());
 
-      foreach ($properties as list ($name, $value_elem)) {
-        try {
-          $logs_to_save = $set_asset_property_method($feature_type, $name, $value_elem, $asset);
-          $asset_logs_to_save += $logs_to_save;
-        } catch (\Exception $e) {
-          $transactionResults->recordUpdateFailure($e->getMessage());
-          continue 2;
+        if ($transactionResults->isAborted()) {
+          break;
         }
-      }
-
-      $constraint_violation_list = $asset->validate();
 
-      if ($constraint_violation_list && $constraint_violation_list->count() > 0) {
-        $transactionResults->recordUpdateFailure(
-          "Updated asset would not be valid. Constraint violation at path '{$constraint_violation_list->get(0)->getPropertyPath()}': {$constraint_violation_list->get(0)->getMessage()}");
         continue;
       }
 
+      unset($savepoint);
+
+      $transactionResults->recordDeleteSuccess();
+      $deleted_asset_ids[] = $asset->id();
+    }
+
+    return $deleted_asset_ids;
+  }
+
+  /**
+   * Saves an asset along with its new movement logs such that either all or none of them are saved.
+   */
+  private function save_in_savepoint(Asset $asset, array $asset_logs_to_save) {
+    $savepoint = $this->connection->startTransaction();
+
+    try {
       $asset->save();
 
       foreach ($asset_logs_to_save as $log_to_save) {
@@ -291,69 +578,58 @@ class FarmWfsTransactionHandler {
         ]);
         $log_to_save->save();
       }
-
-      $transactionResults->recordUpdateSuccess();
+    } catch (\Exception $e) {
+      $savepoint->rollBack();
+      throw $e;
     }
   }
 
-  private function handle_delete(\DOMElement $transaction_action_elem, $transactionResults, $set_asset_property_method) {
-    list ($feature_types, $unknown_type_names) = $this->featureTypeFactoryValidator->type_name_to_validated_feature_types(
-      $transaction_action_elem->getAttribute('typeName'));
-
-    if (! empty($unknown_type_names)) {
-      $unknown_type_name = $unknown_type_names[0];
-
-      throw new FarmWfsException(
-        farmos_wfs_makeExceptionReport(
-          function ($eReport, $elem) use ($unknown_type_name) {
-            $eReport->appendChild(
-              $elem('Exception', [],
-                $elem('ExceptionText', [],
-                  "Could not understand request body: Unknown feature type '$unknown_type_name'")));
-          }), 400);
-    }
+  /**
+   * Gets the names of all the taxonomy terms referenced by the transaction operations keyed by vocabulary.
+   */
+  private function collect_taxonomy_term_names_by_vocabulary(array $operations) {
+    $names_by_vocabulary = [];
 
-    $feature_type = $feature_types[0];
-
-    $filter_elem = farmos_wfs_get_xnode_children_with_tag($transaction_action_elem, 'Filter')[0] ?? null;
+    foreach ($operations as $operation) {
+      if (empty($operation['properties'])) {
+        continue;
+      }
 
-    $geometry_types = [
-      $feature_type->getGeometryTypeName()
-    ];
+      $field_definitions = $this->entityFieldManager->getFieldDefinitions('asset',
+        $operation['feature_type']->getAssetType());
 
-    $asset_ids = $this->filterQueryResolver->resolve_query($feature_type->getAssetType(), $geometry_types, $filter_elem);
+      foreach ($operation['properties'] as list ($name, $value)) {
+        $field_definition = $field_definitions[$name] ?? null;
 
-    $asset_storage = $this->entityTypeManager->getStorage('asset');
+        if (! isset($value) || ! $field_definition || $field_definition->getType() != "entity_reference" ||
+          $field_definition->getSetting('target_type') != "taxonomy_term") {
+          continue;
+        }
 
-    $assets = $asset_storage->loadMultiple($asset_ids);
+        $handler_settings = $field_definition->getSetting('handler_settings') ?? [];
 
-    foreach ($assets as $asset) {
-      $asset->delete();
-      $transactionResults->recordDeleteSuccess();
+        foreach ($handler_settings['target_bundles'] ?? [] as $vocabulary) {
+          $names_by_vocabulary[$vocabulary][] = $value;
+        }
+      }
     }
+
+    return $names_by_vocabulary;
   }
 
-  private function create_asset_property_setter() {
+  private function create_asset_property_setter(TaxonomyTermLookup $taxonomy_term_lookup) {
     $field_definitions_by_asset_type_cache = [];
 
     $log_storage = $this->entityTypeManager->getStorage('log');
 
-    return function (FarmWfsFeatureType $feature_type, string $raw_property_name, \DOMElement $property_value_elem,
-      Asset $asset) use (&$field_definitions_by_asset_type_cache, &$log_storage) {
+    return function (FarmWfsFeatureType $feature_type, string $raw_property_name, ?string $raw_value, Asset $asset) use (
+      &$field_definitions_by_asset_type_cache, &$log_storage, $taxonomy_term_lookup) {
 
       $logs_to_save = [];
 
+      // Geometry values are converted to WKT when the transaction is parsed - see geometry_property_to_wkt
       if ($raw_property_name == 'geometry') {
-        $gml_geometry_elem = farmos_wfs_get_xnode_children_with_tag($property_value_elem)[0];
-
-        $geophp_geometry = gml_three_point_one_point_one_to_geophp($gml_geometry_elem);
-
-        if ($geophp_geometry->geometryType() != $feature_type->getGeometryTypeName()) {
-          throw new \Exception(
-            "Attempted to set geometry of type '{$geophp_geometry->geometryType()}' when expected geometry type should be '{$feature_type->getGeometryTypeName()}'");
-        }
-
-        $wkt = $geophp_geometry->out('wkt');
+        $wkt = $raw_value;
 
         if ($asset->get('is_fixed')->value) {
           $asset->set('intrinsic_geometry', $wkt);
@@ -392,39 +668,36 @@ class FarmWfsTransactionHandler {
         throw new \Exception("Attempted to set unknown asset property: $raw_property_name");
       }
 
-      $value = $property_value_elem->nodeValue;
+      $value = $raw_value;
 
-      if ($field_definition->getType() == "entity_reference" && $field_definition->getSetting('target_type') == "taxonomy_term") {
+      if (isset($value) && $field_definition->getType() == "entity_reference" && $field_definition->getSetting('target_type') == "taxonomy_term") {
         $handler_settings = $field_definition->getSetting('handler_settings') ?? [];
 
         $target_bundles = array_values($handler_settings['target_bundles'] ?? []);
 
-        $query = \Drupal::entityQuery('taxonomy_term');
-        $query->accessCheck(TRUE);
-        $query->condition('vid', $target_bundles, 'IN');
-        $query->condition('name', $value);
-
-        $tids = $query->execute();
+        $term = $taxonomy_term_lookup->lookup($target_bundles, $value);
 
-        if (! empty($tids)) {
-          $value = array_values($tids)[0];
-        } else {
+        if (! isset($term)) {
           $auto_create_bundle = $handler_settings['auto_create_bundle'] ?? null;
 
           if (! $handler_settings['auto_create'] ?? FALSE || !$auto_create_bundle) {
             throw new \Exception("Attempted to set a taxonomy reference to '$value' which cannot be auto-created for asset property: $raw_property_name");
           }
 
+          // The new term is only saved once the transaction is applied
           $term = $this->entityTypeManager->getStorage('taxonomy_term')->create([
             'vid'      => $auto_create_bundle,
             'name'     => $value,
           ]);
-          $term->save();
-          $value = $term->id();
+          $taxonomy_term_lookup->add($auto_create_bundle, $value, $term);
         }
+
+        $value = is_object($term) ? [
+          'entity' => $term
+        ] : $term;
       }
 
-      if ($field_definition->getType() == 'timestamp') {
+      if (isset($value) && $field_definition->getType() == 'timestamp') {
         $datetime = new \DateTime($value);
 
         $value = $datetime->getTimestamp();
@@ -438,13 +711,13 @@ class FarmWfsTransactionHandler {
 
       if ($constraint_violation_list && $constraint_violation_list->count() > 0) {
         throw new \Exception(
-          "Attempted to set an illegal value of '$value' for asset property '$raw_property_name': {$constraint_violation_list->get(0)->getMessage()}");
+          "Attempted to set an illegal value of '$raw_value' for asset property '$raw_property_name': {$constraint_violation_list->get(0)->getMessage()}");
       }
 
       // For some reason state fields only validate on non-new entities...
       // https://git.drupalcode.org/project/state_machine/-/blob/2f33a2a78db28e82fb62222cdcce211942aec231/src/Plugin/Validation/Constraint/StateConstraintValidator.php#L19
       if ($field_definition->getType() == 'state' && ! $field_data->first()->isValid()) {
-        throw new \Exception("Attempted to set an illegal value of '$value' for asset property '$raw_property_name'");
+        throw new \Exception("Attempted to set an illegal value of '$raw_value' for asset property '$raw_property_name'");
       }
 
       return $logs_to_save;
@@ -489,6 +762,10 @@ function properties_as_name_value_elem_pairs_with_geometry_last($transaction_act
 
 class TransactionResults {
 
+  private bool $abortOnFailure;
+
+  private bool $aborted = false;
+
   public array $insertedFeaturesByHandle = [];
 
   private int $updateSuccessCount = 0;
@@ -499,6 +776,28 @@ class TransactionResults {
 
   public array $updateFailureMessages = [];
 
+  public array $deleteFailureMessages = [];
+
+  function __construct(bool $abort_on_failure = false) {
+    $this->abortOnFailure = $abort_on_failure;
+  }
+
+  /**
+   * Whether a failure was recorded which should cause the whole transaction to be rolled back.
+   */
+  function isAborted() {
+    return $this->aborted;
+  }
+
+  /**
+   * Forgets the recorded successes after the transaction has been rolled back.
+   */
+  function discardSuccesses() {
+    $this->insertedFeaturesByHandle = [];
+    $this->updateSuccessCount = 0;
+    $this->deleteSuccessCount = 0;
+  }
+
   function totalInserted() {
     return count($this->insertedFeaturesByHandle);
   }
@@ -525,72 +824,145 @@ class TransactionResults {
 
   function recordInsertionFailure($handle, $message) {
     $this->insertionFailureMessagesByHandle[$handle][] = $message;
+    $this->aborted = $this->abortOnFailure;
   }
 
   function recordUpdateFailure($message) {
     $this->updateFailureMessages[] = $message;
+    $this->aborted = $this->abortOnFailure;
+  }
+
+  function recordDeleteFailure($message) {
+    $this->deleteFailureMessages[] = $message;
+    $this->aborted = $this->abortOnFailure;
   }
 }
 
-function gml_three_point_one_point_one_to_geophp($geometry_elem) {
-  $children_with_tag = 'farmos_wfs_get_xnode_children_with_tag';
+/**
+ * Transaction-scoped lookup table of taxonomy term ids by vocabulary and (case-insensitive) name.
+ */
+class TaxonomyTermLookup {
 
-  switch ($geometry_elem->localName) {
-    case 'Point':
+  private $termStorage;
 
-      $pos = $children_with_tag($geometry_elem, 'pos')[0];
+  // Term ids - or new, not yet saved, terms - keyed by vocabulary and lowercase name. FALSE marks names known not to exist
+  private array $termIdsByVocabularyAndName = [];
 
-      // Check $pos->attributes['srsDimension'] == '2'
+  private array $newTerms = [];
 
-      $coord_pair = explode(' ', $pos->nodeValue);
+  function __construct($term_storage) {
+    $this->termStorage = $term_storage;
+  }
 
-      return new \Point($coord_pair[0], $coord_pair[1]);
+  /**
+   * Loads the ids of the terms with any of the given names in a single query.
+   */
+  function warm(array $names_by_vocabulary) {
+    $names_by_vocabulary = array_filter($names_by_vocabulary);
 
-    case 'LineString':
+    if (empty($names_by_vocabulary)) {
+      return;
+    }
 
-      $posList = $children_with_tag($geometry_elem, 'posList')[0];
+    $query = $this->termStorage->getQuery();
+    $query->accessCheck(TRUE);
+    $query->condition('vid', array_keys($names_by_vocabulary), 'IN');
+    $query->condition('name', array_values(array_unique(array_merge(...array_values($names_by_vocabulary)))), 'IN');
+    $query->sort('tid');
 
-      $coord_pairs = array_chunk(explode(' ', $posList->nodeValue), 2);
+    foreach ($names_by_vocabulary as $vocabulary => $names) {
+      foreach ($names as $name) {
+        $this->termIdsByVocabularyAndName[$vocabulary][mb_strtolower($name)] ??= FALSE;
+      }
+    }
 
-      $points = array_map(function ($coord_pair) {
-        return new \Point($coord_pair[0], $coord_pair[1]);
-      }, $coord_pairs);
+    foreach ($this->termStorage->loadMultiple($query->execute()) as $term) {
+      $key = mb_strtolower($term->getName());
 
-      return new \LineString($points);
+      if (empty($this->termIdsByVocabularyAndName[$term->bundle()][$key])) {
+        $this->termIdsByVocabularyAndName[$term->bundle()][$key] = $term->id();
+      }
+    }
+  }
 
-    case 'Polygon':
+  /**
+   * Gets the id of a term with a given name in the first of the given vocabularies which has one.
+   *
+   * @return int|\Drupal\taxonomy\TermInterface|null The term id, a new term added to the lookup, or null if no such
+   *         term exists.
+   */
+  function lookup(array $vocabularies, string $name) {
+    $key = mb_strtolower($name);
+
+    $unknown_vocabularies = array_values(
+      array_filter($vocabularies, function ($vocabulary) use ($key) {
+        return ! isset($this->termIdsByVocabularyAndName[$vocabulary][$key]);
+      }));
+
+    if (! empty($unknown_vocabularies)) {
+      $this->warm(array_fill_keys($unknown_vocabularies, [
+        $name
+      ]));
+    }
 
-      $lines = array();
+    foreach ($vocabularies as $vocabulary) {
+      $tid = $this->termIdsByVocabularyAndName[$vocabulary][$key] ?? FALSE;
 
-      $component_elems = $children_with_tag($geometry_elem);
+      if ($tid !== FALSE) {
+        return $tid;
+      }
+    }
 
-      foreach ($component_elems as $component_elem) {
+    return null;
+  }
 
-        $fn = array(
-          'exterior' => 'array_unshift',
-          'interior' => 'array_push'
-        )[$component_elem->localName] ?? null;
+  /**
+   * Adds a term id or a new term to the lookup.
+   */
+  function add(string $vocabulary, string $name, $tid_or_new_term) {
+    $this->termIdsByVocabularyAndName[$vocabulary][mb_strtolower($name)] = $tid_or_new_term;
 
-        if ($fn) {
-          $linearRing = $children_with_tag($component_elem, 'LinearRing')[0];
+    if (is_object($tid_or_new_term)) {
+      $this->newTerms[] = $tid_or_new_term;
+    }
+  }
 
-          $posList = $children_with_tag($linearRing, 'posList')[0];
+  /**
+   * Saves the new terms which were added to the lookup.
+   */
+  function save_new_terms() {
+    foreach ($this->newTerms as $term) {
+      if ($term->isNew()) {
+        $term->save();
+      }
+    }
 
-          // Check $posList->attributes['srsDimension'] == '2'
+    $this->newTerms = [];
+  }
+}
 
-          $coord_pairs = array_chunk(explode(' ', $posList->nodeValue), 2);
+/**
+ * Converts a GML geometry property element to WKT checking that it matches the geometry type of the feature type.
+ *
+ * @return string|null The WKT or null if no geometry property element is given.
+ */
+function geometry_property_to_wkt(FarmWfsFeatureType $feature_type, ?\DOMElement $property_value_elem) {
+  if (! $property_value_elem) {
+    return null;
+  }
 
-          $points = array_map(function ($coord_pair) {
-            return new \Point($coord_pair[0], $coord_pair[1]);
-          }, $coord_pairs);
+  $gml_geometry_elem = farmos_wfs_get_xnode_children_with_tag($property_value_elem)[0] ?? null;
 
-          $fn($lines, new \LineString($points));
-        }
-      }
+  if (! $gml_geometry_elem) {
+    throw new \Exception("Attempted to set geometry without a GML geometry element");
+  }
 
-      return new \Polygon($lines);
+  $geophp_geometry = farmos_wfs_gml_three_point_one_point_one_to_geophp($gml_geometry_elem);
 
-    default:
-      throw new \Exception("Unsupported geometry type: {$geometry_elem->localName}");
+  if ($geophp_geometry->geometryType() != $feature_type->getGeometryTypeName()) {
+    throw new \Exception(
+      "Attempted to set geometry of type '{$geophp_geometry->geometryType()}' when expected geometry type should be '{$feature_type->getGeometryTypeName()}'");
   }
+
+  return $geophp_geometry->out('wkt');
 }
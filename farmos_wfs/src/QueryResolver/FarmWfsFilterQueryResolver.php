@@ -2,63 +2,170 @@
 
 namespace Drupal\farmos_wfs\QueryResolver;
 
+use Drupal\Component\Datetime\TimeInterface;
+use Drupal\Component\Utility\Crypt;
+use Drupal\Core\Database\Connection;
+use Drupal\Core\Database\Query\SelectInterface;
+use Drupal\farmos_wfs\FarmWfsFilterCompiler;
 use Drupal\farmos_wfs\FarmWfsQueryFactory;
 
 class FarmWfsFilterQueryResolver {
 
   protected $queryFactory;
 
-  public function __construct(FarmWfsQueryFactory $query_factory) {
+  protected $filterCompiler;
+
+  protected $connection;
+
+  protected $time;
+
+  public function __construct(FarmWfsQueryFactory $query_factory, FarmWfsFilterCompiler $filter_compiler,
+    Connection $connection, TimeInterface $time) {
     $this->queryFactory = $query_factory;
+    $this->filterCompiler = $filter_compiler;
+    $this->connection = $connection;
+    $this->time = $time;
   }
 
   /**
-   * Retrieves an array of asset ids by geometry type and OGC Filter element.
+   * Gets the bounding box the matches of an OGC Filter element are restricted to - see FarmWfsFilterCompiler::get_bbox.
    */
-  function resolve_query(string $asset_type, array $geometry_types, \DOMElement $filter_elem) {
-    $filter_ids = [];
+  function get_bbox(\DOMElement $filter_elem) {
+    return $this->filterCompiler->get_bbox($filter_elem);
+  }
 
-    $nontext_filter_children = array_values(
-      array_filter(iterator_to_array($filter_elem->childNodes),
-        function ($e) {
-          return ! ($e instanceof \DOMText && $e->isWhitespaceInElementContent());
-        }));
+  /**
+   * Creates a query selecting asset ids by geometry type and OGC Filter element.
+   *
+   * When the filter has spatial operations which need the exact geometries to be tested, the ids of the matching
+   * assets are recorded in the spatial match table and joined from there. That keeps the query small however many
+   * assets match. The recorded matches are removed once the request has been sent - or by cron if it is aborted.
+   */
+  function create_query(string $asset_type, array $geometry_types, \DOMElement $filter_elem) {
+    $asset_query = $this->queryFactory->create_query($asset_type, $geometry_types);
 
-    $distinct_child_names = array_unique(array_map(function ($e) {
-      return $e->localName;
-    }, $nontext_filter_children));
+    $asset_query->condition($this->filterCompiler->compile($asset_query, $asset_type, $filter_elem));
 
-    if (empty($distinct_child_names)) {
-      throw new \Exception("Illegal filter expression. Cannot be empty.");
-    }
+    $spatial_predicates = $asset_query->getMetaData('farmos_wfs_spatial_predicates');
 
-    if (count($distinct_child_names) > 1) {
-      $distinct_child_names_str = print_r($distinct_child_names, TRUE);
-      throw new \Exception("Illegal filter expression. Heterogeneous children of types: $distinct_child_names_str");
+    if (empty($spatial_predicates)) {
+      return $asset_query;
     }
 
-    if ($distinct_child_names[0] == 'FeatureId' || $distinct_child_names[0] == 'GmlObjectId') {
+    $match_id = Crypt::randomBytesBase64(24);
+
+    drupal_register_shutdown_function(function () use ($match_id) {
+      $this->connection->delete(FARMOS_WFS_SPATIAL_MATCH_TABLE)
+        ->condition('match_id', $match_id)
+        ->execute();
+    });
 
-      $children_with_tag = 'farmos_wfs_get_xnode_children_with_tag';
+    $match_count = $this->refine_spatial_predicates($asset_query, $spatial_predicates, $match_id);
 
-      $filter_raw_ids = array_merge(
-        array_map(function ($e) {
-          return $e->getAttribute('fid');
-        }, $children_with_tag($filter_elem, 'FeatureId')),
-        array_map(function ($e) {
-          return $e->getAttribute('id');
-        }, $children_with_tag($filter_elem, 'GmlObjectId')));
+    $refined_asset_query = $this->queryFactory->create_query($asset_type, $geometry_types);
 
-      $filter_ids = array_map(function ($raw_id) {
-        return preg_replace('/^[^.]+\.(.*)$/', '$1', $raw_id);
-      }, $filter_raw_ids);
+    if ($match_count == 0) {
+      $refined_asset_query->alwaysFalse();
     } else {
-      throw new \Exception("Unsupported filter operation: '{$distinct_child_names[0]}'");
+      $refined_asset_query->join(FARMOS_WFS_SPATIAL_MATCH_TABLE, 'spatial_match', 'asset.id = spatial_match.asset_id');
+      $refined_asset_query->condition('spatial_match.match_id', $match_id);
     }
 
-    $asset_query = $this->queryFactory->create_query($asset_type, $geometry_types);
+    return $refined_asset_query;
+  }
+
+  /**
+   * Removes the recorded spatial matches of requests which didn't get to clean up after themselves.
+   */
+  function prune_spatial_matches() {
+    $this->connection->delete(FARMOS_WFS_SPATIAL_MATCH_TABLE)
+      ->condition('created', $this->time->getRequestTime() - 3600, '<')
+      ->execute();
+  }
 
-    $asset_query->condition('uuid', $filter_ids, 'IN');
+  /**
+   * Creates a condition matching assets by OGC Filter element on a query created by FarmWfsQueryFactory::create_query.
+   *
+   * Unlike create_query, the exact geometries are not tested here. Spatial predicates which need that are instead
+   * collected in the 'farmos_wfs_spatial_predicates' metadata of the query.
+   */
+  function create_condition(SelectInterface $asset_query, string $asset_type, \DOMElement $filter_elem) {
+    return $this->filterCompiler->compile($asset_query, $asset_type, $filter_elem);
+  }
+
+  /**
+   * Tests the exact geometries of the candidate assets matched by a query against the given spatial predicates.
+   *
+   * The geometry values are loaded a batch of candidates at a time without loading the asset entities. The ids of the
+   * matching assets are recorded in the spatial match table under the given match id a batch at a time as well.
+   *
+   * @return int The number of assets whose geometries match all the spatial predicates.
+   */
+  private function refine_spatial_predicates(SelectInterface $candidate_query, array $spatial_predicates,
+    string $match_id) {
+    $this->queryFactory->add_geometry_fields($candidate_query);
+
+    $match_count = 0;
+
+    $match_batch = function (array $rows) use ($spatial_predicates, $match_id, &$match_count) {
+      $matching_asset_ids = [];
+
+      foreach ($this->queryFactory->load_geometry_values($rows) as $asset_id => $wkt) {
+        $geometry = $wkt ? \geoPHP::load($wkt, 'wkt') : null;
+
+        foreach ($spatial_predicates as $spatial_predicate) {
+          if (! $spatial_predicate->matches($geometry)) {
+            continue 2;
+          }
+        }
+
+        $matching_asset_ids[] = $asset_id;
+      }
+
+      if (empty($matching_asset_ids)) {
+        return;
+      }
+
+      $insert = $this->connection->insert(FARMOS_WFS_SPATIAL_MATCH_TABLE)->fields([
+        'match_id',
+        'asset_id',
+        'created'
+      ]);
+
+      foreach ($matching_asset_ids as $asset_id) {
+        $insert->values([
+          'match_id' => $match_id,
+          'asset_id' => $asset_id,
+          'created' => $this->time->getRequestTime()
+        ]);
+      }
+
+      $insert->execute();
+
+      $match_count += count($matching_asset_ids);
+    };
+
+    $rows = [];
+
+    foreach ($candidate_query->execute() as $row) {
+      $rows[] = $row;
+
+      if (count($rows) >= FARMOS_WFS_SPATIAL_REFINEMENT_BATCH_SIZE) {
+        $match_batch($rows);
+        $rows = [];
+      }
+    }
+
+    $match_batch($rows);
+
+    return $match_count;
+  }
+
+  /**
+   * Retrieves an array of asset ids by geometry type and OGC Filter element.
+   */
+  function resolve_query(string $asset_type, array $geometry_types, \DOMElement $filter_elem) {
+    $asset_query = $this->create_query($asset_type, $geometry_types, $filter_elem);
 
     $result = $asset_query->execute();
 
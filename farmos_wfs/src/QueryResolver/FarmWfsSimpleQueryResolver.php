@@ -12,11 +12,18 @@ class FarmWfsSimpleQueryResolver {
     $this->queryFactory = $query_factory;
   }
 
+  /**
+   * Creates a query selecting asset ids by geometry type.
+   */
+  function create_query(string $asset_type, array $geometry_types) {
+    return $this->queryFactory->create_query($asset_type, $geometry_types);
+  }
+
   /**
    * Retrieves an array of asset ids by geometry type.
    */
   function resolve_query(string $asset_type, array $geometry_types) {
-    $asset_query = $this->queryFactory->create_query($asset_type, $geometry_types);
+    $asset_query = $this->create_query($asset_type, $geometry_types);
 
     $result = $asset_query->execute();
 